@@ -6,12 +6,123 @@ this class and override the constructor and these three member
 functions.
 """
 
+import os
+import sys
+import errno
+import shutil
+import tempfile
+import threading
 from abc import ABCMeta
+from subprocess import Popen, PIPE
+
+
+class ConcatFeeder(threading.Thread):
+    """ Writes the concatenation of some files into a named pipe, so that a
+        program that takes only one input file can read several without
+        their being copied to disk first.  The pipe can be read only once. """
+
+    def __init__(self, fns):
+        super(ConcatFeeder, self).__init__()
+        self.daemon = True
+        self.fns = fns
+        self.dir = tempfile.mkdtemp(prefix='qtip_fifo_')
+        self.fifo = os.path.join(self.dir, 'concat')
+        self.error = None
+        os.mkfifo(self.fifo)
+
+    def run(self):
+        try:
+            with open(self.fifo, 'wb') as ofh:  # blocks until reader opens
+                for fn in self.fns:
+                    with open(fn, 'rb') as fh:
+                        shutil.copyfileobj(fh, ofh, 1024 * 1024)
+        except IOError as e:
+            if e.errno != errno.EPIPE:
+                self.error = e
+        except Exception as e:
+            self.error = e
+
+    def close(self):
+        """ Wait for writer to finish, unblocking it if the reader never
+            opened the pipe or stopped reading, and remove the pipe.  Raises
+            if the writer failed. """
+        while self.is_alive():
+            try:
+                os.close(os.open(self.fifo, os.O_RDONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
+            self.join(0.1)
+        shutil.rmtree(self.dir, ignore_errors=True)
+        if self.error is not None:
+            raise RuntimeError('Error feeding %s to aligner: %s' % (', '.join(self.fns), str(self.error)))
 
 
 class Aligner(object):
     __metaclass__ = ABCMeta
 
+    pipe = None
+    filter_pipe = None
+    feeders = None
+
+    def _concatenated(self, fns):
+        """ Return a filename from which the concatenation of the given
+            files can be read, for aligners taking only one file per mate.
+            Reads keep their names, so categories (e.g. the concordant,
+            discordant and bad-end tandem reads) can still be told apart
+            in the output. """
+        fns = list(fns)
+        if len(fns) == 1:
+            return fns[0]
+        if len(set(fn.endswith('.gz') for fn in fns)) > 1:
+            raise RuntimeError('Can\'t concatenate mix of compressed and uncompressed inputs: %s' % ', '.join(fns))
+        feeder = ConcatFeeder(fns)
+        if self.feeders is None:
+            self.feeders = []
+        self.feeders.append(feeder)
+        return feeder.fifo
+
+    def close_inputs(self):
+        """ Clean up after inputs fed through named pipes; call once
+            aligner has exited.  Raises if a feeder failed, since the
+            aligner then saw truncated input. """
+        feeders, self.feeders = self.feeders or [], None
+        for feeder in feeders:
+            feeder.close()
+
+    def _open_pipes(self, cmd, stdin, stderr, sam, output_filter):
+        """ Start the aligner.  If output_filter is given, the aligner writes
+            SAM to standard out, which is piped through output_filter (e.g. a
+            compressor) into file sam.  If sam is "-", the aligner's standard
+            out is left for the caller to read from self.pipe.stdout. """
+        close_fds = 'posix' in sys.builtin_module_names
+        for feeder in self.feeders or []:
+            feeder.start()
+        if output_filter is None:
+            self.pipe = Popen(cmd, shell=True,
+                              stdin=stdin, stdout=PIPE if sam == '-' else None, stderr=stderr,
+                              bufsize=-1, close_fds=close_fds)
+        else:
+            self.pipe = Popen(cmd, shell=True,
+                              stdin=stdin, stdout=PIPE, stderr=stderr,
+                              bufsize=-1, close_fds=close_fds)
+            with open(sam, 'wb') as ofh:
+                self.filter_pipe = Popen(output_filter, shell=True,
+                                         stdin=self.pipe.stdout, stdout=ofh,
+                                         close_fds=close_fds)
+            self.pipe.stdout.close()  # so aligner gets SIGPIPE if filter dies
+
     @staticmethod
     def supports_mix():
         return False
+
+    @staticmethod
+    def thread_options():
+        """ Aligner options that set how many threads it uses """
+        return []
+
+    @staticmethod
+    def supports_tab6_stream():
+        """ True iff aligner can take a mix of unpaired and paired-end reads
+            in Bowtie 2's --tab6 format on standard in, as written by
+            qtip-parse's tab6-out option """
+        return False
@@ -0,0 +1,279 @@
+"""
+Copyright 2016, Ben Langmead <langmea@cs.jhu.edu>
+
+Helpers for --batch: reading the sample manifest, splitting the output of
+one aligner run over many samples into per-sample SAM files, grouping
+samples with similar read and fragment lengths so they can share a tandem
+model, and splitting a pooled final SAM back into samples.
+"""
+
+import os
+import re
+from collections import OrderedDict
+from shards import open_reads, fastq_records
+from tandem_cache import round_sig
+
+__author__ = 'langmead'
+
+
+def read_batch_manifest(fn):
+    """
+    Read manifest with one sample per line: name, then comma-separated
+    unpaired FASTQ files, or name, then comma-separated mate 1 files, then
+    comma-separated mate 2 files.  Fields are tab-separated; blank lines and
+    lines starting with # are ignored.  Relative paths are relative to the
+    manifest's directory.
+    """
+    base = os.path.dirname(os.path.abspath(fn))
+    samples = []
+    names = set()
+    with open(fn) as fh:
+        for lineno, ln in enumerate(fh, 1):
+            ln = ln.rstrip('\r\n')
+            if len(ln.strip()) == 0 or ln.startswith('#'):
+                continue
+            toks = ln.split('\t')
+            if len(toks) not in [2, 3]:
+                raise RuntimeError('Line %d of batch manifest "%s" should have 2 or 3 tab-separated fields'
+                                   % (lineno, fn))
+            name = toks[0]
+            if re.match(r'^[A-Za-z0-9_.-]+$', name) is None or name.startswith('.'):
+                raise RuntimeError('Bad sample name "%s" on line %d of batch manifest "%s"' % (name, lineno, fn))
+            if name in names:
+                raise RuntimeError('Sample name "%s" appears more than once in batch manifest "%s"' % (name, fn))
+            names.add(name)
+            files = [[os.path.join(base, f) for f in tok.split(',')] for tok in toks[1:]]
+            if len(files) == 2 and len(files[0]) != len(files[1]):
+                raise RuntimeError('Sample "%s" has different numbers of mate 1 and mate 2 files' % name)
+            samples.append({'name': name,
+                            'unpaired': files[0] if len(files) == 1 else None,
+                            'paired': list(zip(files[0], files[1])) if len(files) == 2 else None})
+    if len(samples) == 0:
+        raise RuntimeError('No samples in batch manifest "%s"' % fn)
+    return samples
+
+
+def _read_name(nm):
+    """ Read name as aligners report it: up to the first whitespace, without
+        any /1 or /2 mate suffix """
+    nm = nm.split(None, 1)[0] if len(nm.strip()) > 0 else b''
+    if nm[-2:] in [b'/1', b'/2']:
+        nm = nm[:-2]
+    return nm
+
+
+def read_names(fns):
+    """ Yield the names of the FASTQ records in the given files, in order """
+    for fn in fns:
+        raw, fh = open_reads(fn)
+        try:
+            for rec in fastq_records(fh, fn):
+                yield _read_name(rec[1:rec.index(b'\n')])
+        finally:
+            fh.close()
+            raw.close()
+
+
+def _is_primary(ln):
+    return (int(ln.split(b'\t', 2)[1]) & 0x900) == 0
+
+
+def split_sam(sam_fn, names, dsts):
+    """
+    Split SAM output by an aligner that reported reads in input order into
+    one file per sample, copying the header to each.  names gives, for each
+    sample, an iterable over its read names in input order (one per pair for
+    paired-end samples).  Records are matched to reads by name, so reads the
+    aligner left out (e.g. Bowtie 2's --no-unal) don't shift the boundaries
+    between samples.  Secondary and supplementary records stay with the read
+    before.
+    """
+    assert len(names) == len(dsts)
+    with open(sam_fn, 'rb') as fh:
+        header = []
+        ln = fh.readline()
+        while ln[0:1] == b'@':
+            header.append(ln)
+            ln = fh.readline()
+        cur, ofh, it = -1, None, None
+        last, nrecs = None, 0  # read matched by the last primary record, and its records so far
+        while len(ln) > 0:
+            if _is_primary(ln):
+                toks = ln.split(b'\t', 2)
+                nm = _read_name(toks[0])
+                if nm != last or (int(toks[1]) & 1) == 0 or nrecs != 1:
+                    # advance through the samples' reads to this one
+                    while it is None or not any(rd == nm for rd in it):
+                        if ofh is not None:
+                            ofh.close()
+                        cur += 1
+                        if cur == len(dsts):
+                            raise RuntimeError('Read "%s" in "%s" is not among the samples\' reads, '
+                                               'or is out of order' % (nm.decode(), sam_fn))
+                        it = iter(names[cur])
+                        ofh = open(dsts[cur], 'wb')
+                        ofh.writelines(header)
+                    last, nrecs = nm, 0
+                nrecs += 1
+            elif ofh is None:
+                raise RuntimeError('"%s" starts with a secondary alignment' % sam_fn)
+            ofh.write(ln)
+            ln = fh.readline()
+    if ofh is not None:
+        ofh.close()
+    # samples after the last one with any alignments
+    for dst in dsts[cur+1:]:
+        with open(dst, 'wb') as ofh:
+            ofh.writelines(header)
+
+
+def sam_profile(sam_fn, max_reads=10000):
+    """
+    Summarize the first max_reads primary alignments in a SAM file: whether
+    reads are paired, and median read and fragment lengths rounded to two
+    significant digits.  Samples with the same profile can share a tandem
+    model.
+    """
+    lens, fraglens, paired = [], [], False
+    with open(sam_fn, 'rb') as fh:
+        for ln in fh:
+            if ln[0:1] == b'@':
+                continue
+            toks = ln.split(b'\t', 10)
+            flag = int(toks[1])
+            if (flag & 0x900) != 0:
+                continue
+            if (flag & 1) != 0:
+                paired = True
+            lens.append(len(toks[9]))
+            if (flag & 0x42) == 0x42:  # mate 1 of a concordant pair
+                fraglens.append(abs(int(toks[8])))
+            if len(lens) >= max_reads:
+                break
+    med = lambda ls: sorted(ls)[len(ls) // 2] if len(ls) > 0 else 0
+    return paired, round_sig(med(lens)), round_sig(med(fraglens))
+
+
+def group_by_profile(sams):
+    """ Return lists of indexes into sams, grouping those with the same
+        profile, in order of first appearance """
+    groups = OrderedDict()
+    for i, fn in enumerate(sams):
+        groups.setdefault(sam_profile(fn), []).append(i)
+    return list(groups.values())
+
+
+def split_final_sam(sam_fn, shards, dsts):
+    """
+    Split a final SAM, rewritten from an input SAM made by concatenating
+    samples' SAMs (see shards.concat_sams), back into one file per sample,
+    copying the header to each.
+    """
+    assert len(shards) == len(dsts)
+    with open(sam_fn, 'rb') as fh:
+        header = []
+        for _ in range(shards[0]['line_offset']):
+            header.append(fh.readline())
+        for i, dst in enumerate(dsts):
+            with open(dst, 'wb') as ofh:
+                ofh.writelines(header)
+                if i + 1 < len(shards):
+                    for _ in range(shards[i+1]['line_offset'] - shards[i]['line_offset']):
+                        ofh.write(fh.readline())
+                else:
+                    for ln in fh:
+                        ofh.write(ln)
+
+
+if __name__ == "__main__":
+
+    import sys
+    import shutil
+    import tempfile
+    import unittest
+    from os.path import join
+    from shards import concat_sams, read_shards
+
+    def _sam(recs):
+        return b''.join(('%s\t%d\t*\t0\t0\t*\t*\t0\t%d\tACGT\tIIII\n' % rec).encode() for rec in recs)
+
+    class TestCases(unittest.TestCase):
+
+        def setUp(self):
+            self.dir = tempfile.mkdtemp()
+
+        def tearDown(self):
+            shutil.rmtree(self.dir)
+
+        def _read(self, fn):
+            with open(fn, 'rb') as fh:
+                return fh.read()
+
+        def _write(self, fn, data):
+            with open(fn, 'wb') as fh:
+                fh.write(data)
+
+        def test_manifest_1(self):
+            fn = join(self.dir, 'samples.tsv')
+            self._write(fn, b'# comment\nA\ta.fq,b.fq\n\nB\tb_1.fq\tb_2.fq\n')
+            samples = read_batch_manifest(fn)
+            self.assertEqual(['A', 'B'], [s['name'] for s in samples])
+            self.assertEqual([join(self.dir, 'a.fq'), join(self.dir, 'b.fq')], samples[0]['unpaired'])
+            self.assertEqual([(join(self.dir, 'b_1.fq'), join(self.dir, 'b_2.fq'))], samples[1]['paired'])
+            self._write(fn, b'A\ta.fq\nA\tb.fq\n')
+            self.assertRaises(RuntimeError, read_batch_manifest, fn)
+            self._write(fn, b'../A\ta.fq\n')
+            self.assertRaises(RuntimeError, read_batch_manifest, fn)
+
+        def test_read_names_1(self):
+            fn = join(self.dir, 'a.fq')
+            self._write(fn, b'@r1/1 extra\nA\n+\nI\n@r2\nA\n+\nI\n')
+            self.assertEqual([b'r1', b'r2', b'r1', b'r2'], list(read_names([fn, fn])))
+
+        def test_split_sam_1(self):
+            fn = join(self.dir, 'all.sam')
+            # r2 has a secondary alignment
+            self._write(fn, b'@HD\tVN:1.0\n' + _sam([('r1', 4, 0), ('r2', 0, 0), ('r2', 256, 0), ('r3', 0, 0)]))
+            dsts = [join(self.dir, 's%d.sam' % i) for i in range(3)]
+            split_sam(fn, [[b'r1', b'r2'], [b'r3'], []], dsts)
+            self.assertEqual(b'@HD\tVN:1.0\n' + _sam([('r1', 4, 0), ('r2', 0, 0), ('r2', 256, 0)]),
+                             self._read(dsts[0]))
+            self.assertEqual(b'@HD\tVN:1.0\n' + _sam([('r3', 0, 0)]), self._read(dsts[1]))
+            self.assertEqual(b'@HD\tVN:1.0\n', self._read(dsts[2]))
+            self.assertRaises(RuntimeError, split_sam, fn, [[b'r1'], [b'r2'], []], dsts)
+            self.assertRaises(RuntimeError, split_sam, fn, [[b'r2', b'r1'], [b'r3'], []], dsts)
+
+        def test_split_sam_2(self):
+            # unaligned reads left out of the SAM, as with --no-unal; pairs
+            # with the same names in both samples
+            fn = join(self.dir, 'all.sam')
+            self._write(fn, b'@HD\tVN:1.0\n' + _sam([('p2', 99, 0), ('p2', 147, 0), ('p1', 99, 0), ('p1', 147, 0),
+                                                      ('p3', 97, 0), ('p3', 145, 0)]))
+            dsts = [join(self.dir, 's%d.sam' % i) for i in range(3)]
+            split_sam(fn, [[b'p1', b'p2'], [b'p1', b'p2', b'p3'], [b'p1']], dsts)
+            self.assertEqual(b'@HD\tVN:1.0\n' + _sam([('p2', 99, 0), ('p2', 147, 0)]), self._read(dsts[0]))
+            self.assertEqual(b'@HD\tVN:1.0\n' + _sam([('p1', 99, 0), ('p1', 147, 0), ('p3', 97, 0),
+                                                      ('p3', 145, 0)]), self._read(dsts[1]))
+            self.assertEqual(b'@HD\tVN:1.0\n', self._read(dsts[2]))
+
+        def test_profile_1(self):
+            fns = [join(self.dir, 's%d.sam' % i) for i in range(3)]
+            self._write(fns[0], _sam([('r1', 67, 300), ('r1', 131, -300)]))
+            self._write(fns[1], _sam([('r1', 67, 305), ('r1', 131, -305)]))
+            self._write(fns[2], _sam([('r1', 0, 0)]))
+            self.assertEqual((True, 4.0, 300.0), sam_profile(fns[0]))
+            self.assertEqual([[0, 1], [2]], group_by_profile(fns))
+
+        def test_split_final_1(self):
+            sams = [join(self.dir, 's%d.sam' % i) for i in range(2)]
+            self._write(sams[0], b'@HD\tVN:1.0\n' + _sam([('r1', 0, 0), ('r2', 0, 0)]))
+            self._write(sams[1], b'@HD\tVN:1.0\n' + _sam([('r3', 0, 0)]))
+            pooled, shards_fn = join(self.dir, 'pooled.sam'), join(self.dir, 'pooled.sam.shards')
+            concat_sams(sams, pooled, shards_fn)
+            dsts = [join(self.dir, 'f%d.sam' % i) for i in range(2)]
+            split_final_sam(pooled, read_shards(shards_fn), dsts)
+            for sam, dst in zip(sams, dsts):
+                self.assertEqual(self._read(sam), self._read(dst))
+
+    unittest.main(argv=[sys.argv[0]])
+    sys.exit()
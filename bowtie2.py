@@ -6,9 +6,7 @@ Concrete subclass for Bowtie 2 aligner.
 
 import os
 import logging
-import sys
 from operator import itemgetter
-from subprocess import Popen
 from aligner import Aligner
 
 try:
@@ -37,7 +35,9 @@ class Bowtie2(Aligner):
                  pairs_only=False,
                  sam=None,
                  quiet=False,
-                 input_format=None):
+                 input_format=None,
+                 output_filter=None,
+                 stdin=None):
         """ Create new process.
             
             Inputs:
@@ -52,12 +52,17 @@ class Bowtie2(Aligner):
             
             'sam' is a filename where output SAM records will be
             stored.  If 'sam' is none, SAM records will be added to
-            the outQ.
+            the outQ.  If 'output_filter' is set, SAM output is
+            piped through that shell command on its way to 'sam'.
+            If 'sam' is "-", SAM records can be read from pipe.stdout.
+
+            An input filename of "-" reads from 'stdin', e.g. the
+            stdout of another process.
         """
         if index is None:
             raise RuntimeError('Must specify --index when aligner is Bowtie 2')
         cmd_toks = cmd.split()
-        popen_stdin, popen_stdout, popen_stderr = None, None, None
+        popen_stdin, popen_stderr = stdin, None
         self.inQ, self.outQ = None, None
         # Make sure input arguments haven't been specified already
         for tok in ['-U', '-1', '-2']:
@@ -95,10 +100,10 @@ class Bowtie2(Aligner):
         assert '-S' not in cmd_toks
         # Compose output arguments
         output_args = []
-        if sam is not None:
-            output_args.extend(['-S', sam])
-        else:
+        if sam is None:
             raise RuntimeError("Must specify SAM output")
+        elif output_filter is None and sam != '-':
+            output_args.extend(['-S', sam])
         index_args = ['-x', index]
         # Put all the arguments together
         input_args.extend(aligner_args)
@@ -107,10 +112,16 @@ class Bowtie2(Aligner):
         logging.info('Bowtie 2 command: ' + cmd)
         if quiet:
             popen_stderr = open(os.devnull, 'w')
-        self.pipe = Popen(cmd, shell=True,
-                          stdin=popen_stdin, stdout=popen_stdout, stderr=popen_stderr,
-                          bufsize=-1, close_fds='posix' in sys.builtin_module_names)
+        self._open_pipes(cmd, popen_stdin, popen_stderr, sam, output_filter)
 
     @staticmethod
     def supports_mix():
         return True
+
+    @staticmethod
+    def thread_options():
+        return ['-p', '--threads']
+
+    @staticmethod
+    def supports_tab6_stream():
+        return True
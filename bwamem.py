@@ -6,8 +6,6 @@ Concrete subclass for BWA-MEM aligner.
 
 import os
 import logging
-import sys
-from subprocess import Popen
 from aligner import Aligner
 
 try:
@@ -36,7 +34,8 @@ class BwaMem(Aligner):
                  pairs_only=False,
                  sam=None,
                  quiet=False,
-                 input_format=None):
+                 input_format=None,
+                 output_filter=None):
         """ Create new process.
             
             Inputs:
@@ -51,42 +50,40 @@ class BwaMem(Aligner):
             
             'sam' is a filename where output SAM records will be
             stored.  If 'sam' is none, SAM records will be added to
-            the outQ.
+            the outQ.  If 'output_filter' is set, SAM output is
+            piped through that shell command on its way to 'sam'.
         """
         if index is None:
             raise RuntimeError('Must specify --index when aligner is bwa mem')
         options = []
-        popen_stdin, popen_stdout, popen_stderr = None, None, None
+        popen_stdin, popen_stderr = None, None
         self.inQ, self.outQ = None, None
-        # Compose input arguments
-        if unpaired is not None and len(unpaired) > 1:
-            raise RuntimeError('bwa mem can\'t handle more than one input file at a time')
-        if paired is not None and len(paired) > 1:
-            raise RuntimeError('bwa mem can\'t handle more than one input file at a time')
-        if paired_combined is not None and len(paired_combined) > 1:
-            raise RuntimeError('bwa mem can\'t handle more than one input file at a time')
+        # Compose input arguments; bwa mem takes one file per mate, so
+        # several are fed to it concatenated through named pipes
         if unpaired is not None and (paired is not None or paired_combined is not None):
             raise RuntimeError('bwa mem can\'t handle unpaired and paired-end inputs at the same time')
         input_args = []
         if unpaired is not None:
-            input_args = [unpaired[0]]
+            input_args = [self._concatenated(unpaired)]
             input_args.extend(aligner_unpaired_args)
         if paired is not None:
+            paired = list(paired)
             assert len(paired[0]) == 2
-            input_args = [paired[0][0], paired[0][1]]
+            input_args = [self._concatenated(fn1 for fn1, _ in paired),
+                          self._concatenated(fn2 for _, fn2 in paired)]
             input_args.extend(aligner_paired_args)
         if paired_combined is not None:
             options.append('-p')
-            input_args = [paired_combined[0]]
+            input_args = [self._concatenated(paired_combined)]
             input_args.extend(aligner_paired_args)
         if unpaired is None and paired is None and paired_combined is None:
             raise RuntimeError("Must specify one or more of: unpaired, paired, paired_combined")
         # Compose output arguments
         output_args = []
-        if sam is not None:
-            output_args.extend(['>', sam])
-        else:
+        if sam is None:
             raise RuntimeError("Must specify SAM output")
+        elif output_filter is None:
+            output_args.extend(['>', sam])
         # Tell bwa mem whether to expected paired-end interleaved input
         if pairs_only:
             options.append('-p')
@@ -97,10 +94,12 @@ class BwaMem(Aligner):
         logging.info('bwa mem command: ' + cmd)
         if quiet:
             popen_stderr = open(os.devnull, 'w')
-        self.pipe = Popen(cmd, shell=True,
-                          stdin=popen_stdin, stdout=popen_stdout, stderr=popen_stderr,
-                          bufsize=-1, close_fds='posix' in sys.builtin_module_names)
+        self._open_pipes(cmd, popen_stdin, popen_stderr, sam, output_filter)
 
     @staticmethod
     def supports_mix():
         return False
+
+    @staticmethod
+    def thread_options():
+        return ['-t']
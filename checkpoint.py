@@ -0,0 +1,207 @@
+"""
+Copyright 2016, Ben Langmead <langmea@cs.jhu.edu>
+
+Manifest: records which pipeline stages have completed, along with the
+parameters, inputs and outputs of each, so an interrupted run can resume at
+the stage that failed without trusting missing or corrupt outputs.
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+
+__author__ = 'langmead'
+
+
+_manifest_format = 'qtip-manifest'
+_manifest_version = 1
+
+
+def _canonical(params):
+    """ Return params as they'll look after a round trip through JSON, so
+        they can be compared to what's in the manifest """
+    return json.loads(json.dumps(params, sort_keys=True))
+
+
+class Manifest(object):
+    """
+    A JSON file recording, for each completed stage, its parameters and the
+    size and SHA-1 of each output.  Inputs produced by an earlier stage are
+    recorded by checksum too; other inputs (e.g. reads and reference) are
+    recorded by size and modification time.  The file is rewritten
+    atomically each time a stage is committed or invalidated.
+    """
+
+    def __init__(self, fn, log=logging):
+        self.fn = fn
+        self.log = log
+        self.stages = {}
+        self._sums = {}
+        if os.path.exists(fn):
+            doc = {}
+            try:
+                with open(fn) as fh:
+                    doc = json.load(fh)
+            except ValueError:
+                log.warning('Ignoring unreadable checkpoint manifest "%s"' % fn)
+            if doc.get('format') == _manifest_format and doc.get('version') == _manifest_version:
+                self.stages = doc['stages']
+            elif len(doc) > 0:
+                log.warning('Ignoring checkpoint manifest "%s" with unexpected format/version' % fn)
+
+    def _checksum(self, fn, st):
+        """ SHA-1 of file, remembered as long as its size and mtime don't
+            change """
+        key = (fn, st.st_size, st.st_mtime)
+        if key not in self._sums:
+            h = hashlib.sha1()
+            with open(fn, 'rb') as fh:
+                while True:
+                    buf = fh.read(1 << 20)
+                    if len(buf) == 0:
+                        break
+                    h.update(buf)
+            self._sums[key] = h.hexdigest()
+        return self._sums[key]
+
+    def _is_tracked(self, fn):
+        """ Return true iff file is an output of a committed stage """
+        return any(fn in ent['outputs'] for ent in self.stages.values())
+
+    def _record(self, fn, checksum):
+        st = os.stat(fn)
+        rec = {'size': st.st_size}
+        if checksum:
+            rec['sha1'] = self._checksum(fn, st)
+        else:
+            rec['mtime'] = int(st.st_mtime)
+        return rec
+
+    def _matches(self, fn, rec):
+        if not os.path.exists(fn):
+            return False
+        st = os.stat(fn)
+        if st.st_size != rec['size']:
+            return False
+        if 'sha1' in rec:
+            return self._checksum(fn, st) == rec['sha1']
+        return int(st.st_mtime) == rec['mtime']
+
+    def is_done(self, stage, params):
+        """ Return true iff stage was committed with the same parameters and
+            all its recorded inputs and outputs are unchanged """
+        ent = self.stages.get(stage)
+        if ent is None:
+            return False
+        if ent['params'] != _canonical(params):
+            self.log.info('Stage "%s" must be redone because its parameters changed' % stage)
+            return False
+        for what in ['inputs', 'outputs']:
+            for fn, rec in sorted(ent[what].items()):
+                if not self._matches(fn, rec):
+                    self.log.info('Stage "%s" must be redone because %s "%s" is missing or changed' %
+                                  (stage, what[:-1], fn))
+                    return False
+        return True
+
+    def invalidate(self, stage):
+        """ Forget stage; call before (re)running it """
+        if stage in self.stages:
+            del self.stages[stage]
+            self._write()
+
+    def commit(self, stage, params, inputs, outputs):
+        """ Record that stage completed, reading the given input and output
+            files """
+        ent = {'params': _canonical(params),
+               'inputs': dict((fn, self._record(fn, self._is_tracked(fn))) for fn in inputs),
+               'outputs': dict((fn, self._record(fn, True)) for fn in outputs),
+               'completed': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        self.stages[stage] = ent
+        self._write()
+
+    def _write(self):
+        tmp = self.fn + '.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump({'format': _manifest_format,
+                       'version': _manifest_version,
+                       'stages': self.stages}, fh, sort_keys=True, indent=1)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.rename(tmp, self.fn)
+
+
+if __name__ == "__main__":
+
+    import sys
+    import shutil
+    import tempfile
+    import unittest
+    from os.path import join
+
+    class TestCases(unittest.TestCase):
+
+        def setUp(self):
+            self.dir = tempfile.mkdtemp()
+            self.fn = join(self.dir, 'manifest.json')
+            self.log = logging.getLogger('checkpoint_test')
+            self.log.setLevel(logging.ERROR)
+            self.inp, self.mid, self.out = join(self.dir, 'in'), join(self.dir, 'mid'), join(self.dir, 'out')
+            for fn in [self.inp, self.mid, self.out]:
+                with open(fn, 'w') as fh:
+                    fh.write(fn)
+
+        def tearDown(self):
+            shutil.rmtree(self.dir)
+
+        def _commit_both(self, man):
+            man.commit('one', {'a': 1}, [self.inp], [self.mid])
+            man.commit('two', {'b': (2, 3)}, [self.mid], [self.out])
+
+        def test_resume_1(self):
+            self._commit_both(Manifest(self.fn, log=self.log))
+            man = Manifest(self.fn, log=self.log)
+            self.assertTrue(man.is_done('one', {'a': 1}))
+            self.assertTrue(man.is_done('two', {'b': [2, 3]}))
+            self.assertFalse(man.is_done('two', {'b': [2, 4]}))
+            self.assertFalse(man.is_done('three', {}))
+            self.assertTrue('sha1' in man.stages['two']['inputs'][self.mid])
+            self.assertTrue('mtime' in man.stages['one']['inputs'][self.inp])
+
+        def test_corrupt_output_1(self):
+            self._commit_both(Manifest(self.fn, log=self.log))
+            # same size, different content
+            with open(self.out, 'w') as fh:
+                fh.write(self.out[:-1] + 'X')
+            man = Manifest(self.fn, log=self.log)
+            self.assertTrue(man.is_done('one', {'a': 1}))
+            self.assertFalse(man.is_done('two', {'b': [2, 3]}))
+
+        def test_changed_input_1(self):
+            self._commit_both(Manifest(self.fn, log=self.log))
+            with open(self.mid, 'a') as fh:
+                fh.write('more')
+            man = Manifest(self.fn, log=self.log)
+            self.assertFalse(man.is_done('one', {'a': 1}))
+            self.assertFalse(man.is_done('two', {'b': [2, 3]}))
+
+        def test_invalidate_1(self):
+            man = Manifest(self.fn, log=self.log)
+            self._commit_both(man)
+            man.invalidate('two')
+            man = Manifest(self.fn, log=self.log)
+            self.assertTrue(man.is_done('one', {'a': 1}))
+            self.assertFalse(man.is_done('two', {'b': [2, 3]}))
+
+        def test_unreadable_1(self):
+            with open(self.fn, 'w') as fh:
+                fh.write('{"format": "qtip-manifest", "vers')
+            man = Manifest(self.fn, log=self.log)
+            self.assertFalse(man.is_done('one', {'a': 1}))
+            man.commit('one', {'a': 1}, [self.inp], [self.mid])
+            self.assertTrue(Manifest(self.fn, log=self.log).is_done('one', {'a': 1}))
+
+    unittest.main(argv=[sys.argv[0]])
+    sys.exit()
@@ -31,16 +31,26 @@ class FeatureTableReader(object):
                 ('c',   '_rec_c'),
                 ('b',   '_rec_b')]
 
-    def __init__(self, prefix, chunksize=100000):
+    def __init__(self, prefix, chunksize=100000, only=None, tables=None):
+        """ only, if given, is a string with the short names of the datasets
+            to read; others are treated as empty.  tables, if given, maps
+            short names to tables kept in memory by NativeQtip.parse, which
+            are read instead of files. """
         self.prefix = prefix
         self.dfs = {}
         self.readers = {}
         nonempty = False
         fns = []
         for sn, suf in self.datasets:
+            if only is not None and sn not in only:
+                continue
             fn = self.prefix + suf
             fns.append(fn)
-            if os.path.exists(fn + '.npy') and os.stat(fn + '.npy').st_size > 0:
+            if tables is not None:
+                if sn in tables and tables[sn][1].shape[0] > 0:
+                    nonempty = True
+                    self.readers[sn] = MetaMat(fn, chunksize, table=tables[sn])
+            elif os.path.exists(fn + '.npy') and os.stat(fn + '.npy').st_size > 0:
                 nonempty = True
                 self.readers[sn] = MetaMat(fn, chunksize)
 
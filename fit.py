@@ -15,14 +15,19 @@ import gc
 import os
 import sys
 import multiprocessing
+import sklearn
 from sklearn import cross_validation
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 try:
     import itertools.izip as zip
 except ImportError:
     pass
 
 # qtip imports
-from predictions import MapqPredictions
+from predictions import MapqPredictions, MapqPredictionStream
 from mapq import pcor_to_mapq_np
 
 __author__ = 'langmead'
@@ -94,6 +99,13 @@ def _df_to_mat(data, shortname, training, training_labs, log=logging, include_ma
     return data_mat, data['id'], np.array(data['mapq'], dtype=int), correct, labs
 
 
+# identifies a saved MapqFit; bump the version when the saved state changes
+_model_file_format = 'qtip-model'
+_model_file_version = 1
+
+# numeric codes used to store alignment category alongside predictions
+_category_codes = {'u': 1.0, 'b': 2.0, 'c': 3.0, 'd': 4.0}
+
 _prediction_worker_queue = multiprocessing.Queue()
 _prediction_worker_trained_models = None
 _prediction_worker_pred_overall = None
@@ -126,7 +138,7 @@ def _prediction_worker(my_test_chunk_tup, training, training_labs, ds,
     gc.collect()
     pcor = np.array(postprocess_predictions(pcor, ds_long))
     # convert category data to doubles
-    ds = {'u': 1.0, 'b': 2.0, 'c': 3.0, 'd': 4.0}.get(ds)
+    ds = _category_codes.get(ds)
     pred_df = pandas.DataFrame({'mapq': pandas.Series(pcor_to_mapq_np(pcor), dtype=np.float32),
                                 'ids': pandas.Series(ids, dtype=np.float64),
                                 'category': ds,
@@ -156,6 +168,40 @@ def _prediction_worker(my_test_chunk_tup, training, training_labs, ds,
              (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024.0 * 1024.0)))
 
 
+# state inherited by forked model-fitting workers; see MapqFit._fit_parallel
+_fit_worker_fit = None
+_fit_worker_mats = None
+_fit_worker_kwargs = None
+_fit_worker_log = None
+
+
+def _fit_worker(ds, ds_long):
+    x_train, y_train = _fit_worker_mats[ds]
+    log = _fit_worker_log
+    model, params, score = _fit_worker_fit._fit_one(x_train, y_train, ds, ds_long, log=log,
+                                                    **_fit_worker_kwargs)
+    log.info('    PID %d done fitting %s; peak mem=%0.2fGB' % (os.getpid(), ds_long, _get_peak_gb()))
+    return model, params, score, _fit_worker_fit.model_fam_name
+
+
+def _fit_mem_estimate(x_train, y_train):
+    """ Rough peak bytes for fitting one category: the learner's float32
+        copy of the matrix plus bootstrap samples, sample weights and trees,
+        which all grow with the number of rows. """
+    return 2 * (x_train.nbytes + y_train.nbytes) + 64 * x_train.shape[0]
+
+
+def _mem_budget_bytes(mem_gb):
+    """ Bytes that concurrent fits may use: mem_gb if given, otherwise
+        physical memory, or no limit if that can't be found. """
+    if mem_gb is not None:
+        return mem_gb * 1e9
+    try:
+        return float(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES'))
+    except (ValueError, OSError, AttributeError):
+        return float('inf')
+
+
 def _prediction_worker_star(a_b):
     return _prediction_worker(*a_b)
 
@@ -240,54 +286,134 @@ class MapqFit:
 
     datasets = list(zip('dbcu', ['Discordant', 'Bad-end', 'Concordant', 'Unpaired'], [True, False, True, False]))
 
+    def _training_matrix(self, dfs, ds, ds_long, frac, log=logging):
+        """ Load training table for one category and turn it into a feature
+            matrix and labels, optionally subsampled.  Returns None if there
+            is no training data. """
+        if ds not in dfs:
+            return None  # empty
+        train = pandas.concat([x for x in dfs.dataset_iter(ds)])
+        if train.shape[0] == 0:
+            return None  # empty
+        train.correct = train.correct.astype(int)
+        train.mapq = train.mapq.astype(int)
+        if train['correct'].nunique() == 1:
+            logging.warning('Warning: All training data has correct=%d.  This might mean '
+                            'the qtip software is making a mistake.  It could also '
+                            'mean that, because of your data and reference genome, the aligner '
+                            'can correctly resolve point of origin for all reads.  Treat '
+                            'results circumspectly.' % train['correct'][0])
+        # extract features, convert to matrix
+        x_train, _, mapq_orig_train, y_train, self.col_names[ds] = \
+            _df_to_mat(train, ds, True, self.training_labs, log=logging, include_mapq=False)
+        assert x_train.shape[0] == y_train.shape[0]
+        assert x_train.shape[1] > 0
+        # optionally subsample
+        if frac < 1.0:
+            log.info('  Sampling %0.2f%% of %d rows of %s records' % (100.0 * frac, train.shape[0], ds_long))
+            x_train, mapq_orig_train, y_train = \
+                self._subsample(x_train, mapq_orig_train, y_train, frac)
+            log.info('  Now has %d rows' % x_train.shape[0])
+        return x_train, y_train
+
+    def _fit_one(self, x_train, y_train, ds, ds_long, log=logging,
+                 reweight_ratio=1.0, reweight_mapq=False, reweight_mapq_offset=10.0, no_oob=False):
+        """ Pick a model for one category's training matrix and fit it.
+            Returns the model, its parameters and its score. """
+        # use cross-validation to pick a model
+        log.info('Fitting %d %s training records; %d features each' % (x_train.shape[0], ds_long, x_train.shape[1]))
+        assert x_train.shape[0] == y_train.shape[0]
+        model, params, score = \
+            self._crossval_fit(self.model_gen, x_train, y_train, ds,
+                               use_oob=self.model_gen().calculates_oob() and not no_oob)
+        log.info('    Chose parameters: %s' % str(params))
+        self._fit_and_possibly_reweight_and_refit(model, x_train, y_train,
+                                                  reweight_ratio=reweight_ratio,
+                                                  reweight_mapq=reweight_mapq,
+                                                  reweight_mapq_offset=reweight_mapq_offset)
+        return model, params, score
+
     def _fit(self, dfs, log=logging, frac=1.0, heap_profiler=None, include_mapq=False,
-             reweight_ratio=1.0, reweight_mapq=False, reweight_mapq_offset=10.0, no_oob=False):
+             reweight_ratio=1.0, reweight_mapq=False, reweight_mapq_offset=10.0, no_oob=False,
+             fit_processes=1, fit_mem_gb=None):
         """ Train one model per training table. Optionally subsample training
-            data first. """
+            data first.  With fit_processes > 1, categories are fit
+            concurrently; see _fit_parallel. """
+        fit_kwargs = {'reweight_ratio': reweight_ratio, 'reweight_mapq': reweight_mapq,
+                      'reweight_mapq_offset': reweight_mapq_offset, 'no_oob': no_oob}
+        if fit_processes > 1:
+            self._fit_parallel(dfs, fit_kwargs, fit_processes, fit_mem_gb, log=log, frac=frac)
+            return
         for ds, ds_long, paired in self.datasets:
-            if ds not in dfs:
-                continue  # empty
-            train = pandas.concat([x for x in dfs.dataset_iter(ds)])
-            if train.shape[0] == 0:
+            mat = self._training_matrix(dfs, ds, ds_long, frac, log=log)
+            if mat is None:
                 continue  # empty
-            train.correct = train.correct.astype(int)
-            train.mapq = train.mapq.astype(int)
-            if train['correct'].nunique() == 1:
-                logging.warning('Warning: All training data has correct=%d.  This might mean '
-                                'the qtip software is making a mistake.  It could also '
-                                'mean that, because of your data and reference genome, the aligner '
-                                'can correctly resolve point of origin for all reads.  Treat '
-                                'results circumspectly.' % train['correct'][0])
-            # extract features, convert to matrix
-            x_train, _, mapq_orig_train, y_train, self.col_names[ds] = \
-                _df_to_mat(train, ds, True, self.training_labs, log=logging, include_mapq=False)
-            assert x_train.shape[0] == y_train.shape[0]
-            assert x_train.shape[1] > 0
-            # optionally subsample
-            if frac < 1.0:
-                log.info('  Sampling %0.2f%% of %d rows of %s records' % (100.0 * frac, train.shape[0], ds_long))
-                x_train, mapq_orig_train, y_train = \
-                    self._subsample(x_train, mapq_orig_train, y_train, frac)
-                log.info('  Now has %d rows' % x_train.shape[0])
-            # use cross-validation to pick a model
-            log.info('Fitting %d %s training records; %d features each' % (x_train.shape[0], ds_long, x_train.shape[1]))
-            assert x_train.shape[0] == y_train.shape[0]
+            x_train, y_train = mat
             self.trained_shape[ds] = x_train.shape
             self.trained_models[ds], self.trained_params[ds], self.model_score[ds] = \
-                self._crossval_fit(self.model_gen, x_train, y_train, ds,
-                                   use_oob=self.model_gen().calculates_oob() and not no_oob)
-            log.info('    Chose parameters: %s' % str(self.trained_params[ds]))
-            self._fit_and_possibly_reweight_and_refit(self.trained_models[ds], x_train, y_train,
-                                                      reweight_ratio=reweight_ratio,
-                                                      reweight_mapq=reweight_mapq,
-                                                      reweight_mapq_offset=reweight_mapq_offset)
+                self._fit_one(x_train, y_train, ds, ds_long, log=log, **fit_kwargs)
             del x_train
             del y_train
+            del mat
             gc.collect()
             log.info('    Done; peak mem usage so far = %0.2fGB' % _get_peak_gb())
             if heap_profiler is not None:
                 print(heap_profiler.heap(), file=sys.stderr)
 
+    def _fit_parallel(self, dfs, fit_kwargs, n_proc, mem_gb, log=logging, frac=1.0):
+        """ Train the categories' models in a pool of worker processes.
+            Training matrices are all loaded (and subsampled, in the usual
+            order) up front and inherited by the forked workers.  A category
+            is only started if its estimated memory, added to that of the
+            categories already running, fits in mem_gb (default: physical
+            memory); the largest is always allowed to run by itself.  Results
+            are gathered in dataset order, so they don't depend on which
+            worker finishes first. """
+        global _fit_worker_fit
+        global _fit_worker_mats
+        global _fit_worker_kwargs
+        global _fit_worker_log
+        mats, names, pending = {}, {}, []
+        for ds, ds_long, paired in self.datasets:
+            mat = self._training_matrix(dfs, ds, ds_long, frac, log=log)
+            if mat is None:
+                continue  # empty
+            mats[ds], names[ds] = mat, ds_long
+            self.trained_shape[ds] = mat[0].shape
+            pending.append(ds)
+        if len(pending) == 0:
+            return
+        budget = _mem_budget_bytes(mem_gb)
+        est = dict((ds, _fit_mem_estimate(*mats[ds])) for ds in pending)
+        log.info('Fitting %d categories with up to %d processes; estimated GB: %s' %
+                 (len(pending), n_proc, ', '.join('%s=%0.2f' % (ds, est[ds] / 1e9) for ds in pending)))
+        _fit_worker_fit, _fit_worker_mats, _fit_worker_kwargs, _fit_worker_log = self, mats, fit_kwargs, log
+        pool = multiprocessing.Pool(min(n_proc, len(pending)), _prediction_worker_init, (log,))
+        try:
+            running, results = {}, {}
+            while len(pending) > 0 or len(running) > 0:
+                while len(pending) > 0 and len(running) < n_proc:
+                    in_use = sum(est[ds] for ds in running)
+                    ds = pending[0]
+                    if len(running) > 0 and in_use + est[ds] > budget:
+                        break  # wait for something to finish first
+                    pending.pop(0)
+                    running[ds] = pool.apply_async(_fit_worker, (ds, names[ds]))
+                for ds in list(running.keys()):
+                    running[ds].wait(0.1)
+                    if running[ds].ready():
+                        results[ds] = running.pop(ds).get()
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+            _fit_worker_fit, _fit_worker_mats, _fit_worker_kwargs, _fit_worker_log = None, None, None, None
+        for ds, ds_long, paired in self.datasets:
+            if ds in results:
+                self.trained_models[ds], self.trained_params[ds], self.model_score[ds], \
+                    self.model_fam_name = results[ds]
+        log.info('    Done; peak mem usage so far = %0.2fGB' % _get_peak_gb())
+
     def predict(self, dfs, pred_prefix, assess_prefix,
                 log=logging, dedup=False, training=False, calc_summaries=False,
                 prediction_mem_limit=10000000, heap_profiler=None, include_mapq=False,
@@ -367,6 +493,95 @@ class MapqFit:
 
         return pred_overall
 
+    def predict_stream(self, dfs, ofh, log=logging, dedup=False, include_mapq=False):
+        """ Make predictions for all alignments in dfs, writing them to binary
+            stream ofh in alignment-id order rather than to prediction files.
+            Chunks are predicted across categories in step, always advancing
+            the category that lags furthest behind, so the consumer of ofh can
+            make progress while prediction is still under way. """
+
+        global _prediction_worker_trained_models
+        global _prediction_worker_pred_overall
+        global _prediction_worker_log
+
+        names, iters = {}, {}
+        for ds, ds_long, paired in self.datasets:
+            if ds in dfs:
+                names[_category_codes[ds]] = (ds, ds_long)
+                iters[_category_codes[ds]] = enumerate(dfs.dataset_iter(ds))
+        pred_stream = MapqPredictionStream(ofh, list(iters.keys()))
+
+        _prediction_worker_trained_models = self.trained_models
+        _prediction_worker_pred_overall = pred_stream
+        _prediction_worker_log = log
+
+        while True:
+            code = pred_stream.lagging_category()
+            if code is None:
+                break
+            try:
+                test_chunk = next(iters[code])
+            except StopIteration:
+                pred_stream.close_category(code)
+                continue
+            ds, ds_long = names[code]
+            _prediction_worker(test_chunk, False, self.training_labs,
+                               ds, ds_long, dedup,
+                               multiprocess=False, include_mapq=include_mapq)
+
+        pred_stream.finalize()
+        return pred_stream
+
+    # attributes that make up a trained MapqFit
+    _saved_attrs = ['trained_models', 'training_labs', 'col_names', 'trained_params',
+                    'model_score', 'trained_shape', 'model_fam_name', 'sample_fraction']
+
+    def save(self, fn, meta=None):
+        """
+        Save trained models and everything else needed to make predictions to
+        a versioned model file.  meta is a dictionary describing how the
+        model was made (aligner, reference, etc), checked by load.
+        """
+        header = {'format': _model_file_format,
+                  'version': _model_file_version,
+                  'sklearn_version': sklearn.__version__,
+                  'meta': meta or {}}
+        state = dict((attr, getattr(self, attr)) for attr in self._saved_attrs)
+        tmp_fn = fn + '.tmp'
+        with open(tmp_fn, 'wb') as fh:
+            pickle.dump(header, fh, 2)
+            pickle.dump(state, fh, 2)
+        os.rename(tmp_fn, fn)
+
+    @classmethod
+    def load(cls, fn, meta=None, log=logging):
+        """
+        Load a MapqFit saved with save.  If meta is given, warn about any
+        entries that differ from those saved with the model.
+        """
+        with open(fn, 'rb') as fh:
+            try:
+                header = pickle.load(fh)
+            except Exception:
+                header = None
+            if not isinstance(header, dict) or header.get('format') != _model_file_format:
+                raise RuntimeError('"%s" is not a qtip model file' % fn)
+            if header['version'] != _model_file_version:
+                raise RuntimeError('Model file "%s" has version %d; expected %d' %
+                                   (fn, header['version'], _model_file_version))
+            if header['sklearn_version'] != sklearn.__version__:
+                log.warning('Model file "%s" was saved with scikit-learn %s; this is %s' %
+                            (fn, header['sklearn_version'], sklearn.__version__))
+            for k, v in sorted((meta or {}).items()):
+                if header['meta'].get(k) != v:
+                    log.warning('Model file "%s" was made with %s=%s; this run has %s=%s' %
+                                (fn, k, str(header['meta'].get(k)), k, str(v)))
+            state = pickle.load(fh)
+        fit = cls(None, None, log=log)
+        for attr in cls._saved_attrs:
+            setattr(fit, attr, state[attr])
+        return fit
+
     def write_feature_importances(self, prefix):
         """
         Write feature importances for each model to an appropriately-named
@@ -414,7 +629,7 @@ class MapqFit:
             fh.write(','.join(data) + '\n')
 
     def __init__(self,
-                 dfs,  # dictionary of data frames, one per alignment type
+                 dfs,  # dictionary of data frames, one per alignment type; None to skip fitting
                  model_gen,  # function that takes vector of hyperparameters, returns new model object
                  log=logging,
                  sample_fraction=1.0,  # fraction of training data to actually use
@@ -423,7 +638,9 @@ class MapqFit:
                  reweight_ratio=1.0,
                  reweight_mapq=False,
                  reweight_mapq_offset=10.0,
-                 no_oob=False):
+                 no_oob=False,
+                 fit_processes=1,  # fit categories concurrently in this many processes
+                 fit_mem_gb=None):  # memory budget for concurrent fits; default is physical memory
         self.model_gen = model_gen
         self.trained_models = {}
         self.crossval_std = {}
@@ -435,6 +652,9 @@ class MapqFit:
         self.model_fam_name = None
         self.sample_fraction = sample_fraction
         self.q = None
+        if dfs is None:
+            return  # e.g. about to be filled in by load
         self._fit(dfs, log=log, frac=sample_fraction, heap_profiler=heap_profiler, include_mapq=include_mapq,
                   reweight_ratio=reweight_ratio, reweight_mapq=reweight_mapq,
-                  reweight_mapq_offset=reweight_mapq_offset, no_oob=no_oob)
+                  reweight_mapq_offset=reweight_mapq_offset, no_oob=no_oob,
+                  fit_processes=fit_processes, fit_mem_gb=fit_mem_gb)
@@ -10,16 +10,27 @@ class MetaMat(object):
     Iterator that returns a large matrix of floats in chunks of rows, where the
     number of rows in a chunk is a parameter passed to the constructor.
     Assumes all elements are double-precision 8-byte floating-point numbers.
+    The matrix is memory-mapped, so chunks are views of the page cache rather
+    than copies read into new buffers; pages are copied only if a chunk is
+    modified, and then privately.
     """
 
-    def __init__(self, prefix, chunk_size=1000000):
-        """ Parse metadata, check that files exist and initialize members """
+    def __init__(self, prefix, chunk_size=1000000, table=None):
+        """ Parse metadata, check that files exist and initialize members.
+            table, if given, is a list of column names and a 2D array
+            already in memory (see native.py), used instead of files. """
         self.prefix = prefix
         self.chunk_size = chunk_size
-        self.fh = None
+        self.mat = None
         self.cur = 0
         self.done = False
 
+        if table is not None:
+            self.cols, self.mat = table
+            self.nrow = self.mat.shape[0]
+            assert self.mat.shape[1] == len(self.cols)
+            return
+
         meta_fn = prefix + '.meta'
         if not os.path.exists(meta_fn):
             raise RuntimeError('Metadata file does not exist: "%s"' % meta_fn)
@@ -33,10 +44,15 @@ class MetaMat(object):
             self.nrow = int(fields[-1])
             self.cols = fields[:-1]
 
-        # Start at first chunk
-        self.fh = open(self.data_fn, 'rb')
-        self.cur = 0
-        self.done = False
+        shape = (self.nrow, len(self.cols))
+        nbytes = shape[0] * shape[1] * 8
+        if os.path.getsize(self.data_fn) != nbytes:
+            raise RuntimeError('Data file "%s" has %d bytes; expected %d' %
+                               (self.data_fn, os.path.getsize(self.data_fn), nbytes))
+        if nbytes == 0:
+            self.mat = numpy.empty(shape, dtype=numpy.float64)  # can't map empty file
+        else:
+            self.mat = numpy.memmap(self.data_fn, dtype=numpy.float64, mode='c', shape=shape)
 
     def __iter__(self):
         return self
@@ -47,7 +63,6 @@ class MetaMat(object):
     def __next__(self):
         """ Return next chunk """
         if self.done:
-            self.fh.close()
             raise StopIteration
         if self.chunk_size > 0:
             row_i, row_f = self.cur, min(self.cur + self.chunk_size, self.nrow)
@@ -56,19 +71,9 @@ class MetaMat(object):
             row_i, row_f = 0, self.nrow
         self.done = row_f == self.nrow
         self.cur = row_f
-        nelt = (row_f - row_i) * len(self.cols)
-        assert self.fh.tell() == row_i * 8 * len(self.cols)
-        m = numpy.fromfile(self.fh, dtype=numpy.float64, count=nelt, sep='')
-        expected_pos = row_f * 8 * len(self.cols)
-        assert self.fh.tell() == expected_pos
-        assert m.size == nelt, (row_i, row_f, len(self.cols), m.size, nelt)
-        m = m.reshape((row_f - row_i, len(self.cols)))
-        return pandas.DataFrame(data=m, columns=self.cols)
+        return pandas.DataFrame(data=self.mat[row_i:row_f], columns=self.cols)
 
     def reset(self):
-        if self.fh is not None:
-            self.fh.close()
-        self.fh = open(self.data_fn, 'rb')
         self.cur = 0
         self.done = False
 
@@ -172,6 +177,18 @@ if __name__ == "__main__":
             except StopIteration:
                 pass
 
+        def test_table_1(self):
+            mat = numpy.array(self.float_list[:1000]).reshape(500, 2)
+            m = MetaMat(None, 7, table=(['alpha', 'bravo'], mat))
+            df = next(m)
+            self.assertEqual(7, df.shape[0])
+            self.assertAlmostEqual(self.float_list[3], df.bravo[1], places=3)
+            n = 7
+            for df in m:
+                n += df.shape[0]
+            self.assertEqual(500, n)
+            self.assertAlmostEqual(self.float_list[999], df.bravo.iloc[-1], places=3)
+
         def tearDown(self):
             for prefix in self.prefixes:
                 os.remove(prefix + '.meta')
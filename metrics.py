@@ -0,0 +1,301 @@
+"""
+Copyright 2016, Ben Langmead <langmea@cs.jhu.edu>
+
+Metrics: per-stage performance measurements (wall and CPU time, peak memory,
+I/O volume, rows processed, temporary-file footprint) for the qtip driver
+and the child processes it runs, written as metrics.json.
+"""
+
+import os
+import sys
+import json
+import time
+import errno
+import resource
+import threading
+
+__author__ = 'langmead'
+
+
+_metrics_format = 'qtip-metrics'
+_metrics_version = 1
+
+
+def _rss_bytes(ru):
+    """ ru_maxrss is in kilobytes on Linux but bytes on Mac OS """
+    return ru.ru_maxrss if sys.platform == 'darwin' else ru.ru_maxrss * 1024
+
+
+def _proc_io():
+    """ Return (bytes read, bytes written) by this process so far, or
+        (None, None) if the OS doesn't say """
+    try:
+        with open('/proc/self/io') as fh:
+            io = dict(ln.split(':') for ln in fh if ':' in ln)
+        return int(io['rchar']), int(io['wchar'])
+    except (IOError, OSError, KeyError, ValueError):
+        return None, None
+
+
+def _rss_now():
+    """ Return this process's resident set size in bytes, or None if the
+        OS doesn't say """
+    try:
+        with open('/proc/self/status') as fh:
+            for ln in fh:
+                if ln.startswith('VmRSS:'):
+                    return int(ln.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def _delta(a, b):
+    return None if a is None or b is None else b - a
+
+
+class Metrics(object):
+    """
+    Measures stages, each delimited by start() and end() calls with the same
+    label.  Stages may nest; child processes reaped with wait() are charged
+    to the innermost open stage.
+
+    Peak memory and temporary-file footprint are peaks over the time each
+    stage was open.  If the process's high-water RSS rose during a stage, the
+    new high-water mark is the stage's peak; otherwise it's the largest RSS
+    seen by the sampler while the stage was open, or None if the OS can't
+    report RSS.
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.open = []
+        self.temp_man = None
+        self.lock = threading.Lock()
+        self.sampler = None
+        self.sampler_stop = None
+
+    def set_temp_man(self, temp_man):
+        """ Measure temporary-file footprint with temp_man from now on,
+            including for stages already open """
+        self.temp_man = temp_man
+        for st in self.open:
+            st['_temp_watch'] = temp_man.watch_peak()
+
+    def sample(self):
+        """ Measure RSS and update the peaks of the open stages """
+        rss = _rss_now()
+        if rss is None:
+            return
+        with self.lock:
+            for st in self.open:
+                st['_rss_peak'] = rss if st['_rss_peak'] is None else max(st['_rss_peak'], rss)
+
+    def start_sampler(self, interval=0.5):
+        """ Start thread that measures RSS every interval seconds, so stage
+            peaks reflect growth that's freed before the stage ends """
+        if self.sampler is not None:
+            return
+        self.sampler_stop = threading.Event()
+
+        def _sample():
+            while not self.sampler_stop.wait(interval):
+                self.sample()
+        self.sampler = threading.Thread(target=_sample)
+        self.sampler.daemon = True
+        self.sampler.start()
+
+    def stop_sampler(self):
+        if self.sampler is None:
+            return
+        self.sampler_stop.set()
+        self.sampler.join()
+        self.sampler = None
+
+    def start(self, lab, trial=None):
+        ru_self = resource.getrusage(resource.RUSAGE_SELF)
+        ru_child = resource.getrusage(resource.RUSAGE_CHILDREN)
+        st = {'label': lab,
+              'trial': trial,
+              'children': [],
+              'rows': None,
+              '_t0': time.time(),
+              '_self': ru_self,
+              '_child': ru_child,
+              '_io': _proc_io(),
+              '_rss_peak': _rss_now(),
+              '_temp_watch': None if self.temp_man is None else self.temp_man.watch_peak()}
+        with self.lock:
+            self.stages.append(st)
+            self.open.append(st)
+
+    def end(self, lab, rows=None):
+        """ Finish the innermost open stage with the given label """
+        self.sample()
+        st = None
+        with self.lock:
+            for i in range(len(self.open) - 1, -1, -1):
+                if self.open[i]['label'] == lab:
+                    st = self.open.pop(i)
+                    break
+        if st is None:
+            raise RuntimeError('No open stage with label "%s"' % lab)
+        ru_self = resource.getrusage(resource.RUSAGE_SELF)
+        ru_child = resource.getrusage(resource.RUSAGE_CHILDREN)
+        rd, wr = _proc_io()
+        st['wall_seconds'] = time.time() - st.pop('_t0')
+        ru0 = st.pop('_self')
+        st['cpu_user_seconds'] = ru_self.ru_utime - ru0.ru_utime
+        st['cpu_sys_seconds'] = ru_self.ru_stime - ru0.ru_stime
+        rss_peak = st.pop('_rss_peak')
+        if _rss_bytes(ru_self) > _rss_bytes(ru0):
+            rss_peak = _rss_bytes(ru_self)  # high-water mark set during stage
+        st['peak_rss_bytes'] = rss_peak
+        ru0 = st.pop('_child')
+        st['child_cpu_user_seconds'] = ru_child.ru_utime - ru0.ru_utime
+        st['child_cpu_sys_seconds'] = ru_child.ru_stime - ru0.ru_stime
+        st['child_peak_rss_bytes'] = max([c['peak_rss_bytes'] for c in st['children']] or [0])
+        rd0, wr0 = st.pop('_io')
+        st['read_bytes'] = _delta(rd0, rd)
+        st['write_bytes'] = _delta(wr0, wr)
+        st['child_read_bytes'] = sum(c['read_bytes'] for c in st['children'])
+        st['child_write_bytes'] = sum(c['write_bytes'] for c in st['children'])
+        if rows is not None:
+            st['rows'] = rows
+        temp_watch = st.pop('_temp_watch')
+        st['temp_peak_bytes'] = None if temp_watch is None else self.temp_man.unwatch_peak(temp_watch)
+
+    def wait(self, proc, name):
+        """ Wait for a subprocess.Popen to finish, charging its resource
+            usage to the innermost open stage, and return its exitlevel """
+        if proc.returncode is not None:
+            return proc.returncode
+        t0 = time.time()
+        while True:
+            try:
+                _, status, ru = os.wait4(proc.pid, 0)
+                break
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    raise
+        proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        if len(self.open) > 0:
+            self.open[-1]['children'].append({
+                'name': name,
+                'pid': proc.pid,
+                'exitlevel': proc.returncode,
+                'wall_seconds': time.time() - t0,
+                'cpu_user_seconds': ru.ru_utime,
+                'cpu_sys_seconds': ru.ru_stime,
+                'peak_rss_bytes': _rss_bytes(ru),
+                'read_bytes': ru.ru_inblock * 512,
+                'write_bytes': ru.ru_oublock * 512})
+        return proc.returncode
+
+    def seconds(self, lab):
+        """ Total wall-clock seconds over finished stages with label """
+        return sum(st['wall_seconds'] for st in self.stages if st['label'] == lab and 'wall_seconds' in st)
+
+    def __contains__(self, lab):
+        return any(st['label'] == lab and 'wall_seconds' in st for st in self.stages)
+
+    def __str__(self):
+        """ Wall-clock time for each finished stage, tab-separated """
+        ret = []
+        for st in self.stages:
+            if 'wall_seconds' in st:
+                ret.append('\t'.join([st['label'], str(st['wall_seconds'])]))
+        return '\n'.join(ret) + '\n'
+
+    def write_json(self, fn):
+        ru_self = resource.getrusage(resource.RUSAGE_SELF)
+        ru_child = resource.getrusage(resource.RUSAGE_CHILDREN)
+        doc = {'format': _metrics_format,
+               'version': _metrics_version,
+               'peak_rss_bytes': _rss_bytes(ru_self),
+               'child_peak_rss_bytes': _rss_bytes(ru_child),
+               'stages': [st for st in self.stages if 'wall_seconds' in st]}
+        with open(fn, 'w') as fh:
+            json.dump(doc, fh, sort_keys=True, indent=1)
+
+
+if __name__ == "__main__":
+
+    import shutil
+    import tempfile
+    import unittest
+    from subprocess import Popen
+
+    class TestCases(unittest.TestCase):
+
+        def setUp(self):
+            self.dir = tempfile.mkdtemp()
+
+        def tearDown(self):
+            shutil.rmtree(self.dir)
+
+        def test_nested_1(self):
+            m = Metrics()
+            m.start('Overall')
+            m.start('inner', trial=1)
+            proc = Popen('exit 3', shell=True)
+            self.assertEqual(3, m.wait(proc, 'sh'))
+            self.assertEqual(3, proc.wait())
+            m.end('inner', rows=10)
+            m.end('Overall')
+            self.assertTrue('inner' in m)
+            self.assertFalse('other' in m)
+            inner, overall = m.stages[1], m.stages[0]
+            self.assertEqual(1, len(inner['children']))
+            self.assertEqual(0, len(overall['children']))
+            self.assertEqual(3, inner['children'][0]['exitlevel'])
+            self.assertEqual(10, inner['rows'])
+            self.assertEqual(1, inner['trial'])
+            self.assertTrue(m.seconds('Overall') >= m.seconds('inner'))
+            self.assertEqual(['Overall', 'inner'], [ln.split('\t')[0] for ln in str(m).split('\n') if ln])
+
+        def test_json_1(self):
+            m = Metrics()
+            m.start('a')
+            m.start('b')
+            m.end('a')  # stages needn't end in order
+            fn = os.path.join(self.dir, 'metrics.json')
+            m.write_json(fn)
+            with open(fn) as fh:
+                doc = json.load(fh)
+            self.assertEqual(_metrics_format, doc['format'])
+            self.assertEqual(['a'], [st['label'] for st in doc['stages']])
+            self.assertTrue(doc['stages'][0]['peak_rss_bytes'] > 0)
+
+        def test_peaks_1(self):
+            """ Peaks cover only the time a stage was open """
+            from tempman import TemporaryFileManager
+            tm = TemporaryFileManager(self.dir)
+            m = Metrics()
+            m.start('overall')
+            m.set_temp_man(tm)
+            m.start('big')
+            buf = bytearray(200 * 1024 * 1024)
+            with open(tm.get_file('a', group='a'), 'wb') as fh:
+                fh.write(b'x' * 1000)
+            del buf
+            tm.remove_group('a')
+            m.end('big')
+            m.start('small')
+            m.end('small')
+            m.end('overall')
+            overall, big, small = m.stages
+            self.assertEqual(1000, overall['temp_peak_bytes'])
+            self.assertEqual(1000, big['temp_peak_bytes'])
+            self.assertEqual(0, small['temp_peak_bytes'])
+            self.assertTrue(big['peak_rss_bytes'] >= 200 * 1024 * 1024)
+            if small['peak_rss_bytes'] is not None:
+                self.assertTrue(small['peak_rss_bytes'] < 200 * 1024 * 1024)
+            tm.purge()
+
+        def test_no_stage_1(self):
+            m = Metrics()
+            self.assertRaises(RuntimeError, m.end, 'a')
+
+    unittest.main(argv=[sys.argv[0]])
+    sys.exit()
@@ -0,0 +1,144 @@
+"""
+Copyright 2016, Ben Langmead <langmea@cs.jhu.edu>
+
+NativeQtip: runs the qtip-parse and qtip-rewrite engines in the driver's own
+process through libqtip.so, built by src/Makefile alongside the binaries.
+This spares starting a process per stage, and lets feature tables come back
+as NumPy arrays and predictions go in as NumPy arrays rather than through
+files.  Arguments are the same as the binaries take, minus the program name.
+"""
+
+import os
+import ctypes
+import numpy
+
+__author__ = 'langmead'
+
+
+# order of libqtip's tables: records for each category, then their metadata
+_categories = ['u', 'b', 'c', 'd']
+
+
+def _argv(args):
+    """ Return argc and a C argv for the given arguments """
+    args = [b'qtip'] + [ar if isinstance(ar, bytes) else ar.encode() for ar in args]
+    argv = (ctypes.c_char_p * len(args))(*args)
+    return len(args), argv
+
+
+class NativeQtip(object):
+    """ Wrapper for libqtip.so.  Calls release the GIL but must not overlap,
+        since the engines keep their options in globals. """
+
+    def __init__(self, lib_fn):
+        lib = ctypes.CDLL(lib_fn)
+        argv_t = ctypes.POINTER(ctypes.c_char_p)
+        lib.qtip_parse.argtypes = [ctypes.c_int, argv_t, ctypes.c_int]
+        lib.qtip_parse.restype = ctypes.c_int
+        lib.qtip_parse_table.argtypes = [ctypes.c_int, ctypes.POINTER(ctypes.c_void_p),
+                                         ctypes.POINTER(ctypes.c_size_t)]
+        lib.qtip_parse_table.restype = ctypes.c_int
+        lib.qtip_parse_free_tables.argtypes = []
+        lib.qtip_parse_free_tables.restype = None
+        lib.qtip_rewrite.argtypes = [ctypes.c_int, argv_t, ctypes.POINTER(ctypes.c_void_p),
+                                     ctypes.POINTER(ctypes.c_size_t), ctypes.c_int]
+        lib.qtip_rewrite.restype = ctypes.c_int
+        self.lib = lib
+
+    def _table(self, i):
+        """ Return address and length of table i kept by the last parse """
+        buf, ln = ctypes.c_void_p(), ctypes.c_size_t()
+        if self.lib.qtip_parse_table(i, ctypes.byref(buf), ctypes.byref(ln)) != 0:
+            raise RuntimeError('No table %d in libqtip' % i)
+        return buf.value, ln.value
+
+    def parse(self, args, keep_tables=False):
+        """ Run qtip-parse.  If keep_tables is true, feature tables aren't
+            written under the record prefix, but returned in a dictionary
+            mapping category ('u', 'b', 'c' or 'd') to column names and a
+            2D array with a row per alignment, for each table written. """
+        argc, argv = _argv(args)
+        if self.lib.qtip_parse(argc, argv, 1 if keep_tables else 0) != 0:
+            raise RuntimeError('qtip-parse returned non-zero')
+        if not keep_tables:
+            return None
+        tables = {}
+        try:
+            for i, cat in enumerate(_categories):
+                meta_buf, meta_len = self._table(i + len(_categories))
+                if meta_buf is None:
+                    continue
+                fields = ctypes.string_at(meta_buf, meta_len).decode().rstrip().split(',')
+                cols, nrow = fields[:-1], int(fields[-1])
+                buf, nbytes = self._table(i)
+                if nbytes != nrow * len(cols) * 8:
+                    raise RuntimeError('Table for category "%s" has %d bytes; expected %d' %
+                                       (cat, nbytes, nrow * len(cols) * 8))
+                mat = numpy.empty((nrow, len(cols)), dtype=numpy.float64)
+                if nbytes > 0:
+                    ctypes.memmove(mat.ctypes.data, buf, nbytes)
+                tables[cat] = (cols, mat)
+        finally:
+            self.lib.qtip_parse_free_tables()
+        return tables
+
+    def rewrite(self, args, preds=()):
+        """ Run qtip-rewrite, also taking predictions from the arrays in
+            preds, each with (line, mapq) rows in ascending line order. """
+        arrs = [numpy.ascontiguousarray(pred, dtype=numpy.float64).reshape(-1, 2) for pred in preds]
+        n = len(arrs)
+        bufs = (ctypes.c_void_p * max(n, 1))(*[arr.ctypes.data for arr in arrs])
+        lens = (ctypes.c_size_t * max(n, 1))(*[arr.shape[0] for arr in arrs])
+        argc, argv = _argv(args)
+        if self.lib.qtip_rewrite(argc, argv, bufs, lens, n) != 0:
+            raise RuntimeError('qtip-rewrite returned non-zero')
+
+
+def load_native(bin_dir):
+    """ Return a NativeQtip for the libqtip.so in bin_dir, or None if it
+        hasn't been built """
+    lib_fn = os.path.join(bin_dir, 'libqtip.so')
+    if not os.path.exists(lib_fn):
+        return None
+    return NativeQtip(lib_fn)
+
+
+if __name__ == "__main__":
+
+    import sys
+    import unittest
+
+    class TestCases(unittest.TestCase):
+
+        def setUp(self):
+            self.native = load_native(os.path.dirname(os.path.realpath(__file__)))
+            if self.native is None:
+                self.skipTest('libqtip.so not built')
+            self.sam_fn, self.out_fn = '.native.test.sam', '.native.test.out.sam'
+            with open(self.sam_fn, 'w') as fh:
+                fh.write('@HD\tVN:1.0\n')
+                for i in range(6):
+                    fh.write('r%d\t0\tchr1\t%d\t7\t4M\t*\t0\t0\tACGT\tIIII\tXS:i:5\n' % (i, 100 + i))
+
+        def tearDown(self):
+            for fn in [self.sam_fn, self.out_fn]:
+                if os.path.exists(fn):
+                    os.remove(fn)
+
+        def test_rewrite_1(self):
+            """ Predictions from two arrays are merged, one of them empty,
+                and alignments without predictions keep their MAPQ.  Ids
+                are 1-based line numbers, counting the header. """
+            preds = [numpy.array([[2, 10.4], [5, 20.6]]), numpy.zeros((0, 2)), numpy.array([[3, 30.0]])]
+            self.native.rewrite(['--', self.sam_fn, '--', '--', self.out_fn], preds)
+            with open(self.out_fn) as fh:
+                mapqs = [ln.split('\t')[4] for ln in fh if not ln.startswith('@')]
+            self.assertEqual(['10', '30', '7', '21', '7', '7'], mapqs)
+
+        def test_rewrite_2(self):
+            """ Errors become exceptions """
+            self.assertRaises(RuntimeError, self.native.rewrite,
+                              ['--', '.native.test.missing.sam', '--', '--', self.out_fn])
+
+    unittest.main(argv=[sys.argv[0]])
+    sys.exit()
@@ -5,6 +5,7 @@ MapqPredictions class for storing and analyzing predictions.
 """
 
 import pandas
+import numpy as np
 import logging
 from collections import Counter
 try:
@@ -246,3 +247,76 @@ class MapqPredictions:
             self.mse_diff_pct = 100.0 * (mse_raw - mse_orig) / mse_orig
             self.mse_diff_round_pct = 100.0 * (mse_raw_round - mse_orig) / mse_orig
             log.info('    Done: %+0.4f%%, %+0.4f%% rounded' % (self.mse_diff_pct, self.mse_diff_round_pct))
+
+
+class MapqPredictionStream:
+    """ Sink for mapq predictions that, rather than writing them to files for
+        qtip-rewrite to merge later, merges them into alignment-id order as
+        they arrive and writes them to a binary stream (usually the stdin of a
+        running qtip-rewrite).  Predictions for a category are held back only
+        until every other open category has been predicted past them. """
+
+    def __init__(self, ofh, categories):
+        self.ofh = ofh
+        self.pending = dict((cat, []) for cat in categories)
+        self.frontier = dict((cat, -1.0) for cat in categories)
+        self.open = set(categories)
+        self.npredictions = 0
+        self.nwritten = 0
+        self.has_correct = False
+
+    def add(self, recs, first_id, last_id, mapq=None, mapq_orig=None, correct=None):
+        """ Add a new batch of predictions, all from the same category and in
+            ascending id order. """
+        if recs.shape[0] == 0:
+            return
+        cat = recs['category'].iloc[0]
+        assert cat in self.open
+        assert first_id > self.frontier[cat]
+        self.pending[cat].append(recs[['ids', 'mapq']].values)
+        self.frontier[cat] = last_id
+        self.npredictions += recs.shape[0]
+        self._flush()
+
+    def lagging_category(self):
+        """ Return the open category whose predictions are furthest behind, or
+            None if all categories are closed. """
+        if len(self.open) == 0:
+            return None
+        return min(self.open, key=lambda c: (self.frontier[c], c))
+
+    def close_category(self, cat):
+        """ Note that there are no more predictions coming for category """
+        self.open.discard(cat)
+        self._flush()
+
+    def _flush(self):
+        """ Write all predictions with ids that no open category can precede """
+        bound = min([self.frontier[c] for c in self.open]) if len(self.open) > 0 else float('inf')
+        ready = []
+        for cat, chunks in self.pending.items():
+            if len(chunks) == 0:
+                continue
+            m = chunks[0] if len(chunks) == 1 else np.concatenate(chunks)
+            n_ready = np.searchsorted(m[:, 0], bound, side='right')
+            if n_ready > 0:
+                ready.append(m[:n_ready])
+            self.pending[cat] = [m[n_ready:]] if n_ready < m.shape[0] else []
+        if len(ready) == 0:
+            return
+        m = np.concatenate(ready)
+        m = m[np.argsort(m[:, 0], kind='mergesort')]
+        self.ofh.write(np.ascontiguousarray(m, dtype=np.float64).tobytes())
+        self.nwritten += m.shape[0]
+
+    def can_assess(self):
+        """ Predictions aren't retained, so no assessment is possible """
+        return False
+
+    def finalize(self, log=logging):
+        """ Write any remaining predictions and flush the stream """
+        for cat in list(self.open):
+            self.close_category(cat)
+        assert self.nwritten == self.npredictions
+        self.ofh.flush()
+        log.info('  %d records streamed' % self.npredictions)
@@ -0,0 +1,306 @@
+"""
+Copyright 2016, Ben Langmead <langmea@cs.jhu.edu>
+
+Helpers for --shards: splitting input reads into contiguous shards that are
+aligned in parallel, recording where each shard's alignments lie and what
+line numbers they'd have as one input SAM (either in the shards' own SAMs or
+after concatenating them), and concatenating the feature tables that
+qtip-parse writes for each shard.
+"""
+
+import os
+import gzip
+import json
+import shutil
+
+__author__ = 'langmead'
+
+
+def open_reads(fn):
+    """ Return (raw file, line iterator); raw file's position tracks progress
+        through the file whether or not it's compressed """
+    raw = open(fn, 'rb')
+    if raw.read(2) == b'\x1f\x8b':
+        raw.seek(0)
+        return raw, gzip.GzipFile(fileobj=raw, mode='rb')
+    raw.seek(0)
+    return raw, raw
+
+
+def fastq_records(fh, fn):
+    """ Yield FASTQ records, each a 4-line bytes object """
+    while True:
+        lines = [fh.readline() for _ in range(4)]
+        if len(lines[0]) == 0:
+            return
+        if lines[0][0:1] != b'@' or len(lines[3]) == 0:
+            raise RuntimeError('"%s" is not FASTQ or is truncated' % fn)
+        yield b''.join(lines)
+
+
+def split_reads(fns, nshards, prefix):
+    """
+    Split reads into at most nshards contiguous shards of about equal size.
+    fns is a list of files (unpaired) or of (mate 1, mate 2) tuples (paired);
+    files are taken in order and mates are read in lockstep.  Returns a list
+    with a file or a (mate 1, mate 2) tuple per non-empty shard.
+    """
+    paired = len(fns) > 0 and isinstance(fns[0], tuple)
+    groups = fns if paired else [(fn,) for fn in fns]
+    tot = sum(os.path.getsize(g[0]) for g in groups)
+    shards, ofhs = [], None
+    done, cur = 0, -1
+    for grp in groups:
+        opened = [open_reads(fn) for fn in grp]
+        raw = opened[0][0]
+        its = [fastq_records(fh, fn) for (_, fh), fn in zip(opened, grp)]
+        while True:
+            recs = [next(it, None) for it in its]
+            if recs[0] is None or recs[-1] is None:
+                if recs[0] is not None or recs[-1] is not None:
+                    raise RuntimeError('Mate files "%s" and "%s" have different numbers of reads' % grp)
+                break
+            # shard i covers the i-th nshards-th of the input bytes
+            want = min(nshards - 1, (done + raw.tell()) * nshards // max(tot, 1))
+            if want > cur or ofhs is None:
+                cur = max(want, cur + 1) if ofhs is not None else want
+                if ofhs is not None:
+                    for ofh in ofhs:
+                        ofh.close()
+                if paired:
+                    ofns = ['%s_%d_%d.fastq' % (prefix, len(shards), m + 1) for m in range(len(grp))]
+                else:
+                    ofns = ['%s_%d.fastq' % (prefix, len(shards))]
+                ofhs = [open(fn, 'wb') for fn in ofns]
+                shards.append(tuple(ofns) if paired else ofns[0])
+            for ofh, rec in zip(ofhs, recs):
+                ofh.write(rec)
+        for fraw, fh in opened:
+            fh.close()
+            fraw.close()
+        done += os.path.getsize(grp[0])
+    if ofhs is not None:
+        for ofh in ofhs:
+            ofh.close()
+    return shards
+
+
+def _count_lines(fh, bufsz=1024 * 1024):
+    """ Count lines from fh's position to its end, including a last line
+        with no newline """
+    n, last = 0, b'\n'
+    for buf in iter(lambda: fh.read(bufsz), b''):
+        n += buf.count(b'\n')
+        last = buf[-1:]
+    return n + (1 if last != b'\n' else 0)
+
+
+def index_sams(sams, shards_fn):
+    """
+    Write shards_fn, a JSON file giving, for each shard's SAM file, the byte
+    range of its alignments and the number of lines preceding them when the
+    shards are read as one SAM with only the first shard's header, as
+    qtip-parse and qtip-rewrite do.  Unlike concat_sams, alignments aren't
+    copied; only newlines are counted.  SAMs are named relative to the
+    directory of shards_fn.
+    """
+    shards = []
+    nline = 0
+    for i, fn in enumerate(sams):
+        with open(fn, 'rb') as fh:
+            start = 0
+            ln = fh.readline()
+            while ln[0:1] == b'@':
+                start += len(ln)
+                if i == 0:
+                    nline += 1
+                ln = fh.readline()
+            fh.seek(start)
+            nalns = _count_lines(fh)
+        shards.append({'sam': os.path.relpath(fn, os.path.dirname(os.path.abspath(shards_fn))),
+                       'start': start, 'end': os.path.getsize(fn), 'line_offset': nline})
+        nline += nalns
+    with open(shards_fn, 'w') as fh:
+        json.dump({'shards': shards}, fh, sort_keys=True, indent=1)
+    return shards
+
+
+def concat_sams(sams, dst_fn, shards_fn):
+    """
+    Concatenate shards' SAM files into dst_fn, keeping only the first
+    shard's header.  Writes shards_fn, a JSON file giving the byte range and
+    number of preceding lines for each shard's alignments in dst_fn.
+    """
+    shards = []
+    off, nline = 0, 0
+    with open(dst_fn, 'wb') as ofh:
+        for i, fn in enumerate(sams):
+            with open(fn, 'rb') as fh:
+                ln = fh.readline()
+                while ln[0:1] == b'@':
+                    if i == 0:
+                        ofh.write(ln)
+                        off += len(ln)
+                        nline += 1
+                    ln = fh.readline()
+                start, start_line = off, nline
+                while len(ln) > 0:
+                    ofh.write(ln)
+                    off += len(ln)
+                    nline += 1
+                    ln = fh.readline()
+            shards.append({'start': start, 'end': off, 'line_offset': start_line})
+    with open(shards_fn, 'w') as fh:
+        json.dump({'shards': shards}, fh, sort_keys=True, indent=1)
+    return shards
+
+
+def read_shards(shards_fn, sam=None):
+    """ Return the shards listed in shards_fn.  Shards written by index_sams
+        name their own SAM; for the others, 'sam' is set to the given SAM
+        they were concatenated into, if any. """
+    with open(shards_fn) as fh:
+        shards = json.load(fh)['shards']
+    for sh in shards:
+        if 'sam' in sh:
+            sh['sam'] = os.path.join(os.path.dirname(os.path.abspath(shards_fn)), sh['sam'])
+        elif sam is not None:
+            sh['sam'] = sam
+    return shards
+
+
+def concat_tables(srcs, dst):
+    """
+    Concatenate feature tables (.npy/.meta pairs written by qtip-parse)
+    with the given prefixes into one with prefix dst.  Returns number of rows.
+    """
+    cols, nrow = None, 0
+    for src in srcs:
+        with open(src + '.meta') as fh:
+            fields = fh.readline().rstrip().split(',')
+        if len(fields) < 2:
+            continue  # empty table
+        if cols is not None and fields[:-1] != cols:
+            raise RuntimeError('Feature table "%s" has different columns from earlier shards' % src)
+        cols = fields[:-1]
+        nrow += int(fields[-1])
+    with open(dst + '.npy', 'wb') as ofh:
+        for src in srcs:
+            with open(src + '.npy', 'rb') as fh:
+                shutil.copyfileobj(fh, ofh)
+    with open(dst + '.meta', 'w') as fh:
+        if cols is not None:
+            fh.write(','.join(cols + [str(nrow)]) + '\n')
+    return nrow
+
+
+if __name__ == "__main__":
+
+    import sys
+    import tempfile
+    import unittest
+    from os.path import join
+
+    def _fastq(i, mate=''):
+        return ('@r%d%s\nACGT\n+\nIIII\n' % (i, mate)).encode()
+
+    class TestCases(unittest.TestCase):
+
+        def setUp(self):
+            self.dir = tempfile.mkdtemp()
+
+        def tearDown(self):
+            shutil.rmtree(self.dir)
+
+        def _read(self, fn):
+            with open(fn, 'rb') as fh:
+                return fh.read()
+
+        def test_split_unpaired_1(self):
+            fns = [join(self.dir, 'a.fq'), join(self.dir, 'b.fq.gz')]
+            with open(fns[0], 'wb') as fh:
+                fh.write(b''.join(_fastq(i) for i in range(100)))
+            with gzip.open(fns[1], 'wb') as fh:
+                fh.write(b''.join(_fastq(i) for i in range(100, 150)))
+            shards = split_reads(fns, 3, join(self.dir, 'shard'))
+            self.assertEqual(3, len(shards))
+            recs = b''.join(self._read(fn) for fn in shards)
+            self.assertEqual(b''.join(_fastq(i) for i in range(150)), recs)
+            for fn in shards:
+                self.assertTrue(os.path.getsize(fn) > 0)
+
+        def test_split_paired_1(self):
+            m1, m2 = join(self.dir, 'a_1.fq'), join(self.dir, 'a_2.fq')
+            with open(m1, 'wb') as fh:
+                fh.write(b''.join(_fastq(i, '/1') for i in range(10)))
+            with open(m2, 'wb') as fh:
+                fh.write(b''.join(_fastq(i, '/2') for i in range(10)))
+            shards = split_reads([(m1, m2)], 4, join(self.dir, 'shard'))
+            self.assertEqual(4, len(shards))
+            self.assertEqual(self._read(m1), b''.join(self._read(fn1) for fn1, _ in shards))
+            self.assertEqual(self._read(m2), b''.join(self._read(fn2) for _, fn2 in shards))
+            for fn1, fn2 in shards:
+                self.assertEqual(self._read(fn1).count(b'\n'), self._read(fn2).count(b'\n'))
+
+        def test_split_few_reads_1(self):
+            fn = join(self.dir, 'a.fq')
+            with open(fn, 'wb') as fh:
+                fh.write(_fastq(0) + _fastq(1))
+            self.assertEqual(2, len(split_reads([fn], 8, join(self.dir, 'shard'))))
+
+        def test_split_mismatched_mates_1(self):
+            m1, m2 = join(self.dir, 'a_1.fq'), join(self.dir, 'a_2.fq')
+            with open(m1, 'wb') as fh:
+                fh.write(_fastq(0) + _fastq(1))
+            with open(m2, 'wb') as fh:
+                fh.write(_fastq(0))
+            self.assertRaises(RuntimeError, split_reads, [(m1, m2)], 2, join(self.dir, 'shard'))
+
+        def test_concat_sams_1(self):
+            sams = [join(self.dir, 's%d.sam' % i) for i in range(2)]
+            with open(sams[0], 'wb') as fh:
+                fh.write(b'@HD\tVN:1.0\n@PG\tID:0\nr0\t4\n')
+            with open(sams[1], 'wb') as fh:
+                fh.write(b'@HD\tVN:1.0\n@PG\tID:1\nr1\t4\nr2\t4\n')
+            dst, shards_fn = join(self.dir, 'input.sam'), join(self.dir, 'input.sam.shards')
+            concat_sams(sams, dst, shards_fn)
+            self.assertEqual(b'@HD\tVN:1.0\n@PG\tID:0\nr0\t4\nr1\t4\nr2\t4\n', self._read(dst))
+            self.assertEqual([{'start': 20, 'end': 25, 'line_offset': 2},
+                              {'start': 25, 'end': 35, 'line_offset': 3}], read_shards(shards_fn))
+
+        def test_index_sams_1(self):
+            """ Ranges and line offsets match those of the concatenation """
+            sams = [join(self.dir, 's%d.sam' % i) for i in range(3)]
+            with open(sams[0], 'wb') as fh:
+                fh.write(b'@HD\tVN:1.0\n@PG\tID:0\nr0\t4\n')
+            with open(sams[1], 'wb') as fh:
+                fh.write(b'@HD\tVN:1.0\n')
+            with open(sams[2], 'wb') as fh:
+                fh.write(b'@HD\tVN:1.0\n@PG\tID:2\nr1\t4\nr2\t4')
+            shards_fn = join(self.dir, 'input.sam.shards')
+            index_sams(sams, shards_fn)
+            shards = read_shards(shards_fn)
+            self.assertEqual(sams, [sh['sam'] for sh in shards])
+            self.assertEqual([(20, 25, 2), (11, 11, 3), (20, 29, 3)],
+                             [(sh['start'], sh['end'], sh['line_offset']) for sh in shards])
+            concat_sams(sams, join(self.dir, 'input.sam'), shards_fn)
+            self.assertEqual([join(self.dir, 'input.sam')] * 3,
+                             [sh['sam'] for sh in read_shards(shards_fn, join(self.dir, 'input.sam'))])
+
+        def test_concat_tables_1(self):
+            srcs = [join(self.dir, 't%d' % i) for i in range(3)]
+            for src, meta, npy in zip(srcs, ['id,len,2\n', '', 'id,len,1\n'], [b'a' * 32, b'', b'b' * 16]):
+                with open(src + '.meta', 'w') as fh:
+                    fh.write(meta)
+                with open(src + '.npy', 'wb') as fh:
+                    fh.write(npy)
+            dst = join(self.dir, 'all')
+            self.assertEqual(3, concat_tables(srcs, dst))
+            self.assertEqual(b'id,len,3\n', self._read(dst + '.meta'))
+            self.assertEqual(b'a' * 32 + b'b' * 16, self._read(dst + '.npy'))
+            with open(srcs[1] + '.meta', 'w') as fh:
+                fh.write('id,olen,1\n')
+            self.assertRaises(RuntimeError, concat_tables, srcs, dst)
+
+    unittest.main(argv=[sys.argv[0]])
+    sys.exit()
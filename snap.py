@@ -41,9 +41,8 @@ A couple of "paired" mode parameters to know about:
 
 import os
 import logging
-import sys
 import operator
-from subprocess import Popen, PIPE
+from functools import reduce
 from aligner import Aligner
 
 try:
@@ -82,7 +81,9 @@ class SnapAligner(Aligner):
                  pairs_only=False,
                  sam=None,
                  quiet=False,
-                 input_format=None):
+                 input_format=None,
+                 output_filter=None,
+                 more_runs=None):
         """ Create new process.
             
             Inputs:
@@ -97,23 +98,51 @@ class SnapAligner(Aligner):
             
             'sam' is a filename where output SAM records will be
             stored.  If 'sam' is none, SAM records will be added to
-            the outQ.
+            the outQ.  If 'output_filter' is set, SAM output is
+            piped through that shell command on its way to 'sam'.
+
+            'more_runs' is a list of (unpaired, paired, sam) tuples
+            for further alignments, each with its own output file,
+            that SNAP runs after the first without reloading the
+            index.
         """
 
         if index is None:
             raise RuntimeError('Must specify --index when aligner is SNAP')
 
         cmd_toks = cmd.split()
-        popen_stdin, popen_stdout, popen_stderr = None, None, None
+        popen_stdin, popen_stderr = None, None
         self.inQ, self.outQ = None, None
 
+        for tok in self._input_args + self._output_args:
+            assert tok not in cmd_toks
+
+        if sam is None:
+            raise RuntimeError("Must specify SAM output")
+        runs = [self._run_args(cmd_toks, aligner_args, aligner_unpaired_args, aligner_paired_args, index,
+                               unpaired, paired, paired_combined, sam if output_filter is None else '-')]
+        for more_unpaired, more_paired, more_sam in (more_runs or []):
+            assert output_filter is None
+            runs.append(self._run_args(cmd_toks, aligner_args, aligner_unpaired_args, aligner_paired_args, index,
+                                       more_unpaired, more_paired, None, more_sam))
+
+        cmd = cmd_toks[0] + ' ' + ' , '.join(runs)
+
+        logging.info('SNAP command: ' + cmd)
+        if quiet:
+            popen_stderr = open(os.devnull, 'w')
+        self._open_pipes(cmd, popen_stdin, popen_stderr, sam, output_filter)
+
+    @staticmethod
+    def _run_args(cmd_toks, aligner_args, aligner_unpaired_args, aligner_paired_args, index,
+                  unpaired, paired, paired_combined, sam_out):
+        """ Compose arguments for aligning the given inputs, writing SAM
+            to sam_out; the single and paired alignments are separate runs """
+
         #
         # Compose input arguments
         #
 
-        for tok in self._input_args:
-            assert tok not in cmd_toks
-
         args_single, args_paired = ['single', index], ['paired', index]
 
         if paired_combined is not None:
@@ -135,19 +164,8 @@ class SnapAligner(Aligner):
         if unpaired is None and paired is None and paired_combined is None:
             raise RuntimeError('Cannot instantiate SnapAligner without input file(s) specified')
 
-        #
-        # Compose output arguments
-        #
-
-        for tok in self._output_args:
-            assert tok not in cmd_toks
-
         # Compose output arguments
-        args_output = ['-o', '-sam']
-        if sam is not None:
-            args_output.append(sam)
-        else:
-            raise RuntimeError("Must specify SAM output")
+        args_output = ['-o', '-sam', sam_out]
 
         # Put all the arguments together
         cmd = ''
@@ -169,14 +187,11 @@ class SnapAligner(Aligner):
             cmd += ' ' + ' '.join(aligner_paired_args)
             cmd += ' ' + ' '.join(aligner_args)
 
-        cmd = cmd_toks[0] + ' ' + cmd
+        return cmd
 
-        logging.info('SNAP command: ' + cmd)
-        if quiet:
-            popen_stderr = open(os.devnull, 'w')
-        self.pipe = Popen(cmd, shell=True,
-                          stdin=popen_stdin, stdout=popen_stdout, stderr=popen_stderr,
-                          bufsize=-1, close_fds='posix' in sys.builtin_module_names)
+    @staticmethod
+    def thread_options():
+        return ['-t']
 
     @staticmethod
     def supports_mix():
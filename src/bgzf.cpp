@@ -0,0 +1,654 @@
+//
+//  bgzf.cpp
+//  qtip
+//
+
+#include <string.h>
+#include "bgzf.h"
+#include <iostream>
+#include <cassert>
+#include <map>
+#include <string>
+#include <errno.h>
+#include <signal.h>
+#include <unistd.h>
+#include <zlib.h>
+
+using namespace std;
+
+// BGZF blocks start with a gzip header carrying a "BC" extra subfield that
+// holds the total block size minus 1
+static const size_t BGZF_HEADER = 18;
+static const size_t BGZF_FOOTER = 8;
+
+static const unsigned char bgzf_eof[28] = {
+	0x1f, 0x8b, 0x08, 0x04, 0x00, 0x00, 0x00, 0x00, 0x00, 0xff, 0x06, 0x00,
+	0x42, 0x43, 0x02, 0x00, 0x1b, 0x00, 0x03, 0x00, 0x00, 0x00, 0x00, 0x00,
+	0x00, 0x00, 0x00, 0x00
+};
+
+static inline void put_le16(char *p, unsigned v) {
+	p[0] = (char)(v & 0xff);
+	p[1] = (char)((v >> 8) & 0xff);
+}
+
+static inline void put_le32(char *p, unsigned long v) {
+	put_le16(p, (unsigned)(v & 0xffff));
+	put_le16(p + 2, (unsigned)((v >> 16) & 0xffff));
+}
+
+static inline unsigned long get_le32(const unsigned char *p) {
+	return (unsigned long)p[0] | ((unsigned long)p[1] << 8) |
+	       ((unsigned long)p[2] << 16) | ((unsigned long)p[3] << 24);
+}
+
+BatchPool::BatchPool(int nthreads) :
+	fn_(NULL),
+	ctx_(NULL),
+	next_job_(0),
+	njobs_(0),
+	ndone_(0),
+	quit_(false)
+{
+	pthread_mutex_init(&mu_, NULL);
+	pthread_cond_init(&work_cv_, NULL);
+	pthread_cond_init(&done_cv_, NULL);
+	// calling thread does its share, so start one fewer
+	threads_.resize(nthreads > 1 ? nthreads - 1 : 0);
+	for(size_t i = 0; i < threads_.size(); i++) {
+		if(pthread_create(&threads_[i], NULL, worker, (void *)this) != 0) {
+			cerr << "Could not create worker thread" << endl;
+			throw 1;
+		}
+	}
+}
+
+BatchPool::~BatchPool() {
+	pthread_mutex_lock(&mu_);
+	quit_ = true;
+	pthread_cond_broadcast(&work_cv_);
+	pthread_mutex_unlock(&mu_);
+	for(size_t i = 0; i < threads_.size(); i++) {
+		pthread_join(threads_[i], NULL);
+	}
+	pthread_cond_destroy(&done_cv_);
+	pthread_cond_destroy(&work_cv_);
+	pthread_mutex_destroy(&mu_);
+}
+
+/**
+ * Claim and run jobs from the current batch until none are left.  Called
+ * with the mutex held; returns with it held.
+ */
+void BatchPool::runJobs() {
+	while(next_job_ < njobs_) {
+		size_t j = next_job_++;
+		pthread_mutex_unlock(&mu_);
+		fn_(ctx_, j);
+		pthread_mutex_lock(&mu_);
+		if(++ndone_ == njobs_) {
+			pthread_cond_signal(&done_cv_);
+		}
+	}
+}
+
+void *BatchPool::worker(void *vp) {
+	BatchPool& p = *((BatchPool *)vp);
+	pthread_mutex_lock(&p.mu_);
+	while(true) {
+		while(!p.quit_ && p.next_job_ >= p.njobs_) {
+			pthread_cond_wait(&p.work_cv_, &p.mu_);
+		}
+		if(p.quit_) {
+			break;
+		}
+		p.runJobs();
+	}
+	pthread_mutex_unlock(&p.mu_);
+	return NULL;
+}
+
+void BatchPool::run(size_t n, void (*fn)(void *, size_t), void *ctx) {
+	if(n == 0) {
+		return;
+	}
+	pthread_mutex_lock(&mu_);
+	fn_ = fn;
+	ctx_ = ctx;
+	next_job_ = 0;
+	ndone_ = 0;
+	njobs_ = n;
+	pthread_cond_broadcast(&work_cv_);
+	runJobs();
+	while(ndone_ < njobs_) {
+		pthread_cond_wait(&done_cv_, &mu_);
+	}
+	pthread_mutex_unlock(&mu_);
+}
+
+BgzfWriter::BgzfWriter(
+	FILE *fh,
+	int nthreads,
+	int level,
+	bool write_eof) :
+	fh_(fh),
+	level_(level),
+	write_eof_(write_eof),
+	closed_(false),
+	ok_(true),
+	cur_(0),
+	pool_(nthreads)
+{
+	batch_.resize(4 * (nthreads < 1 ? 1 : nthreads));
+	for(size_t i = 0; i < batch_.size(); i++) {
+		batch_[i].in.resize(BGZF_BLOCK_DATA);
+		batch_[i].out.resize(BGZF_BLOCK_MAX);
+		batch_[i].inlen = batch_[i].outlen = 0;
+		batch_[i].ok = true;
+	}
+}
+
+BgzfWriter::~BgzfWriter() {
+	if(!closed_) {
+		close();
+	}
+}
+
+/**
+ * Compress one block into a complete BGZF member.  Falls back to storing
+ * the data uncompressed in the unlikely case it doesn't fit.
+ */
+void BgzfWriter::compressBlock(Block& b) {
+	char *out = &b.out[0];
+	int level = level_;
+	while(true) {
+		z_stream zs;
+		memset(&zs, 0, sizeof(zs));
+		if(deflateInit2(&zs, level, Z_DEFLATED, -15, 8, Z_DEFAULT_STRATEGY) != Z_OK) {
+			b.ok = false;
+			return;
+		}
+		zs.next_in = (Bytef *)&b.in[0];
+		zs.avail_in = (uInt)b.inlen;
+		zs.next_out = (Bytef *)(out + BGZF_HEADER);
+		zs.avail_out = (uInt)(BGZF_BLOCK_MAX - BGZF_HEADER - BGZF_FOOTER);
+		int ret = deflate(&zs, Z_FINISH);
+		size_t clen = zs.total_out;
+		deflateEnd(&zs);
+		if(ret != Z_STREAM_END) {
+			if(level == 0) {
+				b.ok = false;
+				return;
+			}
+			level = 0;
+			continue;
+		}
+		b.outlen = BGZF_HEADER + clen + BGZF_FOOTER;
+		break;
+	}
+	memcpy(out, bgzf_eof, BGZF_HEADER); // same header, size filled in below
+	put_le16(out + 16, (unsigned)(b.outlen - 1));
+	unsigned long crc = crc32(0L, (const Bytef *)&b.in[0], (uInt)b.inlen);
+	put_le32(out + b.outlen - 8, crc);
+	put_le32(out + b.outlen - 4, (unsigned long)b.inlen);
+	b.ok = true;
+}
+
+void BgzfWriter::compressJob(void *ctx, size_t i) {
+	BgzfWriter& w = *((BgzfWriter *)ctx);
+	w.compressBlock(w.batch_[i]);
+}
+
+/**
+ * Compress all filled blocks in the batch in parallel, then write them out
+ * in order.
+ */
+void BgzfWriter::flushBatch() {
+	size_t n = cur_;
+	if(cur_ < batch_.size() && batch_[cur_].inlen > 0) {
+		n++;
+	}
+	pool_.run(n, compressJob, (void *)this);
+	for(size_t i = 0; i < n; i++) {
+		Block& b = batch_[i];
+		if(!b.ok || fwrite(&b.out[0], 1, b.outlen, fh_) != b.outlen) {
+			ok_ = false;
+		}
+		b.inlen = b.outlen = 0;
+	}
+	cur_ = 0;
+}
+
+bool BgzfWriter::close() {
+	assert(!closed_);
+	flushBatch();
+	if(write_eof_ && !writeEof(fh_)) {
+		ok_ = false;
+	}
+	closed_ = true;
+	return ok_ && fflush(fh_) == 0;
+}
+
+bool BgzfWriter::writeEof(FILE *fh) {
+	return fwrite(bgzf_eof, 1, sizeof(bgzf_eof), fh) == sizeof(bgzf_eof);
+}
+
+/**
+ * State for a compressed SAM input opened with open_sam_input.
+ */
+struct SamInput {
+	bool piped;      // from "samtools view" rather than our own thread
+	std::string fn;
+	FILE *src;       // compressed source
+	int wfd;         // write end of pipe to consumer
+	int nthreads;
+	bool bgzf;
+	bool ok;
+	pthread_t thread;
+};
+
+static pthread_mutex_t sam_inputs_mu = PTHREAD_MUTEX_INITIALIZER;
+static map<FILE *, SamInput *> sam_inputs;
+
+/**
+ * One BGZF block to decompress.
+ */
+struct InflateBlock {
+	vector<char> in, out;
+	size_t inlen, outlen;
+	bool ok;
+};
+
+/**
+ * Read the next whole BGZF block from fh.  Sets eof and returns true at a
+ * clean end of file; returns false if the block is malformed or truncated.
+ */
+static bool read_bgzf_block(FILE *fh, InflateBlock& b, bool& eof) {
+	eof = false;
+	unsigned char *h = (unsigned char *)&b.in[0];
+	size_t n = fread(h, 1, BGZF_HEADER, fh);
+	if(n == 0 && feof(fh)) {
+		eof = true;
+		return true;
+	}
+	if(n != BGZF_HEADER || h[0] != 0x1f || h[1] != 0x8b || (h[3] & 4) == 0 ||
+	   h[10] != 6 || h[11] != 0 || h[12] != 'B' || h[13] != 'C')
+	{
+		return false;
+	}
+	size_t bsize = (h[16] | (h[17] << 8)) + 1;
+	if(bsize < BGZF_HEADER + BGZF_FOOTER) {
+		return false;
+	}
+	if(fread(h + BGZF_HEADER, 1, bsize - BGZF_HEADER, fh) != bsize - BGZF_HEADER) {
+		return false;
+	}
+	b.inlen = bsize;
+	return true;
+}
+
+static void inflate_job(void *ctx, size_t i) {
+	InflateBlock& b = (*((vector<InflateBlock> *)ctx))[i];
+	const unsigned char *in = (const unsigned char *)&b.in[0];
+	size_t isize = get_le32(in + b.inlen - 4);
+	b.ok = false;
+	b.outlen = 0;
+	if(isize > BgzfWriter::BGZF_BLOCK_MAX) {
+		return;
+	}
+	z_stream zs;
+	memset(&zs, 0, sizeof(zs));
+	if(inflateInit2(&zs, -15) != Z_OK) {
+		return;
+	}
+	zs.next_in = (Bytef *)(in + BGZF_HEADER);
+	zs.avail_in = (uInt)(b.inlen - BGZF_HEADER - BGZF_FOOTER);
+	zs.next_out = (Bytef *)&b.out[0];
+	zs.avail_out = (uInt)b.out.size();
+	int ret = inflate(&zs, Z_FINISH);
+	b.outlen = zs.total_out;
+	inflateEnd(&zs);
+	b.ok = ret == Z_STREAM_END && b.outlen == isize &&
+	       crc32(0L, (const Bytef *)&b.out[0], (uInt)b.outlen) == get_le32(in + b.inlen - 8);
+}
+
+/**
+ * Write all of buf to fd; false if the reader has gone away.
+ */
+static bool write_all(int fd, const char *buf, size_t len) {
+	while(len > 0) {
+		ssize_t ret = ::write(fd, buf, len);
+		if(ret < 0) {
+			if(errno == EINTR) {
+				continue;
+			}
+			return false;
+		}
+		buf += ret;
+		len -= ret;
+	}
+	return true;
+}
+
+/**
+ * Decompress the source into the pipe.  BGZF is read a batch of blocks at a
+ * time, and the batch is inflated in parallel; other gzip goes through
+ * zlib's gzread.  A reader that stops early just ends decompression.
+ */
+static void *decompress_worker(void *vp) {
+	SamInput& si = *((SamInput *)vp);
+	si.ok = true;
+	if(si.bgzf) {
+		BatchPool pool(si.nthreads);
+		vector<InflateBlock> batch(4 * (si.nthreads < 1 ? 1 : si.nthreads));
+		for(size_t i = 0; i < batch.size(); i++) {
+			batch[i].in.resize(BgzfWriter::BGZF_BLOCK_MAX);
+			batch[i].out.resize(BgzfWriter::BGZF_BLOCK_MAX);
+		}
+		bool eof = false, reading = true;
+		while(!eof && reading) {
+			size_t n = 0;
+			while(n < batch.size()) {
+				if(!read_bgzf_block(si.src, batch[n], eof)) {
+					si.ok = reading = false;
+					break;
+				}
+				if(eof) {
+					break;
+				}
+				n++;
+			}
+			pool.run(n, inflate_job, (void *)&batch);
+			for(size_t i = 0; i < n && reading; i++) {
+				if(!batch[i].ok) {
+					si.ok = reading = false;
+				} else if(!write_all(si.wfd, &batch[i].out[0], batch[i].outlen)) {
+					reading = false;
+				}
+			}
+		}
+	} else {
+		gzFile gz = gzopen(si.fn.c_str(), "rb");
+		if(gz == NULL) {
+			si.ok = false;
+		} else {
+			vector<char> buf(BgzfWriter::BGZF_BLOCK_MAX * 4);
+			gzbuffer(gz, (unsigned)buf.size());
+			int n;
+			while((n = gzread(gz, &buf[0], (unsigned)buf.size())) > 0) {
+				if(!write_all(si.wfd, &buf[0], n)) {
+					break;
+				}
+			}
+			if(n < 0) {
+				si.ok = false;
+			}
+			gzclose(gz);
+		}
+	}
+	close(si.wfd);
+	si.wfd = -1;
+	return NULL;
+}
+
+bool is_gzip_file(const char *fn) {
+	FILE *fh = fopen(fn, "rb");
+	if(fh == NULL) {
+		return false;
+	}
+	unsigned char h[2] = {0, 0};
+	size_t n = fread(h, 1, 2, fh);
+	fclose(fh);
+	return n == 2 && h[0] == 0x1f && h[1] == 0x8b;
+}
+
+FILE *open_sam_input(const char *fn, int nthreads, const char *samtools) {
+	if(strcmp(fn, "-") == 0) {
+		return stdin; // can't sniff a pipe without consuming it
+	}
+	if(!is_gzip_file(fn)) {
+		return fopen(fn, "rb");
+	}
+	// BAM is BGZF whose decompressed stream starts with "BAM\1"
+	char magic[4];
+	gzFile gz = gzopen(fn, "rb");
+	if(gz == NULL) {
+		return NULL;
+	}
+	int nmagic = gzread(gz, magic, 4);
+	gzclose(gz);
+	SamInput *si = new SamInput();
+	si->fn = fn;
+	si->nthreads = nthreads;
+	si->src = NULL;
+	si->wfd = -1;
+	si->ok = false;
+	FILE *fh = NULL;
+	if(nmagic == 4 && memcmp(magic, "BAM\1", 4) == 0) {
+		si->piped = true;
+		char nthreads_str[32];
+		snprintf(nthreads_str, sizeof(nthreads_str), "%d", nthreads > 1 ? nthreads - 1 : 0);
+		string cmd = string(samtools) + " view -h -@ " + nthreads_str + " '" + fn + "'";
+		fh = popen(cmd.c_str(), "r");
+		if(fh == NULL) {
+			cerr << "Could not run \"" << cmd << "\" to read BAM" << endl;
+		}
+	} else {
+		si->piped = false;
+		si->src = fopen(fn, "rb");
+		unsigned char h[BGZF_HEADER];
+		if(si->src == NULL || fread(h, 1, BGZF_HEADER, si->src) != BGZF_HEADER) {
+			memset(h, 0, BGZF_HEADER);
+		}
+		si->bgzf = (h[3] & 4) != 0 && h[10] == 6 && h[11] == 0 && h[12] == 'B' && h[13] == 'C';
+		int fds[2];
+		if(si->src != NULL && fseeko(si->src, 0, SEEK_SET) == 0 && pipe(fds) == 0) {
+			si->wfd = fds[1];
+			// Block SIGPIPE in the decompression thread so that a reader that
+			// closes early causes EPIPE rather than killing the process
+			sigset_t set, old;
+			sigemptyset(&set);
+			sigaddset(&set, SIGPIPE);
+			pthread_sigmask(SIG_BLOCK, &set, &old);
+			int ret = pthread_create(&si->thread, NULL, decompress_worker, (void *)si);
+			pthread_sigmask(SIG_SETMASK, &old, NULL);
+			if(ret != 0) {
+				cerr << "Could not create decompression thread" << endl;
+				throw 1;
+			}
+			fh = fdopen(fds[0], "rb");
+		}
+	}
+	if(fh == NULL) {
+		if(si->src != NULL) {
+			fclose(si->src);
+		}
+		delete si;
+		return NULL;
+	}
+	pthread_mutex_lock(&sam_inputs_mu);
+	sam_inputs[fh] = si;
+	pthread_mutex_unlock(&sam_inputs_mu);
+	return fh;
+}
+
+int close_sam_input(FILE *fh) {
+	SamInput *si = NULL;
+	pthread_mutex_lock(&sam_inputs_mu);
+	map<FILE *, SamInput *>::iterator it = sam_inputs.find(fh);
+	if(it != sam_inputs.end()) {
+		si = it->second;
+		sam_inputs.erase(it);
+	}
+	pthread_mutex_unlock(&sam_inputs_mu);
+	if(si == NULL) {
+		return fclose(fh); // plain SAM
+	}
+	int ret = 0;
+	if(si->piped) {
+		ret = (pclose(fh) == 0) ? 0 : -1;
+	} else {
+		fclose(fh);
+		pthread_join(si->thread, NULL);
+		fclose(si->src);
+		ret = si->ok ? 0 : -1;
+	}
+	delete si;
+	return ret;
+}
+
+#ifdef BGZF_MAIN
+
+#include <string>
+
+/**
+ * Write a stream with several threads and check that it decompresses back to
+ * the original and that it is made of properly labeled BGZF blocks.
+ */
+static void test1(int nthreads, size_t len, bool eof) {
+	string fn(".bgzf.test1.gz");
+	string orig;
+	for(size_t i = 0; i < len; i++) {
+		// mildly compressible
+		orig.push_back("ACGT\t\n0123"[(i * 7 + i / 13) % 10]);
+	}
+	FILE *fh = fopen(fn.c_str(), "wb");
+	assert(fh != NULL);
+	{
+		BgzfWriter w(fh, nthreads, -1, eof);
+		size_t off = 0, step = 1;
+		while(off < orig.size()) {
+			size_t n = min(step, orig.size() - off);
+			w.write(orig.data() + off, n);
+			off += n;
+			step = step * 3 + 1;
+		}
+		bool ret = w.close();
+		assert(ret);
+	}
+	fclose(fh);
+
+	// walk the blocks
+	fh = fopen(fn.c_str(), "rb");
+	vector<unsigned char> blk(BgzfWriter::BGZF_BLOCK_MAX);
+	size_t nblocks = 0, total = 0;
+	bool saw_eof = false;
+	while(fread(&blk[0], 1, BGZF_HEADER, fh) == BGZF_HEADER) {
+		assert(blk[0] == 0x1f && blk[1] == 0x8b);
+		assert(blk[12] == 'B' && blk[13] == 'C');
+		size_t bsize = (blk[16] | (blk[17] << 8)) + 1;
+		size_t ret = fread(&blk[BGZF_HEADER], 1, bsize - BGZF_HEADER, fh);
+		assert(ret == bsize - BGZF_HEADER);
+		size_t isize = blk[bsize-4] | (blk[bsize-3] << 8) | (blk[bsize-2] << 16);
+		assert(isize <= BgzfWriter::BGZF_BLOCK_DATA);
+		saw_eof = (isize == 0);
+		total += isize;
+		nblocks++;
+	}
+	fclose(fh);
+	assert(total == orig.size());
+	assert(saw_eof == eof);
+	assert(nblocks >= orig.size() / BgzfWriter::BGZF_BLOCK_DATA);
+
+	// decompress
+	gzFile gz = gzopen(fn.c_str(), "rb");
+	assert(gz != NULL);
+	string got;
+	vector<char> buf(100000);
+	int n;
+	while((n = gzread(gz, &buf[0], (unsigned)buf.size())) > 0) {
+		got.append(&buf[0], n);
+	}
+	gzclose(gz);
+	assert(got == orig);
+	remove(fn.c_str());
+}
+
+/**
+ * Write BGZF and plain gzip files and check open_sam_input reads them, and a
+ * plain file, back unchanged, including when the reader stops early.
+ */
+static void test2(int nthreads) {
+	string fn(".bgzf.test2.gz"), plain_fn(".bgzf.test2.sam");
+	string orig;
+	for(size_t i = 0; i < 300000; i++) {
+		char buf[64];
+		snprintf(buf, sizeof(buf), "r%u\t%u\tchr1\t%u\n", (unsigned)i, (unsigned)(i % 3), (unsigned)(i * 17));
+		orig += buf;
+	}
+	FILE *fh = fopen(plain_fn.c_str(), "wb");
+	fwrite(orig.data(), 1, orig.size(), fh);
+	fclose(fh);
+	for(int gzip = 0; gzip < 3; gzip++) {
+		const char *rfn = fn.c_str();
+		if(gzip == 0) {
+			// BGZF
+			fh = fopen(fn.c_str(), "wb");
+			BgzfWriter w(fh, 2);
+			w.write(orig.data(), orig.size());
+			bool ret = w.close();
+			assert(ret);
+			fclose(fh);
+		} else if(gzip == 1) {
+			// ordinary gzip
+			gzFile gz = gzopen(fn.c_str(), "wb");
+			gzwrite(gz, orig.data(), (unsigned)orig.size());
+			gzclose(gz);
+		} else {
+			rfn = plain_fn.c_str();
+		}
+		assert(is_gzip_file(rfn) == (gzip < 2));
+		fh = open_sam_input(rfn, nthreads);
+		assert(fh != NULL);
+		string got;
+		char line[1024];
+		while(fgets(line, sizeof(line), fh) != NULL) {
+			got += line;
+		}
+		int ret = close_sam_input(fh);
+		assert(ret == 0);
+		assert(got == orig);
+
+		// stop after a few lines
+		fh = open_sam_input(rfn, nthreads);
+		for(int i = 0; i < 10; i++) {
+			char *l = fgets(line, sizeof(line), fh);
+			assert(l != NULL);
+		}
+		ret = close_sam_input(fh);
+		assert(ret == 0);
+	}
+
+	// truncated BGZF is an error
+	fh = fopen(fn.c_str(), "wb");
+	{
+		BgzfWriter w(fh, 1);
+		w.write(orig.data(), orig.size());
+		w.close();
+	}
+	long sz = ftell(fh);
+	fclose(fh);
+	int tret = truncate(fn.c_str(), sz / 2);
+	assert(tret == 0);
+	fh = open_sam_input(fn.c_str(), nthreads);
+	char line[1024];
+	while(fgets(line, sizeof(line), fh) != NULL) { }
+	int ret = close_sam_input(fh);
+	assert(ret != 0);
+	remove(fn.c_str());
+	remove(plain_fn.c_str());
+}
+
+int main(void) {
+	test2(1);
+	test2(4);
+	test1(1, 0, true);
+	test1(1, 10, true);
+	test1(1, 1000000, true);
+	test1(3, 1000000, true);
+	test1(8, 3 * BgzfWriter::BGZF_BLOCK_DATA, false);
+	test1(8, 2000000, true);
+	cout << "ALL TESTS PASSED" << endl;
+}
+
+#endif
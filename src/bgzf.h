@@ -0,0 +1,153 @@
+//
+//  bgzf.h
+//  qtip
+//
+
+#ifndef __qtip__bgzf__
+#define __qtip__bgzf__
+
+#include <stdio.h>
+#include <string.h>
+#include <pthread.h>
+#include <vector>
+
+/**
+ * Small pool of worker threads that, together with the calling thread, runs
+ * a function over each index of a batch.
+ */
+class BatchPool {
+public:
+
+	explicit BatchPool(int nthreads);
+
+	~BatchPool();
+
+	/**
+	 * Call fn(ctx, i) for i in [0, n), spread over the pool; return once
+	 * all calls have finished.
+	 */
+	void run(size_t n, void (*fn)(void *, size_t), void *ctx);
+
+private:
+
+	void runJobs();
+
+	static void *worker(void *vp);
+
+	std::vector<pthread_t> threads_;
+	pthread_mutex_t mu_;
+	pthread_cond_t work_cv_, done_cv_;
+	void (*fn_)(void *, size_t);
+	void *ctx_;
+	size_t next_job_, njobs_, ndone_;
+	bool quit_;
+};
+
+/**
+ * Writes a BGZF stream: a series of independent gzip members, each holding
+ * at most BGZF_BLOCK_DATA bytes of input and labeled with its compressed
+ * size, as used by bgzip/htslib.  Because blocks are independent, a batch of
+ * them is compressed in parallel by a pool of worker threads (plus the
+ * calling thread), then written in order.
+ *
+ * Independent BGZF streams written without the EOF marker block can be
+ * concatenated to form a valid stream, so long as the EOF block is appended
+ * at the end.
+ */
+class BgzfWriter {
+public:
+
+	BgzfWriter(
+		FILE *fh,
+		int nthreads = 1,
+		int level = -1,
+		bool write_eof = true);
+
+	~BgzfWriter();
+
+	/**
+	 * Append bytes to the stream.
+	 */
+	void write(const char *buf, size_t len) {
+		while(len > 0) {
+			Block& b = batch_[cur_];
+			size_t n = BGZF_BLOCK_DATA - b.inlen;
+			if(n > len) {
+				n = len;
+			}
+			memcpy(&b.in[b.inlen], buf, n);
+			b.inlen += n;
+			buf += n;
+			len -= n;
+			if(b.inlen == BGZF_BLOCK_DATA) {
+				if(++cur_ == batch_.size()) {
+					flushBatch();
+				}
+			}
+		}
+	}
+
+	/**
+	 * Compress and write all buffered data, then the EOF block if requested.
+	 * Returns false if anything could not be written.  Does not close the
+	 * underlying file.
+	 */
+	bool close();
+
+	/**
+	 * Write the 28-byte BGZF EOF marker block.
+	 */
+	static bool writeEof(FILE *fh);
+
+	static const size_t BGZF_BLOCK_DATA = 0xff00;
+	static const size_t BGZF_BLOCK_MAX = 0x10000;
+
+private:
+
+	struct Block {
+		std::vector<char> in, out;
+		size_t inlen, outlen;
+		bool ok;
+	};
+
+	void flushBatch();
+
+	void compressBlock(Block& b);
+
+	static void compressJob(void *ctx, size_t i);
+
+	FILE *fh_;
+	int level_;
+	bool write_eof_;
+	bool closed_;
+	bool ok_;
+	std::vector<Block> batch_;
+	size_t cur_; // index of block being filled
+	BatchPool pool_;
+};
+
+/**
+ * Open a SAM file for reading as plain text, whether it is uncompressed,
+ * gzip- or BGZF-compressed SAM, or BAM.  Compressed SAM is decompressed by
+ * a background thread (BGZF blocks in parallel over nthreads threads) that
+ * feeds the returned FILE through a pipe.  BAM is converted to SAM, with
+ * header, by "samtools view -h".  "-" is uncompressed SAM on standard in.
+ * Returns NULL if the file can't be opened.  Close with close_sam_input.
+ */
+FILE *open_sam_input(
+	const char *fn,
+	int nthreads = 1,
+	const char *samtools = "samtools");
+
+/**
+ * Close a FILE from open_sam_input.  Returns non-zero if the file could not
+ * be read or decompressed in full.
+ */
+int close_sam_input(FILE *fh);
+
+/**
+ * Return true iff the file starts with the gzip magic number.
+ */
+bool is_gzip_file(const char *fn);
+
+#endif /* defined(__qtip__bgzf__) */
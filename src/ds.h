@@ -445,6 +445,32 @@ public:
 		}
 	}
 
+	/**
+	 * Add a slot for an item that was already chosen by sampling elsewhere,
+	 * e.g. when merging samples, and return its index.  Reservoir must not
+	 * be full.  Doesn't count toward size(); see set_size().
+	 */
+	size_t add_sampled() {
+		assert(list_.size() < k_);
+		list_.expand();
+		return list_.size()-1;
+	}
+
+	/**
+	 * Set the number of items the reservoir has sampled from, so that
+	 * further add() calls continue sampling as if they had all been added.
+	 * If that's more than are in the reservoir, e.g. because the samples it
+	 * was merged from were smaller than it, the reservoir shrinks to its
+	 * current size so that it stays a uniform sample.
+	 */
+	void set_size(size_t n) {
+		assert(n >= list_.size());
+		n_ = n;
+		if(n_ > list_.size()) {
+			k_ = list_.size();
+		}
+	}
+
 	/**
 	 * Return the number of items added (not all of which were retained by the
 	 * sampler).
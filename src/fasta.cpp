@@ -7,7 +7,10 @@
 //
 
 #include "fasta.h"
+#include <string.h>
+#include <ctype.h>
 #include <iostream>
+#include <algorithm>
 #include <cassert>
 
 using namespace std;
@@ -50,6 +53,13 @@ const char *FastaChunkwiseParser::next(
 	if(done()) {
 		return NULL;
 	}
+	if(packed_.is_open()) {
+		return next_packed(refid, refid_full, refoff, retsz);
+	}
+	if(foff_ == 0 && use_packed_ && packed_.open_cached(fns_[fni_])) {
+		prec_ = pstart_ = 0;
+		return next_packed(refid, refid_full, refoff, retsz);
+	}
 	if(foff_ == 0) {
 		fh_ = fopen(fns_[fni_].c_str(), "rb");
 		if(fh_ == NULL) {
@@ -127,6 +137,38 @@ const char *FastaChunkwiseParser::next(
 	return NULL;
 }
 
+/**
+ * Chunks of a record start every chunksz_ - olap_ bases and are chunksz_
+ * long, except the last, which ends at the end of the record.  Returns NULL
+ * after the last chunk of the file.
+ */
+const char *FastaChunkwiseParser::next_packed(
+	std::string& refid,
+	std::string& refid_full,
+	size_t& refoff,
+	size_t& retsz)
+{
+	while(prec_ < packed_.num_records()) {
+		const size_t len = packed_.length(prec_);
+		if(pstart_ < len) {
+			const size_t end = std::min(pstart_ + chunksz_, len);
+			packed_.decode(prec_, pstart_, end - pstart_, buf_);
+			refid_full = packed_.name(prec_);
+			refid = refid_full.substr(0, std::find_if(refid_full.begin(),
+				refid_full.end(), ::isspace) - refid_full.begin());
+			refoff = pstart_;
+			retsz = end - pstart_;
+			pstart_ = (end < len) ? end - olap_ : len;
+			return buf_;
+		}
+		prec_++;
+		pstart_ = 0;
+	}
+	packed_.close();
+	fni_++;
+	return NULL;
+}
+
 #ifdef FASTA_MAIN
 
 #include <fstream>
@@ -263,10 +305,87 @@ static void test1() {
 	assert(refoff == 0);
 	assert(buf[0] == 'C');
 	assert(buf[1] == 'A');
+	remove(fn1.c_str());
+	remove(fn2.c_str());
+	remove(fn3.c_str());
+}
+
+/**
+ * Chunks from a packed copy are the same as from the FASTA, for various
+ * chunk sizes, and a stale packed copy is rebuilt.
+ */
+static void test2() {
+	string fn1 = ".test2.1.fa";
+	string fn2 = ".test2.2.fa";
+	{
+		ofstream ofs1(fn1.c_str(), ofstream::out);
+		ofs1 << ">rec1 first one" << endl;
+		ofs1 << "ACGTacgtNNNNnnRYACGTACGTTTGCA" << endl;
+		ofs1 << "GGGNNNNNNNNNNNNNNNNNACGT" << endl;
+		ofs1 << ">empty" << endl;
+		ofs1 << ">rec2\tx" << endl;
+		ofs1 << "ACG" << endl;
+		ofs1 << ">rec3" << endl;
+		for(int i = 0; i < 40; i++) {
+			ofs1 << "ACGTTGCAN" << (i % 3 == 0 ? "\n" : "");
+		}
+		ofs1 << endl;
+		ofs1.close();
+		ofstream ofs2(fn2.c_str(), ofstream::out);
+		ofs2 << ">rec4" << endl << "TTTTNAAAAC";
+		ofs2.close();
+	}
+	vector<string> fns;
+	fns.push_back(fn1);
+	fns.push_back(fn2);
+	for(size_t chunksz = 2; chunksz < 40; chunksz += 3) {
+		for(size_t olap = 1; olap < chunksz; olap += 4) {
+			FastaChunkwiseParser fa(fns, chunksz, olap);
+			FastaChunkwiseParser pa(fns, chunksz, olap, true);
+			string refid, refid_full, prefid, prefid_full;
+			size_t refoff, retsz, prefoff, pretsz;
+			while(true) {
+				const char *buf = NULL, *pbuf = NULL;
+				while(buf == NULL && !fa.done()) {
+					buf = fa.next(refid, refid_full, refoff, retsz);
+				}
+				while(pbuf == NULL && !pa.done()) {
+					pbuf = pa.next(prefid, prefid_full, prefoff, pretsz);
+				}
+				assert((buf == NULL) == (pbuf == NULL));
+				if(buf == NULL) {
+					break;
+				}
+				assert(refid == prefid);
+				assert(refid_full == prefid_full);
+				assert(refoff == prefoff);
+				assert(retsz == pretsz);
+				assert(memcmp(buf, pbuf, retsz) == 0);
+			}
+		}
+	}
+	{
+		// changing the FASTA makes the packed copy stale
+		PackedRef p;
+		assert(p.open(PackedRef::cache_fn(fn2), fn2));
+		ofstream ofs2(fn2.c_str(), ofstream::out);
+		ofs2 << ">rec4" << endl << "GTTTNAAAAC";
+		ofs2.close();
+		assert(!p.open(PackedRef::cache_fn(fn2), fn2));
+		assert(p.open_cached(fn2));
+		char buf[10];
+		p.decode(0, 0, 10, buf);
+		assert(memcmp(buf, "GTTTNAAAAC", 10) == 0);
+	}
+	for(size_t i = 0; i < fns.size(); i++) {
+		remove(fns[i].c_str());
+		remove(PackedRef::cache_fn(fns[i]).c_str());
+	}
 }
 
 int main(void) {
 	test1();
+	test2();
 	cout << "ALL TESTS PASSED" << endl;
 }
 #endif
@@ -16,17 +16,26 @@
 #include <stdio.h>
 #include <cassert>
 #include <limits>
+#include "packed_ref.h"
+
+/**
+ * Maps FASTA characters to the bases parsers return: A, C, G, T or N.
+ */
+extern int dna_upper[];
 
 /**
  * Class that facilitates iterating through overlapping stretches of all the
- * entries in one or more (multi-)FASTA files.
+ * entries in one or more (multi-)FASTA files.  With use_packed, each FASTA
+ * is read from its packed, memory-mapped copy (see PackedRef), which is
+ * built on first use; chunks are the same either way.
  */
 class FastaChunkwiseParser {
 public:
 	FastaChunkwiseParser(
 		const std::vector<std::string>& fns,
 		size_t chunksz,
-		size_t olap) :
+		size_t olap,
+		bool use_packed = false) :
 		fns_(fns),
 		fni_(0),
 		foff_(0),
@@ -36,7 +45,10 @@ public:
 		bufcur_(0),
 		chunksz_(chunksz),
 		olap_(olap),
-		pushback_(std::numeric_limits<int>::min())
+		pushback_(std::numeric_limits<int>::min()),
+		use_packed_(use_packed),
+		prec_(0),
+		pstart_(0)
 	{
 		assert(chunksz > olap);
 		buf_ = new char[chunksz];
@@ -55,6 +67,8 @@ public:
 		if(fh_ != NULL) {
 			fclose(fh_); fh_ = NULL;
 		}
+		packed_.close();
+		prec_ = pstart_ = 0;
 	}
 	
 	/**
@@ -75,6 +89,15 @@ public:
 	
 protected:
 
+	/**
+	 * Like next(), but from the packed copy of the current FASTA.
+	 */
+	const char *next_packed(
+		std::string& refid,
+		std::string& refid_full,
+		size_t& refoff,
+		size_t& retsz);
+
 	inline void pushback(int c) {
 		assert(pushback_ == std::numeric_limits<int>::min());
 		pushback_ = c;
@@ -102,6 +125,10 @@ protected:
 	const size_t olap_;
 	char fabuf_[FASTA_BUFSZ];
 	int pushback_;
+	const bool use_packed_;
+	PackedRef packed_; // packed copy of current FASTA, if open
+	size_t prec_;      // current record in packed_
+	size_t pstart_;    // start of next chunk from packed_ record
 };
 
 #endif /* defined(__qtip__fasta__) */
@@ -47,8 +47,15 @@ public:
 	 * TODO: allow the draw to be somehow weighted toward lower scores.
 	 */
 	const TemplateUnpaired& draw() const {
+		return draw(r4_uni_01());
+	}
+
+	/**
+	 * Draw an unpaired template, given a uniform draw from [0, 1).
+	 */
+	const TemplateUnpaired& draw(float u) const {
 		assert(!empty());
-		size_t rn = std::min((size_t)(r4_uni_01() * ts_.size()), ts_.size()-1);
+		size_t rn = std::min((size_t)(u * ts_.size()), ts_.size()-1);
 		assert(rn < ts_.size());
 		return ts_[rn];
 	}
@@ -121,8 +128,15 @@ public:
 	 * TODO: allow the draw to be somehow weighted toward lower scores.
 	 */
 	const TemplatePaired& draw() const {
+		return draw(r4_uni_01());
+	}
+
+	/**
+	 * Draw a paired template, given a uniform draw from [0, 1).
+	 */
+	const TemplatePaired& draw(float u) const {
 		assert(!empty());
-		size_t rn = std::min((size_t)(r4_uni_01() * ts_.size()), ts_.size()-1);
+		size_t rn = std::min((size_t)(u * ts_.size()), ts_.size()-1);
 		return ts_[rn];
 	}
 
@@ -0,0 +1,214 @@
+//
+//  model_io.cpp
+//  qtip
+//
+
+#include "model_io.h"
+#include <stdlib.h>
+#include <iostream>
+
+using namespace std;
+
+bool load_templates(const char *fn, SavedTemplates& s) {
+	FILE *fh = fopen(fn, "rb");
+	if(fh == NULL) {
+		cerr << "Could not open input model file \"" << fn << "\"" << endl;
+		return false;
+	}
+	char *line = NULL;
+	size_t cap = 0;
+	ssize_t len;
+	bool ok = false;
+	s.lines.clear();
+	s.n = 0;
+	if((len = getline(&line, &cap, fh)) > 0) {
+		char *toks[3];
+		ok = split_fields(line, toks, 3) &&
+		     strcmp(toks[0], "qtip-templates") == 0 &&
+		     atoi(toks[1]) == 1;
+		if(ok) {
+			s.n = (size_t)strtoull(toks[2], NULL, 10);
+		}
+	}
+	if(!ok) {
+		cerr << "Input model file \"" << fn << "\" has unexpected format/version" << endl;
+	}
+	while(ok && (len = getline(&line, &cap, fh)) > 0) {
+		while(len > 0 && (line[len-1] == '\n' || line[len-1] == '\r')) {
+			line[--len] = '\0';
+		}
+		s.lines.push_back(string(line, len));
+	}
+	free(line);
+	if(ok && s.lines.size() > s.n) {
+		cerr << "Input model file \"" << fn << "\" has more templates than it was sampled from" << endl;
+		ok = false;
+	}
+	if(ferror(fh)) {
+		cerr << "Error reading input model file \"" << fn << "\"" << endl;
+		ok = false;
+	}
+	fclose(fh);
+	return ok;
+}
+
+#ifdef MODEL_IO_MAIN
+
+static void add_unpaired(ReservoirSampledEList<TemplateUnpaired>& r, int score) {
+	size_t off = r.add_part1();
+	if(off < r.k()) {
+		r.list()[off].init(score, 10, 'T', '0', 0, "IIIIIIIIII", "==========");
+	}
+}
+
+/**
+ * Round trip through save_templates and load_templates.
+ */
+static void test1() {
+	const char *fn = ".model_io.test1.tsv";
+	ReservoirSampledEList<TemplatePaired> r(5);
+	for(int i = 0; i < 3; i++) {
+		size_t off = r.add_part1();
+		r.list()[off].init(-i-1, -i, 4, 'T', "IIII", "==X=",
+		                   -1, 3, 'F', "III", "=I=", i == 1, 100 + i);
+	}
+	bool ret = save_templates(fn, r);
+	assert(ret);
+	SavedTemplates s;
+	ret = load_templates(fn, s);
+	assert(ret);
+	assert(s.n == 3);
+	assert(s.lines.size() == 3);
+	vector<SavedTemplates> srcs(1, s);
+	ReservoirSampledEList<TemplatePaired> r2(5);
+	ret = merge_templates(srcs, r2);
+	assert(ret);
+	assert(r2.size() == 3);
+	assert(r2.list().size() == 3);
+	int found = 0;
+	for(size_t i = 0; i < 3; i++) {
+		const TemplatePaired& t = r2.list()[i];
+		assert(strcmp(t.qual_1_, "IIII") == 0);
+		assert(strcmp(t.edit_xscript_2_, "=I=") == 0);
+		assert(t.len_2_ == 3);
+		assert(t.fw_flag_2_ == 'F');
+		assert(t.fraglen_ == 100 + (size_t)(-t.score_1_));
+		assert(t.upstream1_ == (t.score_1_ == -1));
+		found |= 1 << (-t.score_1_);
+	}
+	assert(found == 7);
+	remove(fn);
+}
+
+/**
+ * Merged sample draws from each source in proportion to the size of the
+ * population it was sampled from, and merged reservoir keeps sampling
+ * where the sources left off.
+ */
+static void test2() {
+	const char *fns[2] = {".model_io.test2.1.tsv", ".model_io.test2.2.tsv"};
+	const size_t ns[2] = {1000, 3000};
+	const int trials = 200;
+	size_t from_first = 0;
+	for(int t = 0; t < trials; t++) {
+		vector<SavedTemplates> srcs(2);
+		for(int i = 0; i < 2; i++) {
+			ReservoirSampledEList<TemplateUnpaired> r(20);
+			for(size_t j = 0; j < ns[i]; j++) {
+				add_unpaired(r, i == 0 ? 1 : 2);
+			}
+			bool ret = save_templates(fns[i], r);
+			assert(ret);
+			ret = load_templates(fns[i], srcs[i]);
+			assert(ret);
+		}
+		ReservoirSampledEList<TemplateUnpaired> r(20);
+		bool ret = merge_templates(srcs, r);
+		assert(ret);
+		assert(r.size() == ns[0] + ns[1]);
+		assert(r.list().size() == 20);
+		for(size_t i = 0; i < r.list().size(); i++) {
+			if(r.list()[i].best_score_ == 1) {
+				from_first++;
+			}
+		}
+		add_unpaired(r, 3);
+		assert(r.size() == ns[0] + ns[1] + 1);
+		assert(r.list().size() == 20);
+	}
+	double frac = (double)from_first / (trials * 20);
+	assert(frac > 0.2 && frac < 0.3);
+	remove(fns[0]);
+	remove(fns[1]);
+}
+
+/**
+ * Merging samples smaller than the destination reservoir leaves it at the
+ * size of the merged sample, and further templates keep it uniform rather
+ * than overflowing it.
+ */
+static void test4() {
+	const char *fn = ".model_io.test4.tsv";
+	ReservoirSampledEList<TemplateUnpaired> r(10);
+	for(int i = 0; i < 100; i++) {
+		add_unpaired(r, 1);
+	}
+	bool ret = save_templates(fn, r);
+	assert(ret);
+	vector<SavedTemplates> srcs(1);
+	ret = load_templates(fn, srcs[0]);
+	assert(ret);
+	ReservoirSampledEList<TemplateUnpaired> r2(50);
+	ret = merge_templates(srcs, r2);
+	assert(ret);
+	assert(r2.size() == 100);
+	assert(r2.list().size() == 10);
+	assert(r2.k() == 10);
+	size_t from_second = 0;
+	for(int i = 0; i < 100; i++) {
+		add_unpaired(r2, 2);
+	}
+	assert(r2.size() == 200);
+	assert(r2.list().size() == 10);
+	for(size_t i = 0; i < r2.list().size(); i++) {
+		if(r2.list()[i].best_score_ == 2) {
+			from_second++;
+		}
+	}
+	assert(from_second > 0);
+	remove(fn);
+}
+
+/**
+ * Malformed files are rejected.
+ */
+static void test3() {
+	const char *fn = ".model_io.test3.tsv";
+	FILE *fh = fopen(fn, "wb");
+	fprintf(fh, "qtip-templates\t1\t1\n1\tT\t10\n");
+	fclose(fh);
+	SavedTemplates s;
+	bool ret = load_templates(fn, s);
+	assert(ret);
+	vector<SavedTemplates> srcs(1, s);
+	ReservoirSampledEList<TemplateUnpaired> r(5);
+	ret = merge_templates(srcs, r);
+	assert(!ret);
+	fh = fopen(fn, "wb");
+	fprintf(fh, "qtip-templates\t2\t1\n");
+	fclose(fh);
+	ret = load_templates(fn, s);
+	assert(!ret);
+	remove(fn);
+}
+
+int main(void) {
+	initialize();
+	test1();
+	test2();
+	test3();
+	test4();
+	cout << "ALL TESTS PASSED" << endl;
+}
+
+#endif
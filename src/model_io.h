@@ -0,0 +1,107 @@
+//
+//  model_io.h
+//  qtip
+//
+
+#ifndef __qtip__model_io__
+#define __qtip__model_io__
+
+#include <stdio.h>
+#include <string.h>
+#include <cassert>
+#include <algorithm>
+#include <string>
+#include <vector>
+#include "ds.h"
+#include "template.h"
+#include "rnglib.hpp"
+
+/**
+ * A saved sample of input-model templates, one template per line as
+ * written by Template*::write(), along with the number of templates the
+ * sample was drawn from.
+ */
+struct SavedTemplates {
+
+	SavedTemplates() : n(0) { }
+
+	size_t n;
+	std::vector<std::string> lines;
+};
+
+/**
+ * Write reservoir-sampled templates, along with the number of templates
+ * sampled from, to a file.  Returns false if the file can't be written.
+ */
+template<typename T>
+bool save_templates(const char *fn, const ReservoirSampledEList<T>& r) {
+	FILE *fh = fopen(fn, "wb");
+	if(fh == NULL) {
+		return false;
+	}
+	fprintf(fh, "qtip-templates\t1\t%llu\n", (unsigned long long)r.size());
+	for(size_t i = 0; i < r.list().size(); i++) {
+		r.list()[i].write(fh);
+	}
+	bool ok = ferror(fh) == 0;
+	return fclose(fh) == 0 && ok;
+}
+
+/**
+ * Read a file written by save_templates.  Returns false if the file can't
+ * be read or isn't in the expected format.
+ */
+bool load_templates(const char *fn, SavedTemplates& s);
+
+/**
+ * Replace the contents of dst with a uniform sample, of up to dst.k()
+ * templates, of the union of the populations the saved samples were drawn
+ * from.  Each template is drawn from a source with probability proportional
+ * to the number of that source's population not yet drawn, i.e. sampling
+ * without replacement from the union.  Uses the global RNG.  Returns false
+ * if a template can't be parsed.
+ */
+template<typename T>
+bool merge_templates(std::vector<SavedTemplates>& srcs, ReservoirSampledEList<T>& dst) {
+	dst.list().clear();
+	size_t tot = 0;
+	std::vector<size_t> remaining(srcs.size());
+	for(size_t i = 0; i < srcs.size(); i++) {
+		assert(srcs[i].lines.size() <= srcs[i].n);
+		remaining[i] = srcs[i].lines.empty() ? 0 : srcs[i].n;
+		tot += srcs[i].n;
+	}
+	size_t left = 0;
+	for(size_t i = 0; i < srcs.size(); i++) {
+		left += remaining[i];
+	}
+	std::vector<char> buf;
+	while(left > 0 && dst.list().size() < dst.k()) {
+		size_t r = std::min((size_t)(r4_uni_01() * left), left-1);
+		size_t i = 0;
+		while(r >= remaining[i]) {
+			r -= remaining[i++];
+		}
+		// pick one of the source's sampled templates not yet taken
+		std::vector<std::string>& lines = srcs[i].lines;
+		size_t j = std::min((size_t)(r4_uni_01() * lines.size()), lines.size()-1);
+		buf.assign(lines[j].begin(), lines[j].end());
+		buf.push_back('\0');
+		std::swap(lines[j], lines.back());
+		lines.pop_back();
+		if(!dst.list()[dst.add_sampled()].parse(&buf[0])) {
+			return false;
+		}
+		remaining[i]--;
+		left--;
+		if(lines.empty()) {
+			// sample smaller than population and exhausted
+			left -= remaining[i];
+			remaining[i] = 0;
+		}
+	}
+	dst.set_size(tot);
+	return true;
+}
+
+#endif /* defined(__qtip__model_io__) */
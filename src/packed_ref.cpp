@@ -0,0 +1,255 @@
+//
+//  packed_ref.cpp
+//  qtip
+//
+
+#include "packed_ref.h"
+#include "fasta.h"
+#include <stdio.h>
+#include <string.h>
+#include <stdlib.h>
+#include <ctype.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <zlib.h>
+#include <cassert>
+#include <algorithm>
+#include <iostream>
+#include <sstream>
+#include <vector>
+
+using namespace std;
+
+static const char *PACKED_REF_MAGIC = "QTIPREF1";
+static const size_t PACKED_REF_CRC_BYTES = 65536;
+
+/**
+ * CRC32 of n bytes of fh starting at off.
+ */
+static bool crc_range(FILE *fh, off_t off, size_t n, uint32_t& crc) {
+	vector<unsigned char> buf(n);
+	if(fseeko(fh, off, SEEK_SET) != 0 || fread(n > 0 ? &buf[0] : NULL, 1, n, fh) != n) {
+		return false;
+	}
+	crc = (uint32_t)crc32(crc32(0L, Z_NULL, 0), n > 0 ? &buf[0] : Z_NULL, (uInt)n);
+	return true;
+}
+
+bool PackedRef::fasta_key(const string& fasta_fn, PackedRefHeader& h) {
+	struct stat st;
+	if(stat(fasta_fn.c_str(), &st) != 0) {
+		return false;
+	}
+	h.fasta_size = (uint64_t)st.st_size;
+	h.fasta_mtime = (int64_t)st.st_mtime;
+	FILE *fh = fopen(fasta_fn.c_str(), "rb");
+	if(fh == NULL) {
+		return false;
+	}
+	size_t n = (size_t)min((uint64_t)PACKED_REF_CRC_BYTES, h.fasta_size);
+	bool ok = crc_range(fh, 0, n, h.crc_head) &&
+	          crc_range(fh, (off_t)(h.fasta_size - n), n, h.crc_tail);
+	fclose(fh);
+	return ok;
+}
+
+bool PackedRef::build(const string& fasta_fn, const string& ref_fn) {
+	PackedRefHeader h;
+	memset(&h, 0, sizeof(h));
+	memcpy(h.magic, PACKED_REF_MAGIC, 8);
+	if(!fasta_key(fasta_fn, h)) {
+		cerr << "Could not read FASTA file \"" << fasta_fn << "\"" << endl;
+		return false;
+	}
+	FILE *fh = fopen(fasta_fn.c_str(), "rb");
+	if(fh == NULL) {
+		cerr << "Could not open FASTA file \"" << fasta_fn << "\"" << endl;
+		return false;
+	}
+	ostringstream tmp;
+	tmp << ref_fn << ".tmp." << getpid();
+	const string tmp_fn = tmp.str();
+	FILE *ofh = fopen(tmp_fn.c_str(), "wb");
+	if(ofh == NULL) {
+		fclose(fh);
+		return false;
+	}
+	vector<char> ibuf(1 << 16), obuf(1 << 16);
+	setvbuf(fh, &ibuf[0], _IOFBF, ibuf.size());
+	setvbuf(ofh, &obuf[0], _IOFBF, obuf.size());
+	fwrite(&h, sizeof(h), 1, ofh); // rewritten at the end
+
+	// Same rules as FastaChunkwiseParser::next()
+	vector<PackedRefRecord> recs;
+	vector<PackedRefRun> runs;
+	string names;
+	unsigned char cur = 0;
+	uint64_t nbases = 0;
+	int c;
+	while((c = getc_unlocked(fh)) != EOF) {
+		if(c == '>' || (recs.empty() && !isspace(c))) {
+			PackedRefRecord r;
+			memset(&r, 0, sizeof(r));
+			r.name_off = names.size();
+			r.base_off = nbases;
+			r.run_off = runs.size();
+			recs.push_back(r);
+			if(c == '>') {
+				while((c = getc_unlocked(fh)) != EOF && c != '\n' && c != '\r') {
+					names.push_back((char)c);
+				}
+			}
+			names.push_back('\0');
+			if(c == EOF || isspace(c)) {
+				continue;
+			}
+		}
+		if(isspace(c)) {
+			continue;
+		}
+		PackedRefRecord& r = recs.back();
+		int b = dna_upper[c];
+		unsigned char code = 0;
+		if(b == 'N') {
+			if(r.nruns > 0 && runs.back().start + runs.back().len == r.len) {
+				runs.back().len++;
+			} else {
+				PackedRefRun run;
+				run.start = r.len;
+				run.len = 1;
+				runs.push_back(run);
+				r.nruns++;
+			}
+		} else {
+			code = (b == 'A') ? 0 : ((b == 'C') ? 1 : ((b == 'G') ? 2 : 3));
+		}
+		cur |= (unsigned char)(code << ((nbases & 3) << 1));
+		nbases++;
+		r.len++;
+		if((nbases & 3) == 0) {
+			putc_unlocked(cur, ofh);
+			cur = 0;
+		}
+	}
+	bool ok = ferror(fh) == 0;
+	fclose(fh);
+	if((nbases & 3) != 0) {
+		putc_unlocked(cur, ofh);
+	}
+	uint64_t off = sizeof(h) + (nbases + 3) / 4;
+	while((off & 7) != 0) {
+		putc_unlocked(0, ofh);
+		off++;
+	}
+	h.nrecs = recs.size();
+	h.nruns = runs.size();
+	h.nbases = nbases;
+	h.names_size = names.size();
+	h.recs_off = off;
+	h.runs_off = h.recs_off + recs.size() * sizeof(PackedRefRecord);
+	h.names_off = h.runs_off + runs.size() * sizeof(PackedRefRun);
+	if(!recs.empty()) {
+		fwrite(&recs[0], sizeof(PackedRefRecord), recs.size(), ofh);
+	}
+	if(!runs.empty()) {
+		fwrite(&runs[0], sizeof(PackedRefRun), runs.size(), ofh);
+	}
+	fwrite(names.data(), 1, names.size(), ofh);
+	ok = ok && fseeko(ofh, 0, SEEK_SET) == 0 && fwrite(&h, sizeof(h), 1, ofh) == 1;
+	ok = ok && ferror(ofh) == 0;
+	ok = (fclose(ofh) == 0) && ok;
+	ok = ok && rename(tmp_fn.c_str(), ref_fn.c_str()) == 0;
+	if(!ok) {
+		remove(tmp_fn.c_str());
+	}
+	return ok;
+}
+
+bool PackedRef::open(const string& ref_fn, const string& fasta_fn) {
+	close();
+	int fd = ::open(ref_fn.c_str(), O_RDONLY);
+	if(fd < 0) {
+		return false;
+	}
+	struct stat st;
+	if(fstat(fd, &st) != 0 || (size_t)st.st_size < sizeof(PackedRefHeader)) {
+		::close(fd);
+		return false;
+	}
+	void *p = mmap(NULL, (size_t)st.st_size, PROT_READ, MAP_SHARED, fd, 0);
+	::close(fd);
+	if(p == MAP_FAILED) {
+		return false;
+	}
+	base_ = (char *)p;
+	size_ = (size_t)st.st_size;
+	hdr_ = (const PackedRefHeader *)base_;
+	PackedRefHeader key;
+	const PackedRefHeader& h = *hdr_;
+	bool ok = memcmp(h.magic, PACKED_REF_MAGIC, 8) == 0 &&
+	          fasta_key(fasta_fn, key) &&
+	          key.fasta_size == h.fasta_size &&
+	          key.fasta_mtime == h.fasta_mtime &&
+	          key.crc_head == h.crc_head &&
+	          key.crc_tail == h.crc_tail &&
+	          sizeof(h) + (h.nbases + 3) / 4 <= h.recs_off &&
+	          h.recs_off + h.nrecs * sizeof(PackedRefRecord) == h.runs_off &&
+	          h.runs_off + h.nruns * sizeof(PackedRefRun) == h.names_off &&
+	          h.names_off + h.names_size == size_;
+	if(!ok) {
+		close();
+		return false;
+	}
+	bases_ = (const unsigned char *)(base_ + sizeof(h));
+	recs_ = (const PackedRefRecord *)(base_ + h.recs_off);
+	runs_ = (const PackedRefRun *)(base_ + h.runs_off);
+	names_ = base_ + h.names_off;
+	return true;
+}
+
+bool PackedRef::open_cached(const string& fasta_fn) {
+	const string fn = cache_fn(fasta_fn);
+	if(open(fn, fasta_fn)) {
+		return true;
+	}
+	cerr << "Packing FASTA file \"" << fasta_fn << "\" into \"" << fn << "\"" << endl;
+	if(!build(fasta_fn, fn) || !open(fn, fasta_fn)) {
+		cerr << "Could not write packed reference \"" << fn
+		     << "\"; reading FASTA file instead" << endl;
+		return false;
+	}
+	return true;
+}
+
+void PackedRef::close() {
+	if(base_ != NULL) {
+		munmap(base_, size_);
+		base_ = NULL;
+		size_ = 0;
+		hdr_ = NULL;
+	}
+}
+
+static bool run_ends_before(const PackedRefRun& run, uint64_t off) {
+	return run.start + run.len <= off;
+}
+
+void PackedRef::decode(size_t i, size_t off, size_t len, char *dst) const {
+	const PackedRefRecord& r = recs_[i];
+	assert(off + len <= r.len);
+	uint64_t b = r.base_off + off;
+	for(size_t j = 0; j < len; j++, b++) {
+		dst[j] = "ACGT"[(bases_[b >> 2] >> ((b & 3) << 1)) & 3];
+	}
+	const PackedRefRun *run = lower_bound(runs_ + r.run_off,
+	                                      runs_ + r.run_off + r.nruns,
+	                                      (uint64_t)off, run_ends_before);
+	const PackedRefRun *end = runs_ + r.run_off + r.nruns;
+	for(; run != end && run->start < off + len; run++) {
+		size_t st = (size_t)max(run->start, (uint64_t)off);
+		size_t en = (size_t)min(run->start + run->len, (uint64_t)(off + len));
+		memset(dst + (st - off), 'N', en - st);
+	}
+}
@@ -0,0 +1,131 @@
+//
+//  packed_ref.h
+//  qtip
+//
+
+#ifndef __qtip__packed_ref__
+#define __qtip__packed_ref__
+
+#include <stdint.h>
+#include <string>
+
+/**
+ * Start of a packed reference file.  Followed by the packed bases, 4 per
+ * byte, then the record index, the runs of Ns, and the NUL-terminated
+ * record names.
+ */
+struct PackedRefHeader {
+	char magic[8];        // "QTIPREF1"
+	uint64_t fasta_size;  // FASTA it was built from: size,
+	int64_t fasta_mtime;  // modification time,
+	uint32_t crc_head;    // and CRC32s of its first
+	uint32_t crc_tail;    // and last PACKED_REF_CRC_BYTES bytes
+	uint64_t nrecs;
+	uint64_t nruns;
+	uint64_t nbases;
+	uint64_t names_size;
+	uint64_t recs_off;    // byte offsets of the sections
+	uint64_t runs_off;
+	uint64_t names_off;
+};
+
+struct PackedRefRecord {
+	uint64_t name_off; // into names
+	uint64_t len;      // bases
+	uint64_t base_off; // index of first base among all packed bases
+	uint64_t run_off;  // index of first run of Ns
+	uint64_t nruns;    // runs of Ns in this record
+};
+
+struct PackedRefRun {
+	uint64_t start; // offset into record
+	uint64_t len;
+};
+
+/**
+ * The sequences of a FASTA file, as FastaChunkwiseParser reads them (upper
+ * case, with anything other than A, C, G and T as N), packed 2 bits per base
+ * with runs of Ns stored separately, plus an index of the records.  Built
+ * once and cached beside the FASTA; later runs memory-map it, so it loads
+ * quickly and is shared by concurrent processes through the page cache.
+ * The cache is keyed by the FASTA's size and modification time and
+ * checksums of its first and last bytes.
+ */
+class PackedRef {
+
+public:
+
+	PackedRef() : base_(NULL), size_(0), hdr_(NULL) { }
+
+	~PackedRef() {
+		close();
+	}
+
+	/**
+	 * Pack fasta_fn into ref_fn, writing a temporary file and renaming it
+	 * into place so readers never see a partial file.  Returns false if
+	 * the FASTA can't be read or ref_fn can't be written.
+	 */
+	static bool build(const std::string& fasta_fn, const std::string& ref_fn);
+
+	/**
+	 * Map ref_fn.  Returns false if it's missing, malformed, or wasn't built
+	 * from fasta_fn as it is now.
+	 */
+	bool open(const std::string& ref_fn, const std::string& fasta_fn);
+
+	/**
+	 * Open the cached copy of fasta_fn, building it first if it's missing or
+	 * stale.  Returns false if it can't be built; the caller should read the
+	 * FASTA instead.
+	 */
+	bool open_cached(const std::string& fasta_fn);
+
+	void close();
+
+	bool is_open() const {
+		return base_ != NULL;
+	}
+
+	static std::string cache_fn(const std::string& fasta_fn) {
+		return fasta_fn + ".qtipref";
+	}
+
+	size_t num_records() const {
+		return (size_t)hdr_->nrecs;
+	}
+
+	/**
+	 * Return record's name line, without the '>'.
+	 */
+	const char *name(size_t i) const {
+		return names_ + recs_[i].name_off;
+	}
+
+	size_t length(size_t i) const {
+		return (size_t)recs_[i].len;
+	}
+
+	/**
+	 * Write bases [off, off+len) of record i to dst.
+	 */
+	void decode(size_t i, size_t off, size_t len, char *dst) const;
+
+protected:
+
+	/**
+	 * Fill in the FASTA-derived key fields of a header.  Returns false if
+	 * the FASTA can't be read.
+	 */
+	static bool fasta_key(const std::string& fasta_fn, PackedRefHeader& h);
+
+	char *base_;   // mapped file
+	size_t size_;  // size of mapped file
+	const PackedRefHeader *hdr_;
+	const unsigned char *bases_;
+	const PackedRefRecord *recs_;
+	const PackedRefRun *runs_;
+	const char *names_;
+};
+
+#endif /* defined(__qtip__packed_ref__) */
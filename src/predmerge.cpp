@@ -1,32 +1,84 @@
 #include "predmerge.h"
 #include <iostream>
+#include <algorithm>
 #include <cassert>
 #include <stdio.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
 
 using namespace std;
 
-#define BUFSZ (64 * 1024)
+#define BLOCK_PREDS (64 * 1024) // predictions per block read from unmapped files; 1 MB
 
 /**
  * Construct new prediction merger; open files and read first prediction from
  * each.
  */
-PredictionMerger::PredictionMerger(const vector<string>& in_fns) :
-    in_fns_(in_fns), next_(-1)
-{
-    in_.resize(in_fns.size(), NULL);
-    bufs_.resize(in_fns.size());
-    preds_.resize(in_fns.size());
-    done_.resize(in_fns.size(), false);
-    for(size_t i = 0; i < in_fns.size(); i++) {
-        in_[i] = fopen(in_fns[i].c_str(), "rb");
-        bufs_[i].resize(BUFSZ);
+PredictionMerger::PredictionMerger(const vector<string>& in_fns) : next_(-1) {
+    PredictionSources srcs;
+    srcs.fns = in_fns;
+    init(srcs);
+}
+
+/**
+ * Construct new prediction merger over files and in-memory arrays; read
+ * first prediction from each.
+ */
+PredictionMerger::PredictionMerger(const PredictionSources& srcs) : next_(-1) {
+    init(srcs);
+}
+
+/**
+ * Open files, set up arrays and read first prediction from each.  Empty
+ * arrays are left out.
+ */
+void PredictionMerger::init(const PredictionSources& srcs) {
+    in_fns_ = srcs.fns;
+    for(size_t i = 0; i < srcs.bufs.size(); i++) {
+        if(srcs.lens[i] > 0) {
+            in_fns_.push_back("<memory>");
+        }
+    }
+    const size_t n = in_fns_.size();
+    in_.resize(n, NULL);
+    maps_.resize(n, NULL);
+    map_size_.resize(n, 0);
+    map_off_.resize(n, 0);
+    bufs_.resize(n);
+    block_.resize(n, NULL);
+    block_off_.resize(n, 0);
+    block_len_.resize(n, 0);
+    preds_.resize(n);
+    done_.resize(n, false);
+    heap_.reserve(n);
+    for(size_t i = 0; i < srcs.fns.size(); i++) {
+        if(in_fns_[i] == "-") {
+            in_[i] = stdin; // predictions streamed from the driver
+        } else {
+            in_[i] = fopen(in_fns_[i].c_str(), "rb");
+        }
         if(in_[i] == NULL) {
-			cerr << "Could not open output file \"" << in_fns[i] << "\"" << endl;
+			cerr << "Could not open output file \"" << in_fns_[i] << "\"" << endl;
             throw 1;
         }
-        setvbuf(in_[i], &(bufs_[i][0]), _IOFBF, BUFSZ);
-        advanceFile(i);
+        if(!mapFile(i)) {
+            // blocks are read straight into bufs_, so stdio needn't buffer
+            setvbuf(in_[i], NULL, _IONBF, 0);
+            bufs_[i].resize(2 * BLOCK_PREDS);
+        }
+    }
+    for(size_t i = 0, j = srcs.fns.size(); i < srcs.bufs.size(); i++) {
+        if(srcs.lens[i] > 0) {
+            // never written through; only read like a mapped file
+            maps_[j] = (char *)srcs.bufs[i];
+            map_size_[j] = srcs.lens[i] * 16;
+            j++;
+        }
+    }
+    for(size_t i = 0; i < n; i++) {
+        if(advanceFile(i)) {
+            pushFile(i);
+        }
     }
 }
 
@@ -35,6 +87,10 @@ PredictionMerger::PredictionMerger(const vector<string>& in_fns) :
  */
 PredictionMerger::~PredictionMerger() {
 	for(size_t i = 0; i < in_.size(); i++) {
+		if(maps_[i] != NULL && in_[i] != NULL) {
+			munmap(maps_[i], map_size_[i]);
+			maps_[i] = NULL;
+		}
 		if(in_[i] != NULL) {
 			fclose(in_[i]);
 		}
@@ -42,51 +98,158 @@ PredictionMerger::~PredictionMerger() {
 	}
 }
 
+/**
+ * Map file i if it's a non-empty regular file.  Returns false if it should
+ * be read instead.
+ */
+bool PredictionMerger::mapFile(size_t i) {
+    const size_t recsz = 16;
+    struct stat st;
+    if(in_[i] == stdin || fstat(fileno(in_[i]), &st) != 0 ||
+       !S_ISREG(st.st_mode) || st.st_size == 0)
+    {
+        return false;
+    }
+    if((size_t)st.st_size % recsz != 0) {
+        cerr << "Prediction file \"" << in_fns_[i] << "\" ends partway through a prediction" << endl;
+        throw 1;
+    }
+    void *p = mmap(NULL, (size_t)st.st_size, PROT_READ, MAP_PRIVATE, fileno(in_[i]), 0);
+    if(p == MAP_FAILED) {
+        return false;
+    }
+    madvise(p, (size_t)st.st_size, MADV_SEQUENTIAL);
+    maps_[i] = (char *)p;
+    map_size_[i] = (size_t)st.st_size;
+    map_off_[i] = 0;
+    return true;
+}
+
+/**
+ * Add file i, which has a prediction ready, to the heap.
+ */
+void PredictionMerger::pushFile(size_t i) {
+    assert(!done_[i]);
+    heap_.push_back(PredictionHeapEntry(preds_[i].line, i));
+    push_heap(heap_.begin(), heap_.end());
+}
+
 /**
  * Get and return next prediction.
  */
 Prediction PredictionMerger::next() {
+    size_t i = 0;
     if(next_ >= 0) {
         // Next file is known
-        Prediction next_pred = preds_[next_];
-        if(!advanceFile(next_)) {
-			assert(preds_[next_].line >= next_pred.line);
-			if(preds_[next_].line != next_pred.line + 1) {
-				next_ = -1;
-			}
-		}
-        return next_pred;
+        i = (size_t)next_;
     } else {
-        // Next file not known; have to check
-        assert(next_ == -1);
-        unsigned long long min_line = numeric_limits<unsigned long long>::max();
-        int argmin = -1;
-        const size_t insz = in_.size();
-        for(size_t i = 0; i < insz; i++) {
-            if(!done_[i]) {
-                assert(preds_[i].valid());
-                assert(preds_[i].line != numeric_limits<unsigned long long>::max());
-                assert(preds_[i].line != min_line);
-                if(preds_[i].line < min_line) {
-                    argmin = (int)i;
-                    min_line = preds_[i].line;
+        // Next file not known; take the one with the least line
+        if(heap_.empty()) {
+            // All input files exhausted
+            return Prediction();
+        }
+        pop_heap(heap_.begin(), heap_.end());
+        i = heap_.back().file;
+        heap_.pop_back();
+    }
+    Prediction next_pred = preds_[i];
+    next_ = -1;
+    if(advanceFile(i)) {
+        assert(preds_[i].line > next_pred.line);
+        if(preds_[i].line == next_pred.line + 1) {
+            // no other file can have the very next line
+            next_ = (int)i;
+        } else {
+            pushFile(i);
+        }
+    }
+    return next_pred;
+}
+
+/**
+ * Binary search each file, with its fixed-size (line, mapq) records, for the
+ * first prediction at or after the given line.
+ */
+bool PredictionMerger::seek(unsigned long long line) {
+    const off_t recsz = 16;
+    for(size_t i = 0; i < in_.size(); i++) {
+        done_[i] = false;
+        block_off_[i] = block_len_[i] = 0;
+        if(maps_[i] != NULL) {
+            const double *recs = (const double *)maps_[i];
+            size_t lo = 0, hi = map_size_[i] / recsz;
+            while(lo < hi) {
+                size_t mid = lo + (hi - lo) / 2;
+                if((unsigned long long)recs[2 * mid] < line) {
+                    lo = mid + 1;
+                } else {
+                    hi = mid;
                 }
             }
+            map_off_[i] = lo;
+            continue;
         }
-        if(argmin == -1) {
-            // All input files exhausted
-            return Prediction();
+        if(in_fns_[i] == "-" || fseeko(in_[i], 0, SEEK_END) != 0) {
+            return false;
+        }
+        off_t lo = 0, hi = ftello(in_[i]) / recsz;
+        while(lo < hi) {
+            off_t mid = lo + (hi - lo) / 2;
+            double mid_line = 0.0;
+            if(fseeko(in_[i], mid * recsz, SEEK_SET) != 0 ||
+               fread(&mid_line, 8, 1, in_[i]) != 1)
+            {
+                cerr << "Could not read prediction file \"" << in_fns_[i] << "\" while seeking" << endl;
+                throw 1;
+            }
+            if((unsigned long long)mid_line < line) {
+                lo = mid + 1;
+            } else {
+                hi = mid;
+            }
         }
-        Prediction next_pred = preds_[argmin];
-        if(!done_[argmin]) {
-            if(!advanceFile(argmin)) {
-				if(preds_[argmin].line == next_pred.line + 1) {
-					next_ = argmin;
-				}
-			}
+        if(fseeko(in_[i], lo * recsz, SEEK_SET) != 0) {
+            return false;
         }
-        return next_pred;
+        clearerr(in_[i]);
     }
+    heap_.clear();
+    next_ = -1;
+    for(size_t i = 0; i < in_.size(); i++) {
+        if(advanceFile(i)) {
+            pushFile(i);
+        }
+    }
+    return true;
+}
+
+/**
+ * Make the next block of predictions from one of the files current; for a
+ * mapped file that's the rest of the file.  Returns false if there are none
+ * left.
+ */
+bool PredictionMerger::fillBlock(size_t i) {
+    const size_t recsz = 16;
+    block_off_[i] = 0;
+    if(maps_[i] != NULL) {
+        block_[i] = (const double *)maps_[i] + 2 * map_off_[i];
+        block_len_[i] = map_size_[i] / recsz - map_off_[i];
+        map_off_[i] += block_len_[i];
+        return block_len_[i] > 0;
+    }
+    block_[i] = &bufs_[i][0];
+    char *buf = (char *)&bufs_[i][0];
+    size_t nbytes = fread(buf, 1, BLOCK_PREDS * recsz, in_[i]);
+    if(nbytes < BLOCK_PREDS * recsz && ferror(in_[i])) {
+        cerr << "Could not read prediction file \"" << in_fns_[i] << "\"" << endl;
+        throw 1;
+    }
+    if(nbytes % recsz != 0) {
+        cerr << "Prediction file \"" << in_fns_[i] << "\" ends partway through a prediction" << endl;
+        throw 1;
+    }
+    block_len_[i] = nbytes / recsz;
+    return block_len_[i] > 0;
 }
 
 /**
@@ -94,28 +257,16 @@ Prediction PredictionMerger::next() {
  */
 bool PredictionMerger::advanceFile(size_t i) {
     assert(!done_[i]);
-    assert(!feof(in_[i]));
-    double line = 0.0, mapq = 0.0;
-    size_t ret = fread(&line, 8, 1, in_[i]);
-	if(ret == 0 && feof(in_[i])) {
+    if(block_off_[i] == block_len_[i] && !fillBlock(i)) {
 		done_[i] = true;
 		preds_[i].reset();
 		return false;
-	}
-    if(ret != 1) {
-        cerr << "Could not read line id from prediction file \"" << in_fns_[i] << "\"; read " << ret << " items" << endl;
-        throw 1;
     }
-    assert(!feof(in_[i]));
-    ret = fread(&mapq, 8, 1, in_[i]);
-    if(ret != 1) {
-        cerr << "Could not read MAPQ from prediction file \"" << in_fns_[i] << "\"; read " << ret << " items" << endl;
-        throw 1;
-    }
-    preds_[i].line = (unsigned long long)line;
-    preds_[i].mapq = mapq;
-    assert(mapq >= 0.0);
-    assert(mapq <= 100.0);
+    const double *rec = block_[i] + 2 * block_off_[i]++;
+    preds_[i].line = (unsigned long long)rec[0];
+    preds_[i].mapq = rec[1];
+    assert(preds_[i].mapq >= 0.0);
+    assert(preds_[i].mapq <= 100.0);
     return true;
 }
 
@@ -176,6 +327,15 @@ static void write_file_c(string fn) {
 	fclose(fh);
 }
 
+/**
+ * Remove a test's scratch files.
+ */
+static void remove_all(const vector<string>& fns) {
+    for(size_t i = 0; i < fns.size(); i++) {
+        remove(fns[i].c_str());
+    }
+}
+
 static void test1() {
     string fn(".predmerge.test1.npy");
     write_file_a(fn);
@@ -200,6 +360,7 @@ static void test1() {
     assert(pred.mapq == 1.0);
     pred = m.next();
     assert(!pred.valid());
+    remove_all(fns);
 }
 
 static void test2() {
@@ -247,6 +408,7 @@ static void test2() {
     assert(pred.mapq == 18.0);
     pred = m.next();
     assert(!pred.valid());
+    remove_all(fns);
 }
 
 static void test3() {
@@ -309,12 +471,176 @@ static void test3() {
     assert(pred.mapq == 18.0);
     pred = m.next();
     assert(!pred.valid());
+    remove_all(fns);
+}
+
+static void test4() {
+    string fn_a(".predmerge.test4.1.npy");
+    string fn_b(".predmerge.test4.2.npy");
+    string fn_c(".predmerge.test4.3.npy");
+	write_file_a(fn_a);
+	write_file_b(fn_b);
+	write_file_c(fn_c);
+
+    vector<string> fns;
+    fns.push_back(fn_a);
+    fns.push_back(fn_b);
+    fns.push_back(fn_c);
+    PredictionMerger m(fns);
+    Prediction pred = m.next();
+    assert(pred.line == 0);
+    bool ret = m.seek(7);
+    assert(ret);
+    pred = m.next();
+    assert(pred.line == 7);
+    assert(pred.mapq == 13.0);
+    pred = m.next();
+    assert(pred.line == 8);
+    ret = m.seek(13);
+    assert(ret);
+    pred = m.next();
+    assert(pred.line == 14);
+    assert(pred.mapq == 17.0);
+    ret = m.seek(2);
+    assert(ret);
+    pred = m.next();
+    assert(pred.line == 2);
+    assert(pred.mapq == 20.0);
+    ret = m.seek(16);
+    assert(ret);
+    pred = m.next();
+    assert(!pred.valid());
+    remove_all(fns);
+}
+
+/**
+ * Many files, each with more predictions than fit in a block, with line
+ * numbers dealt out among them in runs of varying length.
+ */
+static void test5() {
+    const size_t nfiles = 37, npred = 200000;
+    vector<string> fns;
+    vector<FILE *> fhs;
+    for(size_t i = 0; i < nfiles; i++) {
+        char fn[64];
+        sprintf(fn, ".predmerge.test5.%d.npy", (int)i);
+        fns.push_back(string(fn));
+        fhs.push_back(fopen(fn, "wb"));
+        assert(fhs.back() != NULL);
+    }
+    size_t f = 0;
+    for(size_t line = 0; line < npred; line++) {
+        if(line % 7 == 0 || line % 11 == 0) {
+            f = (f * 31 + line) % nfiles;
+        }
+        write2_or_throw((double)line, (double)(line % 100), fhs[f]);
+    }
+    for(size_t i = 0; i < nfiles; i++) {
+        fclose(fhs[i]);
+    }
+    PredictionMerger m(fns);
+    for(size_t line = 0; line < npred; line++) {
+        Prediction pred = m.next();
+        assert(pred.line == line);
+        assert(pred.mapq == (double)(line % 100));
+    }
+    assert(!m.next().valid());
+    bool ret = m.seek(npred / 2 + 3);
+    assert(ret);
+    for(size_t line = npred / 2 + 3; line < npred; line++) {
+        Prediction pred = m.next();
+        assert(pred.line == line);
+    }
+    assert(!m.next().valid());
+    remove_all(fns);
+}
+
+/**
+ * Standard input, which is read in blocks rather than mapped, merged with a
+ * mapped file.
+ */
+static void test6() {
+    const size_t npred = 3 * BLOCK_PREDS + 17;
+    vector<string> fns;
+    fns.push_back(".predmerge.test6.1.npy");
+    fns.push_back(".predmerge.test6.2.npy");
+    FILE *fhs[2];
+    for(size_t i = 0; i < 2; i++) {
+        fhs[i] = fopen(fns[i].c_str(), "wb");
+        assert(fhs[i] != NULL);
+    }
+    for(size_t line = 0; line < npred; line++) {
+        write2_or_throw((double)line, (double)(line % 61), fhs[(line / 5) % 2]);
+    }
+    fclose(fhs[0]);
+    fclose(fhs[1]);
+    FILE *in = freopen(fns[0].c_str(), "rb", stdin);
+    assert(in != NULL);
+    vector<string> merge_fns;
+    merge_fns.push_back("-");
+    merge_fns.push_back(fns[1]);
+    PredictionMerger m(merge_fns);
+    for(size_t line = 0; line < npred; line++) {
+        Prediction pred = m.next();
+        assert(pred.line == line);
+        assert(pred.mapq == (double)(line % 61));
+    }
+    assert(!m.next().valid());
+    assert(!m.seek(5));
+    remove_all(fns);
+}
+
+/**
+ * Merge a file with in-memory arrays, one of them empty, and seek in them.
+ */
+static void test7() {
+    const size_t npred = 1000;
+    vector<string> fns;
+    fns.push_back(".predmerge.test7.npy");
+    FILE *fh = fopen(fns[0].c_str(), "wb");
+    assert(fh != NULL);
+    vector<double> a, b;
+    for(size_t line = 0; line < npred; line++) {
+        if(line % 3 == 0) {
+            write2_or_throw((double)line, (double)(line % 61), fh);
+        } else {
+            vector<double>& v = (line % 3 == 1) ? a : b;
+            v.push_back((double)line);
+            v.push_back((double)(line % 61));
+        }
+    }
+    fclose(fh);
+    PredictionSources srcs;
+    srcs.fns = fns;
+    srcs.bufs.push_back(&a[0]);
+    srcs.lens.push_back(a.size() / 2);
+    srcs.bufs.push_back(NULL);
+    srcs.lens.push_back(0);
+    srcs.bufs.push_back(&b[0]);
+    srcs.lens.push_back(b.size() / 2);
+    PredictionMerger m(srcs);
+    for(size_t line = 0; line < npred; line++) {
+        Prediction pred = m.next();
+        assert(pred.line == line);
+        assert(pred.mapq == (double)(line % 61));
+    }
+    assert(!m.next().valid());
+    assert(m.seek(500));
+    for(size_t line = 500; line < npred; line++) {
+        assert(m.next().line == line);
+    }
+    assert(!m.next().valid());
+    remove_all(fns);
 }
 
 int main(void) {
 	test1();
 	test2();
 	test3();
+	test4();
+	test5();
+	test6();
+	test7();
 	cout << "ALL TESTS PASSED" << endl;
 }
 #endif
@@ -26,27 +26,83 @@ struct Prediction {
     double mapq;
 };
 
+/**
+ * A file's next prediction line number, for the merge heap.
+ */
+struct PredictionHeapEntry {
+    PredictionHeapEntry(unsigned long long _line, size_t _file) : line(_line), file(_file) { }
+
+    // reversed, so that std heap functions make a min-heap
+    bool operator<(const PredictionHeapEntry& o) const {
+        return line > o.line;
+    }
+
+    unsigned long long line;
+    size_t file;
+};
+
+/**
+ * Where a PredictionMerger gets its predictions: files, each named by its
+ * path or "-" for standard input, and arrays of (line, mapq) pairs already
+ * in memory.  The arrays belong to the caller and must outlive the merger.
+ */
+struct PredictionSources {
+    std::vector<std::string> fns;
+    std::vector<const double *> bufs;
+    std::vector<size_t> lens;  // pairs in each of bufs
+};
+
 /**
  * Manages a collection of files, each with a series of predictions, in
  * ascending order by line number.  No line number should be repeated within
- * or across files.
+ * or across files.  A file name of "-" means predictions are read from
+ * standard input.  Regular files are memory-mapped; anything else is read
+ * in large blocks.  In-memory arrays are used in place, like mapped files.
+ * Files are merged with a min-heap on their next line
+ * numbers, so the cost per prediction grows only with the log of the number
+ * of files; runs of consecutive line numbers from one file skip the heap
+ * entirely.
  */
 class PredictionMerger {
 public:
     PredictionMerger(const std::vector<std::string>& in_fns);
+
+    PredictionMerger(const PredictionSources& srcs);
 	
 	~PredictionMerger();
 
     Prediction next();
 
+    /**
+     * Reposition every file so that the next prediction returned is the
+     * first with line >= the given line.  Returns false if any input is
+     * not seekable (e.g. standard input).
+     */
+    bool seek(unsigned long long line);
+
 private:
 
+    void init(const PredictionSources& srcs);
+
     bool advanceFile(size_t i);
 
-    const std::vector<std::string>& in_fns_;
-    std::vector<FILE *> in_;
-    std::vector<std::vector<char> > bufs_;
+    bool mapFile(size_t i);
+
+    bool fillBlock(size_t i);
+
+    void pushFile(size_t i);
+
+    std::vector<std::string> in_fns_;
+    std::vector<FILE *> in_;         // NULL for an in-memory array
+    std::vector<char *> maps_;       // mapped file or array, or NULL if it's read instead
+    std::vector<size_t> map_size_;   // bytes mapped
+    std::vector<size_t> map_off_;    // pair that the next block starts at
+    std::vector<std::vector<double> > bufs_; // blocks read from unmapped files
+    std::vector<const double *> block_;  // current block of (line, mapq) pairs
+    std::vector<size_t> block_off_;  // next pair in block
+    std::vector<size_t> block_len_;  // pairs in block
     std::vector<Prediction> preds_;
     std::vector<bool> done_;
+    std::vector<PredictionHeapEntry> heap_; // files besides next_ that aren't done
     int next_; // -1 if next is unknown, index of next file to read from otherwise
 };
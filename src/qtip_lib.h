@@ -0,0 +1,55 @@
+//
+//  qtip_lib.h
+//  qtip
+//
+
+/**
+ * C interface to libqtip, a shared library with the qtip-parse and
+ * qtip-rewrite engines, so the driver can run them in its own process
+ * (see native.py).  Each function takes the same command line as the
+ * corresponding tool, minus the program name.  Functions return 0 on
+ * success; errors are reported on standard error, as with the tools.
+ * Options are globals, so calls must not overlap.
+ */
+
+#ifndef __qtip__lib__
+#define __qtip__lib__
+
+#include <stddef.h>
+
+#define QTIP_EXPORT __attribute__((visibility("default")))
+
+// Tables kept by qtip_parse: feature records (raw doubles, row-major) for
+// each alignment category, then the .meta text describing each
+#define QTIP_NTABLES 8
+
+extern "C" {
+
+/**
+ * Run qtip-parse.  If keep_tables is non-zero, feature tables are kept in
+ * memory for qtip_parse_table rather than written under the record prefix.
+ */
+QTIP_EXPORT int qtip_parse(int argc, char **argv, int keep_tables);
+
+/**
+ * Get table i (0-3: u, b, c and d records; 4-7: their metadata) kept by the
+ * last qtip_parse.  *buf is NULL if the table wasn't written.  The buffer is
+ * valid until qtip_parse_free_tables or the next qtip_parse.
+ */
+QTIP_EXPORT int qtip_parse_table(int i, const char **buf, size_t *len);
+
+/**
+ * Free the tables kept by the last qtip_parse.
+ */
+QTIP_EXPORT void qtip_parse_free_tables(void);
+
+/**
+ * Run qtip-rewrite, taking predictions from the nbufs arrays of (line, mapq)
+ * pairs in bufs, with lens[i] pairs in bufs[i], as well as from any files on
+ * the command line.  The arrays are only read.
+ */
+QTIP_EXPORT int qtip_rewrite(int argc, char **argv, const double **bufs, const size_t *lens, int nbufs);
+
+}
+
+#endif /* defined(__qtip__lib__) */
@@ -13,6 +13,11 @@
 #include "input_model.h"
 #include "rnglib.hpp"
 #include "simplesim.h"
+#include "bgzf.h"
+#include "model_io.h"
+#ifdef QTIP_LIB
+#include "qtip_lib.h"
+#endif
 
 using namespace std;
 
@@ -70,7 +75,9 @@ using namespace std;
 /**
  * Implementations of the various passes that qtip makes over SAM files.
  *
- * NOTE: uses strtok so not multithreaded.
+ * Tokenizing uses strtok_r, and featurizing functions keep their state in
+ * arguments rather than globals, so that blocks of alignments can be
+ * featurized by several threads at once; see sam_pass1.
  */
 
 /* 64K buffer for all input and output */
@@ -190,7 +197,8 @@ struct Alignment {
 	 */
 	char * parse_extra(char *extra) {
 		char *ztz = NULL;
-		extra = strtok(extra, "\t");
+		char *save = NULL;
+		extra = strtok_r(extra, "\t", &save);
 		bool found_ztz = false, found_mdz = false;
 		while(extra != NULL && (!found_mdz || !found_ztz)) {
 			if(strncmp(extra, "ZT:Z:", 5) == 0) {
@@ -203,7 +211,7 @@ struct Alignment {
 				mdz_to_list();
 				found_mdz = true;
 			}
-			extra = strtok(NULL, "\t");
+			extra = strtok_r(NULL, "\t", &save);
 		}
 		if(cigar != NULL && mdz != NULL && !cigar_equal_x) {
 			cigar_and_mdz_to_edit_xscript();
@@ -755,38 +763,34 @@ struct Alignment {
 };
 
 /**
- * strtok already used to parse up to rname.  Parse the rest and return char *
+ * Fields up to rname were already parsed.  Parse the rest and return char *
  * to the extra flags.
- *
- * This function uses strtok so it will interrrupt any strtoks already in
- * progress.  But when it returns, it's finished with its stateful strtok
- * session, so there's nothing keeping the caller from starting another
- * strtok.
  */
 static char * parse_from_rname_on(Alignment& al) {
 	assert(al.rest_of_line != NULL);
-	al.rname = strtok(al.rest_of_line, "\t"); assert(al.rname != NULL);
-	char *pos_str = strtok(NULL, "\t"); assert(pos_str != NULL);
+	char *save = NULL;
+	al.rname = strtok_r(al.rest_of_line, "\t", &save); assert(al.rname != NULL);
+	char *pos_str = strtok_r(NULL, "\t", &save); assert(pos_str != NULL);
 	al.pos = (size_t)atoll(pos_str);
-	char *mapq_str = strtok(NULL, "\t"); assert(mapq_str != NULL);
+	char *mapq_str = strtok_r(NULL, "\t", &save); assert(mapq_str != NULL);
 	al.mapq = atoi(mapq_str);
 	assert(al.mapq < 256);
 
 	// sets cigar_ops, cigar_run
 	// if CIGAR string uses = and X, then also sets edit transcript
-	al.cigar = strtok(NULL, "\t");
+	al.cigar = strtok_r(NULL, "\t", &save);
 	assert(al.cigar != NULL);
 	al.parse_cigar();
 
-	al.rnext = strtok(NULL, "\t"); assert(al.rnext != NULL);
-	char *pnext_str = strtok(NULL, "\t"); assert(pnext_str != NULL);
+	al.rnext = strtok_r(NULL, "\t", &save); assert(al.rnext != NULL);
+	char *pnext_str = strtok_r(NULL, "\t", &save); assert(pnext_str != NULL);
 	al.pnext = atoi(pnext_str);
-	strtok(NULL, "\t"); // ignore tlen
-	al.seq = strtok(NULL, "\t"); assert(al.seq != NULL);
+	strtok_r(NULL, "\t", &save); // ignore tlen
+	al.seq = strtok_r(NULL, "\t", &save); assert(al.seq != NULL);
 	al.len = strlen(al.seq);
 
 	// sets qual, avg_aligned_qual and avg_clipped_qual
-	al.qual = strtok(NULL, "\t");
+	al.qual = strtok_r(NULL, "\t", &save);
 	assert(al.qual != NULL);
 	al.calc_qual_averages();
 
@@ -794,29 +798,65 @@ static char * parse_from_rname_on(Alignment& al) {
 	return al.rest_of_line;
 }
 
-int wiggle = 30;
-int input_model_size = std::numeric_limits<int>::max();
-float fraction_even = 1.0f;
-float low_score_bias = 1.0f;
-int max_allowed_fraglen = 50000;
-float sim_factor = 30.0f;
-int sim_function = FUNC_SQRT;
-int sim_unp_min = 30000;
-int sim_conc_min = 30000;
-int sim_disc_min = 10000;
-int sim_bad_end_min = 10000;
+int wiggle;
+int input_model_size;
+float fraction_even;
+float low_score_bias;
+int max_allowed_fraglen;
+float sim_factor;
+int sim_function;
+int sim_unp_min;
+int sim_conc_min;
+int sim_disc_min;
+int sim_bad_end_min;
+float sim_fraction;           // scales # reads to simulate in each category
+string sim_categories;        // categories to simulate
+int decompress_threads;
+int parse_threads;            // threads featurizing and simulating
+bool ref_cache;               // simulate from packed copies of FASTAs
+size_t line_offset;           // added to line numbers, for a shard of a SAM
+long long input_start;        // byte offset where parsing starts
+long long input_end;          // byte offset where parsing stops; -1 = EOF
 
-vector<double> write_buf;
+/**
+ * Set options to their defaults, before the command line is parsed; options
+ * are globals and libqtip may run several times in one process.
+ */
+static void set_default_options() {
+	wiggle = 30;
+	input_model_size = std::numeric_limits<int>::max();
+	fraction_even = 1.0f;
+	low_score_bias = 1.0f;
+	max_allowed_fraglen = 50000;
+	sim_factor = 30.0f;
+	sim_function = FUNC_SQRT;
+	sim_unp_min = 30000;
+	sim_conc_min = 30000;
+	sim_disc_min = 10000;
+	sim_bad_end_min = 10000;
+	sim_fraction = 1.0f;
+	sim_categories = "ubcd";
+	decompress_threads = 1;
+	parse_threads = 1;
+	ref_cache = true;
+	line_offset = 0;
+	input_start = 0;
+	input_end = -1;
+}
 
 /**
- * No guarantee about state of strtok upon return.
+ * Featurize an unpaired alignment, or the aligned end of a bad-end pair,
+ * appending its feature record to recs (if not NULL).  Its input-model
+ * template is offered to unp_model, or, when featurizing out of input order,
+ * appended to unp_cands to be offered later.
  */
-static int print_unpaired(
+static void print_unpaired(
 	Alignment& al, // already parsed up through flags
 	size_t ordlen,
 	FILE *fh_model,
-	FILE *fh_recs,
-	ReservoirSampledEList<TemplateUnpaired> *unp_model)
+	vector<double> *recs,
+	ReservoirSampledEList<TemplateUnpaired> *unp_model,
+	EList<TemplateUnpaired> *unp_cands)
 {
 	assert(al.is_aligned());
 	char *extra = parse_from_rname_on(al);
@@ -828,7 +868,8 @@ static int print_unpaired(
 		     << " required for use with qtip." << endl;
 		throw 1;
 	}
-	char *ztz_tok = strtok(ztz, ",");
+	char *save = NULL;
+	char *ztz_tok = strtok_r(ztz, ",", &save);
 	assert(ztz_tok != NULL);
 	al.best_score = atoi(ztz_tok);
 	char fw_flag = al.is_fw() ? 'T' : 'F';
@@ -849,7 +890,7 @@ static int print_unpaired(
 	if(unp_model != NULL) {
 		size_t off = unp_model->add_part1();
 		if(off < unp_model->k()) {
-			unp_model->list().back().init(
+			unp_model->list()[off].init(
 				al.best_score,
 				(int)al.len,
 				fw_flag,
@@ -858,9 +899,20 @@ static int print_unpaired(
 				al.qual,
 				al.edit_xscript.ptr());
 		}
+	} else if(unp_cands != NULL) {
+		unp_cands->expand();
+		unp_cands->back().init(
+			al.best_score,
+			(int)al.len,
+			fw_flag,
+			al.mate_flag(),
+			(int)ordlen,
+			al.qual,
+			al.edit_xscript.ptr());
 	}
 	
-	if(fh_recs != NULL) {
+	if(recs != NULL) {
+		vector<double>& write_buf = *recs;
 		// Output information relevant to MAPQ model
 		write_buf.push_back((double)al.line);
 		write_buf.push_back((double)al.len);
@@ -874,7 +926,7 @@ static int print_unpaired(
 			const char *buf = ztz_tok;
 			if(*buf == 'N') {
 				// Handle NA
-				assert(*(++buf) == 'A');
+				assert(buf[1] == 'A');
 				write_buf.push_back(std::numeric_limits<double>::quiet_NaN());
 			} else {
 				bool neg = false;
@@ -903,38 +955,47 @@ static int print_unpaired(
 					write_buf.push_back((double)(neg ? (-ztz_i) : ztz_i));
 				}
 			}
-			ztz_tok = strtok(NULL, ",");
+			ztz_tok = strtok_r(NULL, ",", &save);
 		}
 
 		// ... and finish with MAPQ and correct
 		write_buf.push_back((double)al.mapq);
 		write_buf.push_back((double)al.correct);
+	}
+}
 
-		// Flush output buffer
-		size_t nwritten = fwrite(&(write_buf.front()), 8,
-			write_buf.size(), fh_recs);
-		if(nwritten != write_buf.size()) {
-			cerr << "Could not write all " << write_buf.size()
-				 << " doubles to record file" << endl;
-			return -1;
-		}
-		write_buf.clear();
+/**
+ * Write and clear feature records accumulated in buf.
+ */
+static int flush_recs(vector<double>& buf, FILE *fh_recs) {
+	if(fh_recs == NULL || buf.empty()) {
+		return 0;
 	}
+	size_t nwritten = fwrite(&(buf.front()), 8, buf.size(), fh_recs);
+	if(nwritten != buf.size()) {
+		cerr << "Could not write all " << buf.size()
+			 << " doubles to record file" << endl;
+		return -1;
+	}
+	buf.clear();
 	return 0;
 }
 
-vector<double> ztz1_buf;
-vector<double> ztz2_buf;
-
 /**
- * No guarantee about state of strtok upon return.
+ * Featurize a concordant or discordant pair, appending its two feature
+ * records to recs (if not NULL); ztz1_buf and ztz2_buf are scratch space.
+ * Its input-model template is offered to paired_model or appended to
+ * paired_cands, as for print_unpaired.
  */
-static int print_paired_helper(
+static void print_paired_helper(
 	Alignment& al1,
 	Alignment& al2,
 	FILE *fh_model,
-	FILE *fh_recs,
-	ReservoirSampledEList<TemplatePaired> *paired_model)
+	vector<double> *recs,
+	vector<double>& ztz1_buf,
+	vector<double>& ztz2_buf,
+	ReservoirSampledEList<TemplatePaired> *paired_model,
+	EList<TemplatePaired> *paired_cands)
 {
 	assert(al1.is_aligned());
 	assert(al2.is_aligned());
@@ -958,7 +1019,8 @@ static int print_paired_helper(
 	assert(al1.cigar != NULL);
 	assert(al2.cigar != NULL);
 
-	char *ztz_tok1 = strtok(ztz1, ",");
+	char *save1 = NULL;
+	char *ztz_tok1 = strtok_r(ztz1, ",", &save1);
 	assert(ztz_tok1 != NULL);
 	al1.best_score = atoi(ztz_tok1);
 	char fw_flag1 = al1.is_fw() ? 'T' : 'F';	
@@ -968,7 +1030,8 @@ static int print_paired_helper(
     double alqual1_d;
     double clipqual1_d;
 
-	if(fh_recs != NULL) {
+	if(recs != NULL) {
+		vector<double>& write_buf = *recs;
 		ztz1_buf.clear();
 		
 		//
@@ -991,7 +1054,7 @@ static int print_paired_helper(
 			const char *buf = ztz_tok1;
 			if(*buf == 'N') {
 				// Handle NA
-				assert(*(++buf) == 'A');
+				assert(buf[1] == 'A');
 				write_buf.push_back(std::numeric_limits<double>::quiet_NaN());
 				ztz1_buf.push_back(std::numeric_limits<double>::quiet_NaN());
 			} else {
@@ -1024,16 +1087,18 @@ static int print_paired_helper(
 					ztz1_buf.push_back(ztz_add);
 				}
 			}
-			ztz_tok1 = strtok(NULL, ",");
+			ztz_tok1 = strtok_r(NULL, ",", &save1);
 		}
 	}
 	
-	char *ztz_tok2 = strtok(ztz2, ",");
+	char *save2 = NULL;
+	char *ztz_tok2 = strtok_r(ztz2, ",", &save2);
 	assert(ztz_tok2 != NULL);
 	al2.best_score = atoi(ztz_tok2);
 	char fw_flag2 = al2.is_fw() ? 'T' : 'F';
 	
-	if(fh_recs != NULL) {
+	if(recs != NULL) {
+		vector<double>& write_buf = *recs;
 		ztz2_buf.clear();
 		
 		//
@@ -1057,7 +1122,7 @@ static int print_paired_helper(
 			const char *buf = ztz_tok2;
 			if(*buf == 'N') {
 				// Handle NA
-				assert(*(++buf) == 'A');
+				assert(buf[1] == 'A');
 				write_buf.push_back(std::numeric_limits<double>::quiet_NaN());
 				ztz2_buf.push_back(std::numeric_limits<double>::quiet_NaN());
 			} else {
@@ -1090,7 +1155,7 @@ static int print_paired_helper(
 					ztz2_buf.push_back(ztz_add);
 				}
 			}
-			ztz_tok2 = strtok(NULL, ",");
+			ztz_tok2 = strtok_r(NULL, ",", &save2);
 		}
 
 		// ... and finish with MAPQ and correct
@@ -1114,16 +1179,6 @@ static int print_paired_helper(
 		write_buf.insert(write_buf.end(), ztz1_buf.begin(), ztz1_buf.end());
 		write_buf.push_back((double)al2.mapq);
 		write_buf.push_back((double)al2.correct);
-		
-		// Flush output buffer
-		size_t nwritten = fwrite(&(write_buf.front()), 8,
-			write_buf.size(), fh_recs);
-		if(nwritten != write_buf.size()) {
-			cerr << "Could not write all " << write_buf.size()
-				 << " doubles to record file" << endl;
-			return -1;
-		}
-		write_buf.clear();
 	}
 
 	if(fh_model != NULL) {
@@ -1145,44 +1200,56 @@ static int print_paired_helper(
 			(unsigned long long)fraglen);
 	}
 
+	TemplatePaired *t = NULL;
 	if(paired_model != NULL) {
 		size_t j = paired_model->add_part1();
 		if(j < paired_model->k()) {
-			paired_model->list().back().init(
-				al1.best_score + al2.best_score,
-				al1.best_score,
-				(int)al1.len,
-				fw_flag1,
-				al1.qual,
-				al1.edit_xscript.ptr(),
-				al2.best_score,
-				(int)al2.len,
-				fw_flag2,
-				al2.qual,
-				al2.edit_xscript.ptr(),
-				upstream1,
-				fraglen);
+			t = &paired_model->list()[j];
 		}
+	} else if(paired_cands != NULL) {
+		paired_cands->expand();
+		t = &paired_cands->back();
+	}
+	if(t != NULL) {
+		t->init(
+			al1.best_score + al2.best_score,
+			al1.best_score,
+			(int)al1.len,
+			fw_flag1,
+			al1.qual,
+			al1.edit_xscript.ptr(),
+			al2.best_score,
+			(int)al2.len,
+			fw_flag2,
+			al2.qual,
+			al2.edit_xscript.ptr(),
+			upstream1,
+			fraglen);
 	}
-	return 0;
 }
 
 /**
  * Call print_paired_helper with the first alignment
  * (according to appearance in the SAM) first.
  */
-static int print_paired(
+static void print_paired(
 	Alignment& al1,
 	Alignment& al2,
 	FILE *fh_model,
-	FILE *fh_recs,
-	ReservoirSampledEList<TemplatePaired> *paired_model)
+	vector<double> *recs,
+	vector<double>& ztz1_buf,
+	vector<double>& ztz2_buf,
+	ReservoirSampledEList<TemplatePaired> *paired_model,
+	EList<TemplatePaired> *paired_cands)
 {
-	return print_paired_helper(al1.line < al2.line ? al1 : al2,
-	                           al1.line < al2.line ? al2 : al1,
-	                           fh_model,
-	                           fh_recs,
-	                           paired_model);
+	print_paired_helper(al1.line < al2.line ? al1 : al2,
+	                    al1.line < al2.line ? al2 : al1,
+	                    fh_model,
+	                    recs,
+	                    ztz1_buf,
+	                    ztz2_buf,
+	                    paired_model,
+	                    paired_cands);
 }
 
 /**
@@ -1258,9 +1325,204 @@ static void print_paired_header(FILE *fh, int n_ztz_fields, unsigned long long n
 	fprintf(fh, ",mapq,correct,%llu\n", nrow);
 }
 
+/**
+ * Bytes of SAM text the reader puts in a block before handing it off.
+ */
+static const size_t PARSE_BLOCK_BYTES = 512 * 1024;
+
+/**
+ * The fields of an alignment that the reader fills in; enough for a worker
+ * thread to featurize it.
+ */
+struct AlignmentStub {
+
+	void set(const Alignment& al) {
+		qname = al.qname;
+		typ = al.typ;
+		rest_of_line = al.rest_of_line;
+		flag = al.flag;
+		line = al.line;
+	}
+
+	void apply(Alignment& al) const {
+		al.clear();
+		al.qname = qname;
+		al.typ = typ;
+		al.rest_of_line = rest_of_line;
+		al.flag = flag;
+		al.line = line;
+	}
+
+	char *qname;
+	char *typ;
+	char *rest_of_line;
+	int flag;
+	size_t line;
+};
+
+/**
+ * An alignment or pair found by the reader that needs featurizing.  cat is
+ * 0-3 for unpaired, bad-end, concordant and discordant.
+ */
+struct ParseUnit {
+	int cat;
+	size_t ordlen; // for bad-end, length of the unaligned mate
+	AlignmentStub al1, al2;
+};
+
+/**
+ * A block of input SAM text, the units the reader found in it, and the
+ * feature records and candidate templates that featurizing them produces.
+ * Both mates of a pair always fall in the same block.
+ */
+struct ParseBlock {
+
+	ParseBlock() : text(PARSE_BLOCK_BYTES + 2 * BUFSZ), used(0) { }
+
+	void clear() {
+		used = 0;
+		units.clear();
+		for(int i = 0; i < 4; i++) {
+			recs[i].clear();
+		}
+		u_cands.clear();
+		b_cands.clear();
+		c_cands.clear();
+		d_cands.clear();
+	}
+
+	/**
+	 * Room for another line?
+	 */
+	bool has_room() const {
+		return text.size() - used >= BUFSZ;
+	}
+
+	void add(int cat, size_t ordlen, const Alignment& al1, const Alignment *al2) {
+		units.push_back(ParseUnit());
+		units.back().cat = cat;
+		units.back().ordlen = ordlen;
+		units.back().al1.set(al1);
+		if(al2 != NULL) {
+			units.back().al2.set(*al2);
+		}
+	}
+
+	vector<char> text;
+	size_t used;
+	vector<ParseUnit> units;
+	vector<double> recs[4];
+	EList<TemplateUnpaired> u_cands, b_cands;
+	EList<TemplatePaired> c_cands, d_cands;
+	vector<double> ztz1_buf, ztz2_buf;
+};
+
+/**
+ * A batch of blocks featurized in parallel.
+ */
+struct ParseBatch {
+	vector<ParseBlock*> blocks;
+	bool do_recs[4];
+	bool do_templates;
+};
+
+/**
+ * Featurize the units in block i of a ParseBatch.  Run by a BatchPool.
+ */
+static void featurize_block(void *ctx, size_t i) {
+	ParseBatch& batch = *(ParseBatch*)ctx;
+	ParseBlock& blk = *batch.blocks[i];
+	Alignment al1, al2;
+	for(size_t j = 0; j < blk.units.size(); j++) {
+		const ParseUnit& u = blk.units[j];
+		vector<double> *recs = batch.do_recs[u.cat] ? &blk.recs[u.cat] : NULL;
+		u.al1.apply(al1);
+		if(u.cat < 2) {
+			EList<TemplateUnpaired> *cands = u.cat == 0 ? &blk.u_cands : &blk.b_cands;
+			print_unpaired(al1, u.ordlen, NULL, recs, NULL,
+			               batch.do_templates ? cands : NULL);
+		} else {
+			EList<TemplatePaired> *cands = u.cat == 2 ? &blk.c_cands : &blk.d_cands;
+			u.al2.apply(al2);
+			print_paired(al1, al2, NULL, recs, blk.ztz1_buf, blk.ztz2_buf,
+			             NULL, batch.do_templates ? cands : NULL);
+		}
+	}
+}
+
+static void offer_template(
+	ReservoirSampledEList<TemplateUnpaired>& r,
+	const TemplateUnpaired& t)
+{
+	size_t off = r.add_part1();
+	if(off < r.k()) {
+		r.list()[off].init(t.best_score_, t.len_, t.fw_flag_, t.mate_flag_,
+		                   t.opp_len_, t.qual_, t.edit_xscript_);
+	}
+}
+
+static void offer_template(
+	ReservoirSampledEList<TemplatePaired>& r,
+	const TemplatePaired& t)
+{
+	size_t off = r.add_part1();
+	if(off < r.k()) {
+		r.list()[off].init(t.score_12_, t.score_1_, t.len_1_, t.fw_flag_1_,
+		                   t.qual_1_, t.edit_xscript_1_, t.score_2_, t.len_2_,
+		                   t.fw_flag_2_, t.qual_2_, t.edit_xscript_2_,
+		                   t.upstream1_, t.fraglen_);
+	}
+}
+
+/**
+ * Featurize the first n blocks of a batch in parallel, then write their
+ * feature records and offer their templates to the reservoirs in input
+ * order, so that results are the same as when featurizing serially.
+ */
+static int run_parse_batch(
+	BatchPool& pool,
+	ParseBatch& batch,
+	size_t n,
+	FILE **orec_fhs,
+	ReservoirSampledEList<TemplateUnpaired> *u_templates,
+	ReservoirSampledEList<TemplateUnpaired> *b_templates,
+	ReservoirSampledEList<TemplatePaired> *c_templates,
+	ReservoirSampledEList<TemplatePaired> *d_templates)
+{
+	pool.run(n, featurize_block, &batch);
+	for(size_t i = 0; i < n; i++) {
+		ParseBlock& blk = *batch.blocks[i];
+		for(int j = 0; j < 4; j++) {
+			if(flush_recs(blk.recs[j], orec_fhs[j]) != 0) {
+				return -1;
+			}
+		}
+		if(!batch.do_templates) {
+			continue;
+		}
+		size_t ncand[4] = {0, 0, 0, 0};
+		for(size_t j = 0; j < blk.units.size(); j++) {
+			int cat = blk.units[j].cat;
+			size_t k = ncand[cat]++;
+			switch(cat) {
+				case 0: offer_template(*u_templates, blk.u_cands[k]); break;
+				case 1: offer_template(*b_templates, blk.b_cands[k]); break;
+				case 2: offer_template(*c_templates, blk.c_cands[k]); break;
+				default: offer_template(*d_templates, blk.d_cands[k]); break;
+			}
+		}
+	}
+	return 0;
+}
+
 /**
  * Read the input SAM file while simultaneously writing out records used to
  * train a MAPQ model as well as records used to build an input model.
+ *
+ * With nthreads > 1, the reader classifies alignments and hands blocks of
+ * them to a pool of threads for featurizing; records and templates are
+ * then written and sampled in input order, so output is identical to the
+ * serial output.
  */
 static int sam_pass1(
 	FILE *fh,
@@ -1280,6 +1542,7 @@ static int sam_pass1(
 	ReservoirSampledEList<TemplateUnpaired> *b_templates,
 	ReservoirSampledEList<TemplatePaired> *c_templates,
 	ReservoirSampledEList<TemplatePaired> *d_templates,
+	int nthreads,
 	bool quiet)
 {
 	/* Advise the kernel of our access pattern.  */
@@ -1299,19 +1562,74 @@ static int sam_pass1(
 	int nunp_al = 0, nunp_unal = 0, npair_badend = 0, npair_conc = 0,
 	    npair_disc = 0, npair_unal = 0, ntyp_mismatch = 0;
 	
+	vector<double> write_buf, ztz1_buf, ztz2_buf;
+	FILE *orec_fhs[4] = {orec_u_fh, orec_b_fh, orec_c_fh, orec_d_fh};
+	
+	// Featurize in parallel unless writing template records, which are
+	// written as they're found
+	bool threaded = nthreads > 1 && omod_u_fh == NULL && omod_b_fh == NULL &&
+	                omod_c_fh == NULL && omod_d_fh == NULL;
+	ParseBatch batch;
+	ParseBlock *blk = NULL; // block being filled, if threaded
+	size_t nblk = 0;
+	BatchPool *pool = NULL;
+	if(threaded) {
+		pool = new BatchPool(nthreads);
+		for(int i = 0; i < 4; i++) {
+			batch.do_recs[i] = orec_fhs[i] != NULL;
+		}
+		batch.do_templates = u_templates != NULL;
+		for(int i = 0; i < 2 * nthreads; i++) {
+			batch.blocks.push_back(new ParseBlock());
+		}
+		blk = batch.blocks[0];
+	}
+	int ret = 0;
+	
+	long long nbytes = input_start;
 	while(1) {
-		char *line = line1 ? linebuf1 : linebuf2;
+		if(input_end >= 0 && nbytes >= input_end) {
+			break; /* done with shard */
+		}
+		if(blk != NULL && blk->used >= PARSE_BLOCK_BYTES &&
+		   !(al_cur1 ? al2 : al1).valid)
+		{
+			// block is full and no mate is waiting for its opposite
+			if(++nblk == batch.blocks.size()) {
+				ret = run_parse_batch(*pool, batch, nblk, orec_fhs, u_templates,
+				                      b_templates, c_templates, d_templates);
+				if(ret != 0) {
+					break;
+				}
+				nblk = 0;
+			}
+			blk = batch.blocks[nblk];
+			blk->clear();
+		}
+		if(blk != NULL && !blk->has_room()) {
+			cerr << "Mate of paired-end read not found near line "
+			     << nline + line_offset << endl;
+			ret = -1;
+			break;
+		}
+		char *line = blk != NULL ? &blk->text[blk->used] : (line1 ? linebuf1 : linebuf2);
 		if(fgets(line, BUFSZ, fh) == NULL) {
 			break; /* done */
 		}
+		size_t linelen = 0;
+		if(input_end >= 0 || blk != NULL) {
+			linelen = strlen(line);
+			nbytes += linelen;
+		}
 		nline++;
 		if(line[0] == '@') {
 			nhead++;
 			continue; // skip header
 		}
-		char *qname = strtok(line, "\t"); assert(qname != NULL);
+		char *save = NULL;
+		char *qname = strtok_r(line, "\t", &save); assert(qname != NULL);
 		assert(qname == line);
-		char *flag_str = strtok(NULL, "\t"); assert(flag_str != NULL);
+		char *flag_str = strtok_r(NULL, "\t", &save); assert(flag_str != NULL);
 		int flag = atoi(flag_str);
 		if((flag & 2048) != 0) {
 			nsec++;
@@ -1320,6 +1638,9 @@ static int sam_pass1(
 		
 		/* switch which buffer "line" points to */
 		line1 = !line1;
+		if(blk != NULL) {
+			blk->used += linelen + 1;
+		}
 		
 		Alignment& al_cur  = al_cur1 ? al1 : al2;
 		assert(!al_cur.valid);
@@ -1330,7 +1651,7 @@ static int sam_pass1(
 		al_cur.rest_of_line = flag_str + strlen(flag_str) + 1; /* for re-parsing */
 		al_cur.qname = qname;
 		al_cur.flag = flag;
-		al_cur.line = nline;
+		al_cur.line = nline + line_offset;
 		
 		/* If we're able to mate up ends at this time, do it */
 		Alignment *mate1 = NULL, *mate2 = NULL;
@@ -1381,8 +1702,16 @@ static int sam_pass1(
 				}
 
 				nunp_al++;
-				if(print_unpaired(al_cur, 0, omod_u_fh, orec_u_fh, u_templates) != 0) {
-				    return -1;
+				if(blk != NULL) {
+					blk->add(0, 0, al_cur, NULL);
+				} else {
+					print_unpaired(al_cur, 0, omod_u_fh,
+					               orec_u_fh != NULL ? &write_buf : NULL,
+					               u_templates, NULL);
+					if(flush_recs(write_buf, orec_u_fh) != 0) {
+						ret = -1;
+						break;
+					}
 				}
 			}
 			
@@ -1417,12 +1746,18 @@ static int sam_pass1(
 					npair_badend++;
 					// the call to infer_read_length is needed because we
 					// haven't parsed the sequence
-					if(print_unpaired(
-					    alm,
-						infer_read_length(m1al ? mate2->rest_of_line : mate1->rest_of_line),
-						omod_b_fh, orec_b_fh, b_templates) != 0)
-					{
-					    return -1;
+					size_t ordlen = infer_read_length(
+						m1al ? mate2->rest_of_line : mate1->rest_of_line);
+					if(blk != NULL) {
+						blk->add(1, ordlen, alm, NULL);
+					} else {
+						print_unpaired(alm, ordlen, omod_b_fh,
+						               orec_b_fh != NULL ? &write_buf : NULL,
+						               b_templates, NULL);
+						if(flush_recs(write_buf, orec_b_fh) != 0) {
+							ret = -1;
+							break;
+						}
 					}
 				}
 				
@@ -1444,10 +1779,16 @@ static int sam_pass1(
 						// Case 6: Current read is paired and both mates
 						// aligned, concordantly
 						npair_conc++;
-						if(print_paired(*mate1, *mate2, omod_c_fh,
-						                orec_c_fh, c_templates) != 0)
-						{
-						    return -1;
+						if(blk != NULL) {
+							blk->add(2, 0, *mate1, mate2);
+						} else {
+							print_paired(*mate1, *mate2, omod_c_fh,
+							             orec_c_fh != NULL ? &write_buf : NULL,
+							             ztz1_buf, ztz2_buf, c_templates, NULL);
+							if(flush_recs(write_buf, orec_c_fh) != 0) {
+								ret = -1;
+								break;
+							}
 						}
 					}
 					
@@ -1465,8 +1806,16 @@ static int sam_pass1(
 
 						// Case 7: Current read is paired and both mates aligned, not condordantly
 						npair_disc++;
-						if(print_paired(*mate1, *mate2, omod_d_fh, orec_d_fh, d_templates) != 0) {
-						    return -1;
+						if(blk != NULL) {
+							blk->add(3, 0, *mate1, mate2);
+						} else {
+							print_paired(*mate1, *mate2, omod_d_fh,
+							             orec_d_fh != NULL ? &write_buf : NULL,
+							             ztz1_buf, ztz2_buf, d_templates, NULL);
+							if(flush_recs(write_buf, orec_d_fh) != 0) {
+								ret = -1;
+								break;
+							}
 						}
 					}
 
@@ -1483,6 +1832,20 @@ static int sam_pass1(
 			al_cur.valid = true;
 		}
 	}
+	
+	if(threaded) {
+		if(ret == 0) {
+			ret = run_parse_batch(*pool, batch, nblk + 1, orec_fhs, u_templates,
+			                      b_templates, c_templates, d_templates);
+		}
+		for(size_t i = 0; i < batch.blocks.size(); i++) {
+			delete batch.blocks[i];
+		}
+		delete pool;
+	}
+	if(ret != 0) {
+		return ret;
+	}
 
     // Write metadata
     if(u_head) {
@@ -1532,11 +1895,29 @@ static int sam_pass1(
 		setvbuf(fh, buf, _IOFBF, BUFSZ); \
 	}
 
+// Feature tables kept in memory instead of written, for libqtip; slots are
+// records for u, b, c and d, then their metadata
+static bool keep_tables = false;
+static char *table_bufs[8];
+static size_t table_lens[8];
+
+#define TABLEDEC(fn, fh, buf, slot, do_open) \
+	FILEDEC(fn, fh, buf, "feature", (do_open) && !keep_tables); \
+	if((do_open) && keep_tables) { \
+		fh = open_memstream(&table_bufs[slot], &table_lens[slot]); \
+		if(fh == NULL) { \
+			cerr << "Could not keep feature table \"" << fn << "\" in memory" << endl; \
+			return -1; \
+		} \
+	}
+
 /**
  * Caller gives path to one or more SAM files, then the final argument is a prefix where all the
  */
-int main(int argc, char **argv) {
-	
+static int parse_main(int argc, char **argv) {
+
+	set_default_options();
+
 	if(argc == 1) {
 		// print which arguments from ts.py should pass through to here
 		cout << "wiggle "
@@ -1551,6 +1932,9 @@ int main(int argc, char **argv) {
 		     << "sim-disc-min "
 		     << "sim-bad-end-min "
 		     << "seed "
+		     << "decompress-threads "
+		     << "parse-threads "
+		     << "no-ref-cache "
 		     << endl;
 		return 0;
 	}
@@ -1563,8 +1947,10 @@ int main(int argc, char **argv) {
     string orec_b_meta_fn;
     string orec_c_meta_fn;
     string orec_d_meta_fn;
+	string osave_u_fn, osave_b_fn, osave_c_fn, osave_d_fn;
 	string prefix, mod_prefix;
-	vector<string> fastas, sams;
+	vector<string> fastas, sams, input_models;
+	string tab6_out; // if set, write simulated reads here in --tab6 format
 	char buf_input_sam[BUFSZ];
 	
 	bool do_input_model = false; // output records related to input model
@@ -1654,6 +2040,36 @@ int main(int argc, char **argv) {
 				else if(strcmp(argv[i], "sim-bad-end-min") == 0) {
 					sim_bad_end_min = atoi(argv[++i]);
 				}
+				else if(strcmp(argv[i], "decompress-threads") == 0) {
+					decompress_threads = atoi(argv[++i]);
+				}
+				else if(strcmp(argv[i], "parse-threads") == 0) {
+					parse_threads = atoi(argv[++i]);
+				}
+				else if(strcmp(argv[i], "no-ref-cache") == 0) {
+					ref_cache = strcmp(argv[++i], "True") != 0;
+				}
+				else if(strcmp(argv[i], "input-model") == 0) {
+					input_models.push_back(string(argv[++i]));
+				}
+				else if(strcmp(argv[i], "line-offset") == 0) {
+					line_offset = (size_t)strtoull(argv[++i], NULL, 10);
+				}
+				else if(strcmp(argv[i], "input-start") == 0) {
+					input_start = atoll(argv[++i]);
+				}
+				else if(strcmp(argv[i], "input-end") == 0) {
+					input_end = atoll(argv[++i]);
+				}
+				else if(strcmp(argv[i], "tab6-out") == 0) {
+					tab6_out = argv[++i];
+				}
+				else if(strcmp(argv[i], "sim-fraction") == 0) {
+					sim_fraction = atof(argv[++i]);
+				}
+				else if(strcmp(argv[i], "sim-categories") == 0) {
+					sim_categories = argv[++i];
+				}
 				else if(strcmp(argv[i], "seed") == 0) {
 					// Unsure whether this is a good way to do this
 					i++;
@@ -1689,6 +2105,12 @@ int main(int argc, char **argv) {
 				omod_c_fn = mod_prefix + string("_mod_c.csv");
 				omod_d_fn = mod_prefix + string("_mod_d.csv");
 
+				// sampled input-model templates, written in mode i
+				osave_u_fn = mod_prefix + string("_model_u.tsv");
+				osave_b_fn = mod_prefix + string("_model_b.tsv");
+				osave_c_fn = mod_prefix + string("_model_c.tsv");
+				osave_d_fn = mod_prefix + string("_model_d.tsv");
+
 				// simulated (tandem) reads
 				oread_u_fn = mod_prefix + string("_reads_u.fastq");
 				oread1_b_fn = mod_prefix + string("_reads_b_1.fastq");
@@ -1705,7 +2127,7 @@ int main(int argc, char **argv) {
 				cerr << "Warning: More than one model output prefix specified; using last one: \"" << mod_prefix << "\"" << endl;
 			}
 		}
-		if(sams.empty() || !prefix_set) {
+		if((sams.empty() && input_models.empty()) || !prefix_set) {
 			cerr << "Usage: qtip_parse_input [modes]* -- [argument value]* -- [sam]* -- [fasta]* -- [record prefix] -- [read/model prefix]" << endl;
 			cerr << "[record prefix] is prefix for record files" << endl;
 			cerr << "[read/model prefix] is prefix for simulated read and model files" << endl;
@@ -1718,26 +2140,48 @@ int main(int argc, char **argv) {
 			cerr << "  wiggle <int>: if the reported alignment is within "
 			     << "this many of the true alignment, it's considered correct"
 			     << endl;
+			cerr << "  input-model <prefix>: start from input-model templates "
+			     << "written in mode i with [read/model prefix] <prefix>; may "
+			     << "be repeated, in which case the samples are merged" << endl;
+			cerr << "  line-offset <int>: add to SAM line numbers" << endl;
+			cerr << "  input-start <int>, input-end <int>: parse only the "
+			     << "lines of the (uncompressed) SAM between these byte offsets"
+			     << endl;
+			cerr << "  tab6-out <file>: write all simulated reads to <file>, "
+			     << "or to standard out if -, in Bowtie 2's --tab6 format "
+			     << "instead of to FASTQ files" << endl;
+			cerr << "  sim-fraction <float>: simulate this fraction of the "
+			     << "reads the sim-* arguments call for" << endl;
+			cerr << "  sim-categories <str>: simulate only these categories "
+			     << "(some of u, b, c and d)" << endl;
 		}
 	}
-	keep_templates = do_simulation;
+	keep_templates = do_simulation || do_input_model;
 
 	if(do_simulation && mod_prefix_set == 0) {
 		cerr << "s (simulation) argument specified, but [read/model prefix] not specified" << endl;
 		return -1;
 	}
+	if(do_input_model && mod_prefix_set == 0) {
+		cerr << "i (input model) argument specified, but [read/model prefix] not specified" << endl;
+		return -1;
+	}
+	if((input_start > 0 || input_end >= 0) && sams.size() > 1) {
+		cerr << "input-start/input-end specified with more than one SAM file" << endl;
+		return -1;
+	}
 
-	FILEDEC(orec_u_fn, orec_u_fh, orec_u_buf, "feature", do_features);
-	FILEDEC(orec_u_meta_fn, orec_u_meta_fh, orec_u_meta_buf, "feature", do_features);
+	TABLEDEC(orec_u_fn, orec_u_fh, orec_u_buf, 0, do_features);
+	TABLEDEC(orec_u_meta_fn, orec_u_meta_fh, orec_u_meta_buf, 4, do_features);
 	FILEDEC(omod_u_fn, omod_u_fh, omod_u_buf, "template record", false);
-	FILEDEC(orec_b_fn, orec_b_fh, orec_b_buf, "feature", do_features);
-	FILEDEC(orec_b_meta_fn, orec_b_meta_fh, orec_b_meta_buf, "feature", do_features);
+	TABLEDEC(orec_b_fn, orec_b_fh, orec_b_buf, 1, do_features);
+	TABLEDEC(orec_b_meta_fn, orec_b_meta_fh, orec_b_meta_buf, 5, do_features);
 	FILEDEC(omod_b_fn, omod_b_fh, omod_b_buf, "template record", false);
-	FILEDEC(orec_c_fn, orec_c_fh, orec_c_buf, "feature", do_features);
-	FILEDEC(orec_c_meta_fn, orec_c_meta_fh, orec_c_meta_buf, "feature", do_features);
+	TABLEDEC(orec_c_fn, orec_c_fh, orec_c_buf, 2, do_features);
+	TABLEDEC(orec_c_meta_fn, orec_c_meta_fh, orec_c_meta_buf, 6, do_features);
 	FILEDEC(omod_c_fn, omod_c_fh, omod_c_buf, "template record", false);
-	FILEDEC(orec_d_fn, orec_d_fh, orec_d_buf, "feature", do_features);
-	FILEDEC(orec_d_meta_fn, orec_d_meta_fh, orec_d_meta_buf, "feature", do_features);
+	TABLEDEC(orec_d_fn, orec_d_fh, orec_d_buf, 3, do_features);
+	TABLEDEC(orec_d_meta_fn, orec_d_meta_fh, orec_d_meta_buf, 7, do_features);
 	FILEDEC(omod_d_fn, omod_d_fh, omod_d_buf, "template record", false);
 
 	ReservoirSampledEList<TemplateUnpaired> u_templates(input_model_size);
@@ -1745,16 +2189,46 @@ int main(int argc, char **argv) {
 	ReservoirSampledEList<TemplatePaired> c_templates(input_model_size);
 	ReservoirSampledEList<TemplatePaired> d_templates(input_model_size);
 
+	if(!input_models.empty()) {
+		const char *sufs[4] = {"_model_u.tsv", "_model_b.tsv", "_model_c.tsv", "_model_d.tsv"};
+		bool ok = true;
+		for(int j = 0; j < 4 && ok; j++) {
+			vector<SavedTemplates> saved(input_models.size());
+			for(size_t i = 0; i < input_models.size() && ok; i++) {
+				ok = load_templates((input_models[i] + sufs[j]).c_str(), saved[i]);
+			}
+			if(ok) {
+				switch(j) {
+					case 0: ok = merge_templates(saved, u_templates); break;
+					case 1: ok = merge_templates(saved, b_templates); break;
+					case 2: ok = merge_templates(saved, c_templates); break;
+					default: ok = merge_templates(saved, d_templates); break;
+				}
+			}
+		}
+		if(!ok) {
+			cerr << "Could not load input model" << endl;
+			return -1;
+		}
+		cerr << "Loaded input model from " << input_models.size() << " prefix(es)" << endl;
+	}
+
 	if(do_features || do_input_model || do_simulation) {
 		for(size_t i = 0; i < sams.size(); i++) {
 			cerr << "Parsing SAM file \"" << sams[i] << "\" (seed=" << seed << ")" << endl;
-			FILE *fh = fopen(sams[i].c_str(), "rb");
+			// may be compressed SAM or BAM
+			FILE *fh = open_sam_input(sams[i].c_str(), decompress_threads);
 			if(fh == NULL) {
 				cerr << "Could not open input SAM file \"" << sams[i] << "\"" << endl;
 				return -1;
 			}
 			setvbuf(fh, buf_input_sam, _IOFBF, BUFSZ);
-			sam_pass1(fh,
+			if(input_start > 0 && fseeko(fh, (off_t)input_start, SEEK_SET) != 0) {
+				cerr << "Could not seek to offset " << input_start
+				     << " of input SAM file \"" << sams[i] << "\"" << endl;
+				return -1;
+			}
+			int ret = sam_pass1(fh,
 					  orec_u_fn, orec_u_fh,
 					  orec_u_meta_fn, orec_u_meta_fh,
 					  omod_u_fn, omod_u_fh,
@@ -1771,8 +2245,17 @@ int main(int argc, char **argv) {
 					  keep_templates ? &b_templates : NULL,
 					  keep_templates ? &c_templates : NULL,
 					  keep_templates ? &d_templates : NULL,
+					  parse_threads,
 					  false); // not quiet
-			fclose(fh);
+			if(ret != 0) {
+				cerr << "Error parsing input SAM file \"" << sams[i] << "\"" << endl;
+				close_sam_input(fh);
+				return -1;
+			}
+			if(close_sam_input(fh) != 0) {
+				cerr << "Error reading input SAM file \"" << sams[i] << "\"" << endl;
+				return -1;
+			}
 		}
 	}
 
@@ -1790,6 +2273,17 @@ int main(int argc, char **argv) {
 	if(orec_d_meta_fh != NULL) fclose(orec_d_meta_fh);
 	cerr << "Finished parsing SAM" << endl;
 
+	if(do_input_model) {
+		if(!save_templates(osave_u_fn.c_str(), u_templates) ||
+		   !save_templates(osave_b_fn.c_str(), b_templates) ||
+		   !save_templates(osave_c_fn.c_str(), c_templates) ||
+		   !save_templates(osave_d_fn.c_str(), d_templates))
+		{
+			cerr << "Could not write input model with prefix \"" << mod_prefix << "\"" << endl;
+			return -1;
+		}
+	}
+
 	if(keep_templates) {
 		cerr << "Input model in memory:" << endl;
 		if(!u_templates.empty()) {
@@ -1816,13 +2310,21 @@ int main(int argc, char **argv) {
 		InputModelPaired c_model(c_templates.list(), c_templates.size(), fraction_even, low_score_bias);
 		InputModelPaired d_model(d_templates.list(), d_templates.size(), fraction_even, low_score_bias);
 		
-		FILEDEC(oread_u_fn, oread_u_fh, oread_u_buf, "FASTQ", true);
-		FILEDEC(oread1_b_fn, oread1_b_fh, oread1_b_buf, "FASTQ", true);
-		FILEDEC(oread2_b_fn, oread2_b_fh, oread2_b_buf, "FASTQ", true);
-		FILEDEC(oread1_c_fn, oread1_c_fh, oread1_c_buf, "FASTQ", true);
-		FILEDEC(oread2_c_fn, oread2_c_fh, oread2_c_buf, "FASTQ", true);
-		FILEDEC(oread1_d_fn, oread1_d_fh, oread1_d_buf, "FASTQ", true);
-		FILEDEC(oread2_d_fn, oread2_d_fh, oread2_d_buf, "FASTQ", true);
+		const bool tab6 = !tab6_out.empty();
+		if(tab6) {
+			oread_u_fn = tab6_out;
+		}
+		FILEDEC(oread_u_fn, oread_u_fh, oread_u_buf, "FASTQ", !tab6 || tab6_out != "-");
+		FILEDEC(oread1_b_fn, oread1_b_fh, oread1_b_buf, "FASTQ", !tab6);
+		FILEDEC(oread2_b_fn, oread2_b_fh, oread2_b_buf, "FASTQ", !tab6);
+		FILEDEC(oread1_c_fn, oread1_c_fh, oread1_c_buf, "FASTQ", !tab6);
+		FILEDEC(oread2_c_fn, oread2_c_fh, oread2_c_buf, "FASTQ", !tab6);
+		FILEDEC(oread1_d_fn, oread1_d_fh, oread1_d_buf, "FASTQ", !tab6);
+		FILEDEC(oread2_d_fn, oread2_d_fh, oread2_d_buf, "FASTQ", !tab6);
+		if(tab6_out == "-") {
+			oread_u_fh = stdout;
+			setvbuf(oread_u_fh, oread_u_buf, _IOFBF, BUFSZ);
+		}
 
 		cerr << "Creating tandem read simulator" << endl;
 		const size_t chunksz = 128 * 1024;
@@ -1831,7 +2333,11 @@ int main(int argc, char **argv) {
 							  oread_u_fh,
 							  oread1_b_fh, oread2_b_fh,
 							  oread1_c_fh, oread2_c_fh,
-							  oread1_d_fh, oread2_d_fh);
+							  oread1_d_fh, oread2_d_fh,
+							  tab6,
+							  seed,
+							  parse_threads,
+							  ref_cache);
 
 		cerr << "  Estimate total number of FASTA bases is a bit less than "
 		     << ss.num_estimated_bases() / 1000 << "k" << endl;
@@ -1843,14 +2349,65 @@ int main(int argc, char **argv) {
 			sim_unp_min,
 			sim_conc_min,
 			sim_disc_min,
-			sim_bad_end_min);
+			sim_bad_end_min,
+			sim_fraction,
+			sim_categories.c_str());
 		
-		fclose(oread_u_fh);
-		fclose(oread1_b_fh);
-		fclose(oread2_b_fh);
-		fclose(oread1_c_fh);
-		fclose(oread2_c_fh);
-		fclose(oread1_d_fh);
-		fclose(oread2_d_fh);
+		if(fclose(oread_u_fh) != 0) {
+			cerr << "Error writing simulated reads to \"" << oread_u_fn << "\"" << endl;
+			return -1;
+		}
+		if(!tab6) {
+			fclose(oread1_b_fh);
+			fclose(oread2_b_fh);
+			fclose(oread1_c_fh);
+			fclose(oread2_c_fh);
+			fclose(oread1_d_fh);
+			fclose(oread2_d_fh);
+		}
+	}
+	return 0;
+}
+
+#ifdef QTIP_LIB
+/**
+ * Free feature tables kept in memory.
+ */
+static void free_tables() {
+	for(int i = 0; i < 8; i++) {
+		free(table_bufs[i]);
+		table_bufs[i] = NULL;
+		table_lens[i] = 0;
 	}
 }
+
+int qtip_parse(int argc, char **argv, int keep) {
+	free_tables();
+	keep_tables = keep != 0;
+	int ret = -1;
+	try {
+		ret = parse_main(argc, argv);
+	} catch(int e) {
+		ret = -1;
+	}
+	keep_tables = false;
+	return ret;
+}
+
+int qtip_parse_table(int i, const char **buf, size_t *len) {
+	if(i < 0 || i >= QTIP_NTABLES) {
+		return -1;
+	}
+	*buf = table_bufs[i];
+	*len = table_lens[i];
+	return 0;
+}
+
+void qtip_parse_free_tables(void) {
+	free_tables();
+}
+#else
+int main(int argc, char **argv) {
+	return parse_main(argc, argv);
+}
+#endif
@@ -8,12 +8,22 @@
 
 #include <iostream>
 #include <stdio.h>
+#include <stdlib.h>
 #include <string.h>
+#include <math.h>
 #include <string>
 #include <vector>
 #include <cassert>
+#include <pthread.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/types.h>
+#include <sys/stat.h>
 #include "qtip_rewrite.h"
 #include "predmerge.h"
+#ifdef QTIP_LIB
+#include "qtip_lib.h"
+#endif
 
 using namespace std;
 
@@ -21,65 +31,623 @@ using namespace std;
  * Re-write a SAM file to include our new MAPQ prediction.
  */
 
-bool write_orig_mapq = false;
-const char *orig_mapq_flag = "Zm:i";
+bool write_orig_mapq;
+const char *orig_mapq_flag;
 
-bool write_precise_mapq = false;
-const char *precise_mapq_flag = "Zp:Z";
+bool write_precise_mapq;
+const char *precise_mapq_flag;
 
-bool keep_ztz = false;
+bool keep_ztz;
+
+int rewrite_threads;
+
+bool output_bgzf;            // BGZF-compress the output
+int compress_threads;        // threads for BGZF compression
+int compress_level;          // zlib level; -1 for default
+static int decompress_threads; // threads for decompressing BGZF input
+
+/**
+ * Set options to their defaults, before the command line is parsed; options
+ * are globals and libqtip may run several times in one process.
+ */
+static void set_default_options() {
+	write_orig_mapq = false;
+	orig_mapq_flag = "Zm:i";
+	write_precise_mapq = false;
+	precise_mapq_flag = "Zp:Z";
+	keep_ztz = false;
+	rewrite_threads = 1;
+	output_bgzf = false;
+	compress_threads = 1;
+	compress_level = -1;
+	decompress_threads = 1;
+}
 
 const static size_t BUFSZ = 262144;
 
 /**
- * Write a new line of SAM (buf) to output filehandle (osam_fh) replacing the
- * existing MAPQ with the predicted one (mapq).
+ * Write n to dst in decimal, as "%d" would; return number of chars written.
+ */
+static size_t format_int(char *dst, long long n) {
+	char tmp[24];
+	size_t len = 0, off = 0;
+	unsigned long long u = (unsigned long long)n;
+	if(n < 0) {
+		dst[off++] = '-';
+		u = 0ULL - u;
+	}
+	do {
+		tmp[len++] = (char)('0' + (u % 10));
+		u /= 10;
+	} while(u > 0);
+	while(len > 0) {
+		dst[off++] = tmp[--len];
+	}
+	return off;
+}
+
+/**
+ * Write x to dst with 3 decimal places, as "%0.3lf" would; return number of
+ * chars written.  Values within a hair of a rounding tie, and anything
+ * negative or huge, are left to snprintf so output is always identical.
+ */
+static size_t format_fixed3(char *dst, size_t dstsz, double x) {
+	double scaled = x * 1000.0;
+	double fl = floor(scaled);
+	if(!(scaled >= 0.0 && scaled < 1e15) || fabs(scaled - fl - 0.5) < 1e-6) {
+		return (size_t)snprintf(dst, dstsz, "%0.3lf", x);
+	}
+	unsigned long long v = (unsigned long long)fl + ((scaled - fl > 0.5) ? 1 : 0);
+	size_t off = format_int(dst, (long long)(v / 1000));
+	unsigned frac = (unsigned)(v % 1000);
+	dst[off++] = '.';
+	dst[off++] = (char)('0' + frac / 100);
+	dst[off++] = (char)('0' + (frac / 10) % 10);
+	dst[off++] = (char)('0' + frac % 10);
+	return off;
+}
+
+/**
+ * Write a new line of SAM (buf, len bytes including any newline) to output
+ * sink (out) replacing the existing MAPQ with the predicted one (mapq).
+ * Field boundaries are found with memchr and unchanged stretches of the line
+ * are written as spans.
  */
-static void rewrite(FILE *fh, char *buf, double mapq) {
-	char orig[10];
-	char *orig_cur = orig;
+static void rewrite(OutputSink& out, const char *buf, size_t len, double mapq) {
+	const char *end = buf + len;
+	if(end > buf && end[-1] == '\n') {
+		end--;
+	}
+	if(end > buf && end[-1] == '\r') {
+		end--;
+	}
+	const char *cur = buf;
 	for(int i = 0; i < 4; i++) {
-		while(*buf != '\t') {
-		    putc_unlocked(*buf++, fh);
+		cur = (const char *)memchr(cur, '\t', end - cur);
+		if(cur == NULL) {
+			out.write(buf, len); // too few fields to have a MAPQ
+			return;
 		}
-		putc_unlocked(*buf++, fh);
+		cur++;
 	}
+	out.write(buf, cur - buf);
 	// Replace MAPQ with our new one
-	int mapq_rounded = (int)(mapq + 0.5);
-	fprintf(fh, "%d", mapq_rounded);
-	while(*buf != '\t') {
-		// Copy orginal to buffer?
-		*orig_cur++ = *buf++;
-	}
-	*orig_cur = '\0';
-	while(*buf != '\n' && *buf != '\r') {
-		if(!keep_ztz && *buf == '\t') {
-			if(strncmp(buf+1, "ZT:Z:", 5) == 0) { // Remove the ZT:Z
-				buf += 6;
-				while(true) {
-					if(*buf == '\t' || *buf == '\n' || *buf == '\r') {
-						break;
-					}
-					buf++;
-				}
-			}
-			if(*buf == '\n' || *buf == '\r') {
-				break;
+	char num[64];
+	out.write(num, format_int(num, (long long)(int)(mapq + 0.5)));
+	const char *orig = cur;
+	cur = (const char *)memchr(cur, '\t', end - cur);
+	if(cur == NULL) {
+		cur = end;
+	}
+	const char *orig_end = cur;
+	const char *span = cur;
+	if(!keep_ztz) {
+		// Remove any ZT:Z fields
+		while((cur = (const char *)memchr(cur, '\t', end - cur)) != NULL) {
+			if(end - cur >= 6 && memcmp(cur + 1, "ZT:Z:", 5) == 0) {
+				out.write(span, cur - span);
+				const char *next = (const char *)memchr(cur + 6, '\t', end - cur - 6);
+				cur = span = (next == NULL) ? end : next;
+				continue;
 			}
+			cur++;
 		}
-		putc_unlocked(*buf, fh);
-		buf++;
 	}
+	out.write(span, end - span);
 	if(write_orig_mapq) {
-		fprintf(fh, "\t%s:%s", orig_mapq_flag, orig);
+		out.write("\t", 1);
+		out.puts(orig_mapq_flag);
+		out.write(":", 1);
+		out.write(orig, orig_end - orig);
 	}
 	if(write_precise_mapq) {
-		fprintf(fh, "\t%s:%0.3lf", precise_mapq_flag, mapq);
+		out.write("\t", 1);
+		out.puts(precise_mapq_flag);
+		out.write(":", 1);
+		out.write(num, format_fixed3(num, sizeof(num), mapq));
 	}
-	putc_unlocked('\n', fh);
+	out.write("\n", 1);
 }
 
-int main(int argc, char **argv) {
+/**
+ * Hands out the lines of a FILE, reading it a large block at a time and
+ * finding line ends with memchr.  A line longer than the block grows it.
+ */
+class LineReader {
+public:
+	explicit LineReader(FILE *fh) :
+		fh_(fh), buf_(BUFSZ), beg_(0), end_(0), eof_(false) { }
+
+	/**
+	 * Point line at the next line, len bytes long including its newline (if
+	 * any).  It stays valid until the next call.  Returns false at EOF.
+	 */
+	bool next(const char*& line, size_t& len) {
+		while(true) {
+			char *b = &buf_[0];
+			const char *nl = (const char *)memchr(b + beg_, '\n', end_ - beg_);
+			if(nl != NULL || (eof_ && beg_ < end_)) {
+				line = b + beg_;
+				len = (nl != NULL) ? (size_t)(nl + 1 - line) : end_ - beg_;
+				beg_ += len;
+				return true;
+			}
+			if(eof_) {
+				return false;
+			}
+			// Move partial line to the front and read more after it
+			memmove(b, b + beg_, end_ - beg_);
+			end_ -= beg_;
+			beg_ = 0;
+			if(end_ == buf_.size()) {
+				buf_.resize(2 * buf_.size());
+			}
+			size_t nread = fread(&buf_[end_], 1, buf_.size() - end_, fh_);
+			eof_ = (nread == 0);
+			end_ += nread;
+		}
+	}
+
+private:
+	FILE *fh_;
+	vector<char> buf_;
+	size_t beg_, end_;  // unread bytes in buf_
+	bool eof_;
+};
+
+struct RewriteCounts {
+	RewriteCounts() : nhead(0), nskip(0), nrewrite(0) { }
+
+	void add(const RewriteCounts& o) {
+		nhead += o.nhead;
+		nskip += o.nskip;
+		nrewrite += o.nrewrite;
+	}
+
+	size_t nhead, nskip, nrewrite;
+};
+
+/**
+ * Rewrite SAM lines read from fh_sam to out, stopping after nbytes bytes
+ * (or at EOF if nbytes < 0).  nline is the number of lines that precede the
+ * first line read, and is advanced past the lines read.  p is the next
+ * prediction from m, for a line at or after the first line read, and is
+ * left at the first prediction not used.  If keep_header is false, header
+ * lines are dropped without being counted as lines, as for all but the
+ * first of several SAMs rewritten as one.
+ */
+static void rewrite_range(
+	FILE *fh_sam,
+	OutputSink& out,
+	PredictionMerger& m,
+	Prediction& p,
+	unsigned long long& nline,
+	off_t nbytes,
+	bool keep_header,
+	RewriteCounts& cnt)
+{
+	LineReader rd(fh_sam);
+	const char *linebuf = NULL;
+	size_t len = 0;
+	off_t nread = 0;
+	while(nbytes < 0 || nread < nbytes) {
+		// Handle line of sam
+		if(!rd.next(linebuf, len)) {
+			break;
+		}
+		nread += len;
+		if(linebuf[0] == '@' && !keep_header) {
+			continue;
+		}
+		nline++;
+		assert(!p.valid() || nline <= p.line);
+		if(linebuf[0] == '@') {
+			cnt.nhead++;
+			out.write(linebuf, len);
+			continue; // skip header
+		}
+		if(!p.valid() || p.line > nline) {
+			out.write(linebuf, len); // no prediction for this line
+			cnt.nskip++;
+			continue;
+		}
+		assert(nline == p.line); // there is a prediction
+		rewrite(out, linebuf, len, p.mapq);
+		cnt.nrewrite++;
+		p = m.next(); // get next prediction
+	}
+}
+
+/**
+ * One line-aligned byte range of an input SAM, rewritten by its own thread
+ * into its own temporary file.
+ */
+struct RewriteShard {
+	const string *sam;
+	const PredictionSources *preds;
+	string tmpfn;
+	off_t begin, end;             // byte range in input SAM
+	unsigned long long nlines;    // newlines in [begin, end)
+	unsigned long long line_off;  // lines preceding begin, over all SAMs
+	off_t out_off, out_len;       // where shard lands in output
+	int out_fd;                   // final output, for the copy phase
+	RewriteCounts cnt;
+	bool ok;
+};
+
+/**
+ * Count the newlines in a shard's byte range, so that each shard can learn
+ * the line number its range starts at.
+ */
+static void *count_lines_worker(void *vp) {
+	RewriteShard& sh = *((RewriteShard *)vp);
+	sh.ok = false;
+	sh.nlines = 0;
+	int fd = open(sh.sam->c_str(), O_RDONLY);
+	if(fd < 0) {
+		return NULL;
+	}
+	vector<char> buf(BUFSZ);
+	off_t off = sh.begin;
+	while(off < sh.end) {
+		size_t toread = (size_t)min((off_t)BUFSZ, sh.end - off);
+		ssize_t nread = pread(fd, &buf[0], toread, off);
+		if(nread <= 0) {
+			close(fd);
+			return NULL;
+		}
+		const char *cur = &buf[0], *bufend = cur + nread;
+		while((cur = (const char *)memchr(cur, '\n', bufend - cur)) != NULL) {
+			sh.nlines++;
+			cur++;
+		}
+		off += nread;
+	}
+	close(fd);
+	sh.ok = true;
+	return NULL;
+}
+
+/**
+ * Rewrite a shard's byte range to out, finding its first prediction by
+ * seeking.  Returns false if the input can't be read or out can't be written.
+ */
+static bool rewrite_shard(RewriteShard& sh, OutputSink& out, RewriteCounts& cnt) {
+	FILE *fh_sam = fopen(sh.sam->c_str(), "rb");
+	if(fh_sam == NULL) {
+		return false;
+	}
+	vector<char> ibuf(BUFSZ);
+	setvbuf(fh_sam, &ibuf[0], _IOFBF, BUFSZ);
+	bool ok = false;
+	if(fseeko(fh_sam, sh.begin, SEEK_SET) == 0) {
+		PredictionMerger m(*sh.preds);
+		if(m.seek(sh.line_off + 1)) {
+			Prediction p = m.next();
+			unsigned long long nline = sh.line_off;
+			rewrite_range(fh_sam, out, m, p, nline, sh.end - sh.begin, true, cnt);
+			ok = ferror(fh_sam) == 0;
+		}
+	}
+	fclose(fh_sam);
+	return out.finish() && ok;
+}
+
+/**
+ * Rewrite a shard's byte range into its temporary file, compressing it if
+ * output is BGZF.
+ */
+static void *rewrite_shard_worker(void *vp) {
+	RewriteShard& sh = *((RewriteShard *)vp);
+	sh.ok = false;
+	FILE *osam_fh = fopen(sh.tmpfn.c_str(), "wb");
+	if(osam_fh == NULL) {
+		return NULL;
+	}
+	vector<char> obuf(BUFSZ);
+	setvbuf(osam_fh, &obuf[0], _IOFBF, BUFSZ);
+	if(output_bgzf) {
+		// Shards are already rewritten in parallel, so each compresses its
+		// own output with one thread; EOF block is added after concatenation
+		BgzfSink out(osam_fh, 1, compress_level, false);
+		sh.ok = rewrite_shard(sh, out, sh.cnt);
+	} else {
+		FileSink out(osam_fh);
+		sh.ok = rewrite_shard(sh, out, sh.cnt);
+	}
+	sh.ok = (fclose(osam_fh) == 0) && sh.ok;
+	return NULL;
+}
+
+/**
+ * Copy len bytes of in_fd from in_off to out_fd at out_off.
+ */
+static bool copy_range(int in_fd, off_t in_off, int out_fd, off_t out_off, off_t len, vector<char>& buf) {
+#if defined(__GLIBC__) && defined(__GLIBC_PREREQ)
+#if __GLIBC_PREREQ(2, 27)
+	// in-kernel copy, where the filesystem supports it
+	while(len > 0) {
+		loff_t ioff = in_off, ooff = out_off;
+		ssize_t ret = copy_file_range(in_fd, &ioff, out_fd, &ooff, (size_t)len, 0);
+		if(ret <= 0) {
+			break; // finish with read and write
+		}
+		in_off += ret;
+		out_off += ret;
+		len -= ret;
+	}
+#endif
+#endif
+	while(len > 0) {
+		ssize_t nread = pread(in_fd, &buf[0], (size_t)min((off_t)buf.size(), len), in_off);
+		if(nread <= 0) {
+			return false;
+		}
+		ssize_t nwritten = 0;
+		while(nwritten < nread) {
+			ssize_t ret = pwrite(out_fd, &buf[nwritten], nread - nwritten, out_off + nwritten);
+			if(ret <= 0) {
+				return false;
+			}
+			nwritten += ret;
+		}
+		in_off += nread;
+		out_off += nread;
+		len -= nread;
+	}
+	return true;
+}
+
+/**
+ * Copy a shard's temporary file into the final output at its offset.  The copy goes from the end back to the start a chunk at a time,
+ * truncating the temporary behind it, so the temporaries and the output
+ * together take up little more disk than the output alone.  The temporary
+ * is then removed.
+ */
+static void *copy_shard_worker(void *vp) {
+	RewriteShard& sh = *((RewriteShard *)vp);
+	const off_t chunk = 64 * 1024 * 1024;
+	sh.ok = false;
+	int fd = open(sh.tmpfn.c_str(), O_RDWR);
+	if(fd < 0) {
+		return NULL;
+	}
+	vector<char> buf(BUFSZ);
+	off_t end = sh.out_len;
+	while(end > 0) {
+		off_t beg = max((off_t)0, end - chunk);
+		if(!copy_range(fd, beg, sh.out_fd, sh.out_off + beg, end - beg, buf) ||
+		   ftruncate(fd, beg) != 0)
+		{
+			close(fd);
+			return NULL;
+		}
+		end = beg;
+	}
+	close(fd);
+	unlink(sh.tmpfn.c_str());
+	sh.ok = true;
+	return NULL;
+}
+
+/**
+ * Run the given worker over all shards, one thread per shard.  Returns false
+ * if any worker failed.
+ */
+static bool run_shards(vector<RewriteShard>& shards, void *(*worker)(void *)) {
+	vector<pthread_t> threads(shards.size());
+	for(size_t i = 0; i < shards.size(); i++) {
+		if(pthread_create(&threads[i], NULL, worker, (void *)&shards[i]) != 0) {
+			cerr << "Could not create rewrite thread" << endl;
+			throw 1;
+		}
+	}
+	bool ok = true;
+	for(size_t i = 0; i < shards.size(); i++) {
+		pthread_join(threads[i], NULL);
+		ok = ok && shards[i].ok;
+	}
+	return ok;
+}
+
+/**
+ * Find the offset just past the header of a SAM file.  Returns false if it
+ * can't be read.
+ */
+static bool header_end(const string& sam, off_t& off) {
+	FILE *fh = fopen(sam.c_str(), "rb");
+	if(fh == NULL) {
+		return false;
+	}
+	off = 0;
+	int c;
+	while((c = getc_unlocked(fh)) == '@') {
+		off++;
+		while((c = getc_unlocked(fh)) != EOF && c != '\n') {
+			off++;
+		}
+		if(c == EOF) {
+			break;
+		}
+		off++;
+	}
+	bool ok = ferror(fh) == 0;
+	fclose(fh);
+	return ok;
+}
+
+/**
+ * Cut [begin, end) of a SAM file into at most n ranges of about equal size,
+ * each starting just past a newline, adding the start of each to cuts.
+ */
+static bool cut_range(const string& sam, off_t begin, off_t end, int n, vector<off_t>& cuts) {
+	FILE *fh_sam = fopen(sam.c_str(), "rb");
+	if(fh_sam == NULL) {
+		return false;
+	}
+	cuts.push_back(begin);
+	for(int i = 1; i < n; i++) {
+		off_t cut = begin + ((end - begin) / n) * i;
+		if(cut <= cuts.back()) {
+			continue;
+		}
+		fseeko(fh_sam, cut - 1, SEEK_SET);
+		int c;
+		while((c = getc_unlocked(fh_sam)) != EOF && c != '\n') {
+			cut++;
+		}
+		if(c == EOF || cut >= end) {
+			break;
+		}
+		cuts.push_back(cut);
+	}
+	fclose(fh_sam);
+	return true;
+}
+
+/**
+ * Rewrite SAMs in parallel, as one SAM with the first one's header, by
+ * splitting the first SAM and the alignments of the rest into line-aligned
+ * byte ranges, with a share of the threads for each SAM proportional to its
+ * size.  Each range's starting line number is found by counting newlines in
+ * the preceding ranges, and its predictions are found by seeking.  Each
+ * range is rewritten (and compressed, for BGZF output) into a temporary
+ * file, and the temporaries are then moved into place at offsets given by
+ * the sizes of those before.
+ */
+static int rewrite_parallel(
+	const vector<string>& sams,
+	const PredictionSources& preds,
+	const string& outfn,
+	int nthreads,
+	RewriteCounts& cnt)
+{
+	// Range of each SAM to rewrite; headers of all but the first are dropped
+	vector<off_t> begins(sams.size(), 0), ends(sams.size(), 0);
+	off_t total = 0;
+	for(size_t i = 0; i < sams.size(); i++) {
+		struct stat st;
+		if(stat(sams[i].c_str(), &st) != 0 || (i > 0 && !header_end(sams[i], begins[i]))) {
+			cerr << "Could not open input SAM file \"" << sams[i] << "\"" << endl;
+			return -1;
+		}
+		ends[i] = st.st_size;
+		total += ends[i] - begins[i];
+	}
+	vector<RewriteShard> shards;
+	for(size_t i = 0; i < sams.size(); i++) {
+		if(ends[i] <= begins[i]) {
+			continue;
+		}
+		int n = (int)((double)nthreads * (ends[i] - begins[i]) / total + 0.5);
+		vector<off_t> cuts;
+		if(!cut_range(sams[i], begins[i], ends[i], max(n, 1), cuts)) {
+			cerr << "Could not open input SAM file \"" << sams[i] << "\"" << endl;
+			return -1;
+		}
+		cuts.push_back(ends[i]);
+		for(size_t j = 0; j + 1 < cuts.size(); j++) {
+			RewriteShard sh;
+			sh.sam = &sams[i];
+			sh.preds = &preds;
+			sh.begin = cuts[j];
+			sh.end = cuts[j+1];
+			char suffix[32];
+			snprintf(suffix, sizeof(suffix), ".shard%u", (unsigned)shards.size());
+			sh.tmpfn = outfn + suffix;
+			sh.out_fd = -1;
+			shards.push_back(sh);
+		}
+	}
+	cerr << "Rewriting in " << shards.size() << " shards" << endl;
+	if(!run_shards(shards, count_lines_worker)) {
+		cerr << "Could not count lines in input SAM files" << endl;
+		return -1;
+	}
+	unsigned long long line_off = 0;
+	for(size_t i = 0; i < shards.size(); i++) {
+		shards[i].line_off = line_off;
+		line_off += shards[i].nlines;
+	}
+	bool ok = run_shards(shards, rewrite_shard_worker);
+	for(size_t i = 0; i < shards.size() && ok; i++) {
+		struct stat st;
+		if(stat(shards[i].tmpfn.c_str(), &st) != 0) {
+			ok = false;
+			break;
+		}
+		shards[i].out_len = st.st_size;
+	}
+	off_t out_off = 0;
+	for(size_t i = 0; i < shards.size() && ok; i++) {
+		shards[i].out_off = out_off;
+		out_off += shards[i].out_len;
+	}
+	int out_fd = -1;
+	if(ok) {
+		out_fd = open(outfn.c_str(), O_WRONLY | O_CREAT | O_TRUNC, 0644);
+		ok = out_fd >= 0 && ftruncate(out_fd, out_off) == 0;
+		for(size_t i = 0; i < shards.size(); i++) {
+			shards[i].out_fd = out_fd;
+		}
+	}
+	if(ok && output_bgzf) {
+		// BGZF EOF marker goes after the last shard
+		FILE *fh = fdopen(dup(out_fd), "wb");
+		ok = fh != NULL && fseeko(fh, out_off, SEEK_SET) == 0 && BgzfWriter::writeEof(fh);
+		if(fh != NULL) {
+			ok = (fclose(fh) == 0) && ok;
+		}
+	}
+	ok = ok && run_shards(shards, copy_shard_worker);
+	for(size_t i = 0; i < shards.size() && ok; i++) {
+		cnt.add(shards[i].cnt);
+	}
+	if(out_fd >= 0) {
+		ok = (close(out_fd) == 0) && ok;
+	}
+	if(!ok) {
+		for(size_t i = 0; i < shards.size(); i++) {
+			unlink(shards[i].tmpfn.c_str());
+		}
+		cerr << "Error writing output SAM file \"" << outfn << "\"" << endl;
+		return -1;
+	}
+	return 0;
+}
+
+#ifndef REWRITE_MAIN
+/**
+ * Rewrite as the command line says, taking predictions from the in-memory
+ * arrays in bufs, with lens[i] pairs in bufs[i], as well as any files named.
+ */
+static int rewrite_main(
+	int argc,
+	char **argv,
+	const vector<const double *>& bufs,
+	const vector<size_t>& lens)
+{
+	set_default_options();
 
 	if(argc == 1) {
 		// print which arguments from ts.py should pass through to here
@@ -87,17 +655,23 @@ int main(int argc, char **argv) {
 		     << "precise-mapq-flag "
 		     << "write-orig-mapq "
 		     << "write-precise-mapq "
-		     << "keep-ztz" << endl;
+		     << "keep-ztz "
+		     << "rewrite-threads "
+		     << "compress-threads "
+		     << "compress-level "
+		     << "decompress-threads" << endl;
 		return 0;
 	}
 
 	string fn;
 	string outfn;
-	string sam;           // handle 1 SAM file per invocation
-	vector<string> preds; // might handle many prediction files; need merging
+	vector<string> sams;  // rewritten as one SAM, with the first's header
+	PredictionSources preds; // might handle many prediction files; need merging
+	preds.bufs = bufs;
+	preds.lens = lens;
 
-	// All arguments except last are SAM files to parse.  Final argument is
-	// output file.
+	// Sections: options, SAM files to rewrite, prediction files, output
+	// file.
 	{
 		int section = 0, outfn_set = 0;
 		for(int i = 1; i < argc; i++) {
@@ -125,10 +699,25 @@ int main(int argc, char **argv) {
 				if(strcmp(argv[i], "keep-ztz") == 0) {
 					keep_ztz = strcmp(argv[++i], "True") == 0;
 				}
+				if(strcmp(argv[i], "rewrite-threads") == 0) {
+					rewrite_threads = atoi(argv[++i]);
+				}
+				if(strcmp(argv[i], "output-bgzf") == 0) {
+					output_bgzf = strcmp(argv[++i], "True") == 0;
+				}
+				if(strcmp(argv[i], "compress-threads") == 0) {
+					compress_threads = atoi(argv[++i]);
+				}
+				if(strcmp(argv[i], "compress-level") == 0) {
+					compress_level = atoi(argv[++i]);
+				}
+				if(strcmp(argv[i], "decompress-threads") == 0) {
+					decompress_threads = atoi(argv[++i]);
+				}
 			} else if(section == 1) {
-				sam = argv[i];
+				sams.push_back(string(argv[i]));
 			} else if(section == 2) {
-				preds.push_back(string(argv[i]));
+				preds.fns.push_back(string(argv[i]));
 			} else {
 				outfn = argv[i];
 				outfn_set++;
@@ -137,72 +726,286 @@ int main(int argc, char **argv) {
 				cerr << "Warning: More than output file specified; using last one: \"" << outfn << "\"" << endl;
 			}
 		}
-		if(sam.empty() || !outfn_set) {
+		if(sams.empty() || !outfn_set) {
 			cerr << "Usage: qtip_rewrite" << endl;
 		}
 	}
 
-	// Output SAM file
-    char osam_buf[BUFSZ];
-	FILE *osam_fh = fopen(outfn.c_str(), "wb");
+	RewriteCounts cnt;
+
+	if(rewrite_threads > 1) {
+		// Sharding needs regular, uncompressed input files and seekable
+		// predictions, so not ones from a pipe
+		bool can_shard = outfn != "-";
+		for(size_t i = 0; i < sams.size(); i++) {
+			struct stat st;
+			if(stat(sams[i].c_str(), &st) != 0 || !S_ISREG(st.st_mode) ||
+			   is_gzip_file(sams[i].c_str()))
+			{
+				can_shard = false;
+			}
+		}
+		for(size_t i = 0; i < preds.fns.size(); i++) {
+			struct stat pst;
+			if(preds.fns[i] == "-" || stat(preds.fns[i].c_str(), &pst) != 0 ||
+			   !S_ISREG(pst.st_mode))
+			{
+				can_shard = false;
+			}
+		}
+		if(can_shard) {
+			for(size_t i = 0; i < sams.size(); i++) {
+				cerr << "Parsing SAM file \"" << sams[i] << "\" with "
+				     << rewrite_threads << " threads" << endl;
+			}
+			if(rewrite_parallel(sams, preds, outfn, rewrite_threads, cnt) != 0) {
+				return -1;
+			}
+			cerr << "Header lines:  " << cnt.nhead << endl;
+			cerr << "Skipped lines (did not rewrite MAPQ): " << cnt.nskip << endl;
+			cerr << "Lines with rewritten MAPQ: " << cnt.nrewrite << endl;
+			return 0;
+		}
+		cerr << "Warning: input can't be sharded; rewriting with 1 thread" << endl;
+	}
+
+	// Output SAM file; "-" means standard out
+	vector<char> osam_buf(BUFSZ);
+	FILE *osam_fh = (outfn == "-") ? stdout : fopen(outfn.c_str(), "wb");
 	if(osam_fh == NULL) {
 	    cerr << "Could not open output SAM file \"" << outfn << "\"" << endl;
 		return -1;
 	}
-	setvbuf(osam_fh, osam_buf, _IOFBF, BUFSZ); \
-
-	// Input SAM file
-	char buf_input_sam[BUFSZ];
-	FILE *fh_sam = fopen(sam.c_str(), "rb");
-	if(fh_sam == NULL) {
-		cerr << "Could not open input SAM file \"" << sam << "\"" << endl;
-		return -1;
+	setvbuf(osam_fh, &osam_buf[0], _IOFBF, BUFSZ);
+	OutputSink *out = NULL;
+	if(output_bgzf) {
+		out = new BgzfSink(osam_fh, compress_threads, compress_level, true);
+	} else {
+		out = new FileSink(osam_fh);
 	}
-	setvbuf(fh_sam, buf_input_sam, _IOFBF, BUFSZ);
-
-	cerr << "Parsing SAM file \"" << sam << "\"" << endl;
 
 	// Input prediction file
 	PredictionMerger m(preds);
-	bool done_with_predictions = false;
-	bool done_with_sam = false;
-	char linebuf[BUFSZ];
-	size_t nline = 0, nhead = 0;
-	size_t nskip = 0, nrewrite = 0;
-	while(!done_with_predictions || !done_with_sam) {
-		Prediction p = m.next();
-		done_with_predictions = !p.valid();
-		while(true) {
-			// Handle line of sam
-			if(fgets(linebuf, BUFSZ, fh_sam) == NULL) {
-				assert(done_with_predictions);
-				done_with_sam = true;
-				break;
-			}
-			nline++;
-			assert(done_with_predictions || nline <= p.line);
-			if(linebuf[0] == '@') {
-				nhead++;
-				fputs(linebuf, osam_fh);
-				continue; // skip header
-			}
-			if(done_with_predictions || p.line > nline) {
-				fputs(linebuf, osam_fh); // no prediction for this line
-				nskip++;
-				continue;
-			}
-			assert(nline == p.line); // there is a prediction
-			rewrite(osam_fh, linebuf, p.mapq);
-			nrewrite++;
-			break; // get next prediction
+	Prediction p = m.next();
+	unsigned long long nline = 0;
+
+	vector<char> buf_input_sam(BUFSZ);
+	for(size_t i = 0; i < sams.size(); i++) {
+		// Input SAM file; may be compressed SAM or BAM
+		FILE *fh_sam = open_sam_input(sams[i].c_str(), decompress_threads);
+		if(fh_sam == NULL) {
+			cerr << "Could not open input SAM file \"" << sams[i] << "\"" << endl;
+			return -1;
+		}
+		setvbuf(fh_sam, &buf_input_sam[0], _IOFBF, BUFSZ);
+
+		cerr << "Parsing SAM file \"" << sams[i] << "\"" << endl;
+
+		rewrite_range(fh_sam, *out, m, p, nline, -1, i == 0, cnt);
+		if(close_sam_input(fh_sam) != 0) {
+			cerr << "Error reading input SAM file \"" << sams[i] << "\"" << endl;
+			return -1;
 		}
 	}
-	assert(done_with_predictions && done_with_sam);
-	fclose(fh_sam);
+	assert(!p.valid());
+	bool ok = out->finish();
+	delete out;
+	ok = (fclose(osam_fh) == 0) && ok;
+	if(!ok) {
+		cerr << "Error writing output SAM file \"" << outfn << "\"" << endl;
+		return -1;
+	}
 
-	cerr << "Header lines:  " << nhead << endl;
-	cerr << "Skipped lines (did not rewrite MAPQ): " << nskip << endl;
-	cerr << "Lines with rewritten MAPQ: " << nrewrite << endl;
+	cerr << "Header lines:  " << cnt.nhead << endl;
+	cerr << "Skipped lines (did not rewrite MAPQ): " << cnt.nskip << endl;
+	cerr << "Lines with rewritten MAPQ: " << cnt.nrewrite << endl;
 
 	return 0;
 }
+
+#ifdef QTIP_LIB
+int qtip_rewrite(int argc, char **argv, const double **bufs, const size_t *lens, int nbufs) {
+	try {
+		return rewrite_main(argc, argv,
+		                    vector<const double *>(bufs, bufs + nbufs),
+		                    vector<size_t>(lens, lens + nbufs));
+	} catch(int e) {
+		return -1;
+	}
+}
+#else
+int main(int argc, char **argv) {
+	return rewrite_main(argc, argv, vector<const double *>(), vector<size_t>());
+}
+#endif
+#else
+
+/**
+ * Sink that collects output in a string.
+ */
+class StringSink : public OutputSink {
+public:
+	virtual void write(const char *buf, size_t len) {
+		s.append(buf, len);
+	}
+
+	virtual bool finish() {
+		return true;
+	}
+
+	string s;
+};
+
+/**
+ * Formatters agree with snprintf, including at and near rounding ties.
+ */
+static void test1() {
+	char fast[64], slow[64];
+	long long ints[] = {0, 1, 9, 10, 42, 255, -1, -60, 2147483647LL, -2147483647LL};
+	for(size_t i = 0; i < sizeof(ints) / sizeof(ints[0]); i++) {
+		size_t n = format_int(fast, ints[i]);
+		snprintf(slow, sizeof(slow), "%lld", ints[i]);
+		assert(n == strlen(slow) && memcmp(fast, slow, n) == 0);
+	}
+	vector<double> xs;
+	for(int i = 0; i <= 200000; i++) {
+		xs.push_back(i / 2000.0);        // ties and exact thousandths
+		xs.push_back(i / 2000.0 + 1e-9);
+		xs.push_back(i / 2000.0 - 1e-9);
+		xs.push_back(i * 0.000731);
+	}
+	xs.push_back(-0.0004);
+	xs.push_back(-3.25);
+	xs.push_back(1e20);
+	for(size_t i = 0; i < xs.size(); i++) {
+		size_t n = format_fixed3(fast, sizeof(fast), xs[i]);
+		snprintf(slow, sizeof(slow), "%0.3lf", xs[i]);
+		assert(n == strlen(slow) && memcmp(fast, slow, n) == 0);
+	}
+}
+
+/**
+ * MAPQ is replaced, ZT:Z fields removed and extra fields appended.
+ */
+static void test2() {
+	const char *line = "r1\t0\tchr1\t100\t7\t4M\t*\t0\t0\tACGT\tIIII\tZT:Z:1,2,3\tXS:i:5\tZT:Z:\r\n";
+	StringSink out;
+	rewrite(out, line, strlen(line), 41.6);
+	assert(out.s == "r1\t0\tchr1\t100\t42\t4M\t*\t0\t0\tACGT\tIIII\tXS:i:5\n");
+	write_orig_mapq = write_precise_mapq = keep_ztz = true;
+	out.s.clear();
+	rewrite(out, line, strlen(line) - 2, 12.3456);
+	assert(out.s == "r1\t0\tchr1\t100\t12\t4M\t*\t0\t0\tACGT\tIIII\tZT:Z:1,2,3\tXS:i:5\tZT:Z:\tZm:i:7\tZp:Z:12.346\n");
+	write_orig_mapq = write_precise_mapq = keep_ztz = false;
+}
+
+/**
+ * Lines come back whole across block boundaries, including lines longer
+ * than a block and a final line with no newline.
+ */
+static void test3() {
+	const char *fn = ".rewrite.test3.sam";
+	FILE *fh = fopen(fn, "wb");
+	assert(fh != NULL);
+	vector<string> lines;
+	for(size_t i = 0; i < 2000; i++) {
+		string l(((i * 7919) % 1000) + (i == 1000 ? 3 * BUFSZ : 0), (char)('a' + i % 26));
+		l += (i == 1999) ? "" : "\n";
+		lines.push_back(l);
+		fwrite(l.data(), 1, l.size(), fh);
+	}
+	fclose(fh);
+	fh = fopen(fn, "rb");
+	assert(fh != NULL);
+	LineReader rd(fh);
+	const char *line = NULL;
+	size_t len = 0;
+	for(size_t i = 0; i < lines.size(); i++) {
+		bool ret = rd.next(line, len);
+		assert(ret);
+		assert(string(line, len) == lines[i]);
+	}
+	assert(!rd.next(line, len));
+	fclose(fh);
+	remove(fn);
+}
+
+/**
+ * Read a whole file into a string.
+ */
+static string slurp(const char *fn) {
+	string s;
+	FILE *fh = fopen(fn, "rb");
+	assert(fh != NULL);
+	char buf[4096];
+	size_t n;
+	while((n = fread(buf, 1, sizeof(buf), fh)) > 0) {
+		s.append(buf, n);
+	}
+	fclose(fh);
+	return s;
+}
+
+/**
+ * Several SAMs, one with no alignments, are rewritten in parallel just as
+ * their concatenation with only the first header would be.
+ */
+static void test4() {
+	const char *hdr = "@HD\tVN:1.0\n@SQ\tSN:chr1\tLN:1000\n";
+	const char *fns[3] = {".rewrite.test4.0.sam", ".rewrite.test4.1.sam", ".rewrite.test4.2.sam"};
+	const int nalns[3] = {50, 0, 70};
+	const char *cat_fn = ".rewrite.test4.sam";
+	FILE *cat_fh = fopen(cat_fn, "wb");
+	assert(cat_fh != NULL);
+	fputs(hdr, cat_fh);
+	int id = 0;
+	for(int i = 0; i < 3; i++) {
+		FILE *fh = fopen(fns[i], "wb");
+		assert(fh != NULL);
+		fputs(hdr, fh);
+		for(int j = 0; j < nalns[i]; j++, id++) {
+			char line[256];
+			snprintf(line, sizeof(line), "r%d\t0\tchr1\t%d\t7\t4M\t*\t0\t0\tACGT\tIIII\n", id, 100 + id);
+			fputs(line, fh);
+			fputs(line, cat_fh);
+		}
+		fclose(fh);
+	}
+	fclose(cat_fh);
+	off_t off = 0;
+	assert(header_end(fns[1], off) && off == (off_t)strlen(hdr));
+	// prediction for every other alignment; lines count the 2 header lines
+	vector<double> recs;
+	for(int i = 0; i < id; i += 2) {
+		recs.push_back(3 + i);
+		recs.push_back(i % 60);
+	}
+	PredictionSources preds;
+	preds.bufs.push_back(&recs[0]);
+	preds.lens.push_back(recs.size() / 2);
+	vector<string> cat(1, string(cat_fn)), sams(fns, fns + 3);
+	RewriteCounts cnt1, cnt2;
+	int ret = rewrite_parallel(cat, preds, ".rewrite.test4.out1.sam", 4, cnt1);
+	assert(ret == 0);
+	ret = rewrite_parallel(sams, preds, ".rewrite.test4.out2.sam", 4, cnt2);
+	assert(ret == 0);
+	assert(slurp(".rewrite.test4.out1.sam") == slurp(".rewrite.test4.out2.sam"));
+	assert(cnt1.nhead == 2 && cnt2.nhead == 2);
+	assert(cnt1.nrewrite == 60 && cnt2.nrewrite == 60);
+	for(int i = 0; i < 3; i++) {
+		remove(fns[i]);
+	}
+	remove(cat_fn);
+	remove(".rewrite.test4.out1.sam");
+	remove(".rewrite.test4.out2.sam");
+}
+
+int main(void) {
+	set_default_options();
+	test1();
+	test2();
+	test3();
+	test4();
+	cout << "ALL TESTS PASSED" << endl;
+}
+#endif
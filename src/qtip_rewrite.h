@@ -10,5 +10,88 @@
 #define __qtip__qtip_rewrite__
 
 #include <stdio.h>
+#include <string.h>
+#include <vector>
+#include "bgzf.h"
+
+/**
+ * Destination for rewritten SAM text.
+ */
+class OutputSink {
+public:
+	virtual ~OutputSink() { }
+
+	virtual void write(const char *buf, size_t len) = 0;
+
+	void puts(const char *s) {
+		write(s, strlen(s));
+	}
+
+	/**
+	 * Write out anything buffered; return false if there was an error.
+	 * Does not close the underlying file.
+	 */
+	virtual bool finish() = 0;
+};
+
+/**
+ * Plain, uncompressed output to a FILE.  Small writes are gathered into a
+ * large buffer that's handed to the FILE in one call when full, so output
+ * goes out in large writes rather than one stdio call per span.
+ */
+class FileSink : public OutputSink {
+public:
+	explicit FileSink(FILE *fh, size_t bufsz = (1 << 20)) :
+		fh_(fh), buf_(bufsz), cur_(0) { }
+
+	virtual void write(const char *buf, size_t len) {
+		if(len > buf_.size() - cur_) {
+			flush();
+			if(len >= buf_.size()) {
+				fwrite(buf, 1, len, fh_);
+				return;
+			}
+		}
+		memcpy(&buf_[cur_], buf, len);
+		cur_ += len;
+	}
+
+	virtual bool finish() {
+		flush();
+		return fflush(fh_) == 0 && ferror(fh_) == 0;
+	}
+
+private:
+	void flush() {
+		if(cur_ > 0) {
+			fwrite(&buf_[0], 1, cur_, fh_);
+			cur_ = 0;
+		}
+	}
+
+	FILE *fh_;
+	std::vector<char> buf_;
+	size_t cur_;  // bytes used in buf_
+};
+
+/**
+ * BGZF-compressed output to a FILE, compressed by a pool of threads.
+ */
+class BgzfSink : public OutputSink {
+public:
+	BgzfSink(FILE *fh, int nthreads, int level, bool write_eof) :
+		w_(fh, nthreads, level, write_eof) { }
+
+	virtual void write(const char *buf, size_t len) {
+		w_.write(buf, len);
+	}
+
+	virtual bool finish() {
+		return w_.close();
+	}
+
+private:
+	BgzfWriter w_;
+};
 
 #endif /* defined(__qtip__qtip_rewrite__) */
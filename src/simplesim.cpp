@@ -7,6 +7,7 @@
 //
 
 #include <stdlib.h>
+#include <string.h>
 #include <vector>
 #include <iostream>
 #include <cctype>
@@ -15,6 +16,7 @@
 #include "fasta.h"
 #include "rnglib.hpp"
 #include "edit_xscript.h"
+#include "bgzf.h"
 
 using namespace std;
 
@@ -28,7 +30,7 @@ static inline size_t draw_binomial(size_t n, float p) {
 /**
  * Mutate given simulated read in-place.
  */
-void SimulatedRead::mutate(const char *seq) {
+void SimulatedRead::mutate(const char *seq, SimRng *rng) {
 	const size_t newsz = strlen(qual_);
 	while(newsz+1 >= seq_buf_len_) {
 		double_seq_buf();
@@ -44,16 +46,16 @@ void SimulatedRead::mutate(const char *seq) {
 			assert(seq[rfoff] != '\0');
 			assert(isalpha(seq[rfoff]));
 			do {
-				seq_buf_[rdoff] = draw_base();
+				seq_buf_[rdoff] = draw_base(rng);
 			} while(seq_buf_[rdoff] == seq[rfoff]);
 			rdoff++;
 			rfoff++;
 		} else if(edit_xscript_[i] == 'I') {
-			seq_buf_[rdoff++] = draw_base();
+			seq_buf_[rdoff++] = draw_base(rng);
 		} else if(edit_xscript_[i] == 'D') {
 			rfoff++;
 		} else if(edit_xscript_[i] == 'S') {
-			seq_buf_[rdoff++] = draw_base();
+			seq_buf_[rdoff++] = draw_base(rng);
 			rfoff++;
 		} else {
 			throw 1;
@@ -96,48 +98,66 @@ char asc2dnacomp[] = {
 };
 
 /**
- * Write a simulated read to an output file.
+ * Write sequence, reverse-complemented if read aligned to reverse strand.
  */
-void SimulatedRead::write(FILE *fh, const char *typ) {
-	size_t len = strlen(qual_);
-	fprintf(fh, "@%s%c%s%c%c%c%llu%c%d%c%s\n",
-			sim_startswith, sim_sep,
-			refid_, sim_sep,
-			fw_ ? '+' : '-', sim_sep,
-			(unsigned long long)refoff_, sim_sep,
-			score_, sim_sep,
-			typ);
-	if(fw_) {
-		fputs(seq_buf_, fh);
+static void write_seq(FILE *fh, const char *seq, size_t len, bool fw) {
+	if(fw) {
+		fputs(seq, fh);
 	} else {
 		for(size_t i = 0; i < len; i++) {
-			fputc(asc2dnacomp[(int)seq_buf_[len-i-1]], fh);
+			fputc(asc2dnacomp[(int)seq[len-i-1]], fh);
 		}
 	}
-	fputs("\n+\n", fh);
-	if(fw_) {
-		fputs(qual_, fh);
+}
+
+/**
+ * Write qualities, reversed if read aligned to reverse strand.
+ */
+static void write_qual(FILE *fh, const char *qual, size_t len, bool fw) {
+	if(fw) {
+		fputs(qual, fh);
 	} else {
 		for(size_t i = 0; i < len; i++) {
-			fputc(qual_[len-i-1], fh);
+			fputc(qual[len-i-1], fh);
 		}
 	}
+}
+
+/**
+ * Write a simulated read to an output file, as FASTQ or as a Bowtie 2
+ * --tab6 line.
+ */
+void SimulatedRead::write(FILE *fh, const char *typ, bool tab6) {
+	size_t len = strlen(qual_);
+	fprintf(fh, tab6 ? "%s%c%s%c%c%c%llu%c%d%c%s\t" : "@%s%c%s%c%c%c%llu%c%d%c%s\n",
+			sim_startswith, sim_sep,
+			refid_, sim_sep,
+			fw_ ? '+' : '-', sim_sep,
+			(unsigned long long)refoff_, sim_sep,
+			score_, sim_sep,
+			typ);
+	write_seq(fh, seq_buf_, len, fw_);
+	fputs(tab6 ? "\t" : "\n+\n", fh);
+	write_qual(fh, qual_, len, fw_);
 	fputc('\n', fh);
 }
 
 /**
- * Write pair of simulated reads to parallel FASTQ files.
+ * Write pair of simulated reads to parallel FASTQ files, or to fh1 as one
+ * Bowtie 2 --tab6 line.
  */
 void SimulatedRead::write_pair(
 	const SimulatedRead& rd1,
 	const SimulatedRead& rd2,
 	FILE *fh1,
 	FILE *fh2,
-	const char *typ)
+	const char *typ,
+	bool tab6)
 {
-	FILE *fhs[2] = {fh1, fh2};
+	FILE *fhs[2] = {fh1, tab6 ? fh1 : fh2};
 	for(size_t i = 0; i < 2; i++) {
-		fprintf(fhs[i], "@%s%c%s%c%c%c%llu%c%d%c%s%c%c%c%llu%c%d%c%s\n",
+		fprintf(fhs[i], tab6 ? "%s%c%s%c%c%c%llu%c%d%c%s%c%c%c%llu%c%d%c%s\t" :
+		                       "@%s%c%s%c%c%c%llu%c%d%c%s%c%c%c%llu%c%d%c%s\n",
 				sim_startswith, sim_sep,
 				rd1.refid_, sim_sep,
 				rd1.fw_ ? '+' : '-', sim_sep, // got different fws
@@ -150,22 +170,10 @@ void SimulatedRead::write_pair(
 				typ);
 		const SimulatedRead &rd = ((i == 0) ? rd1 : rd2);
 		size_t len = strlen(rd.qual_);
-		if(rd.fw_) {
-			fputs(rd.seq_buf_, fhs[i]);
-		} else {
-			for(size_t j = 0; j < len; j++) {
-				fputc(asc2dnacomp[(int)rd.seq_buf_[len-j-1]], fhs[i]);
-			}
-		}
-		fputs("\n+\n", fhs[i]);
-		if(rd.fw_) {
-			fputs(rd.qual_, fhs[i]);
-		} else {
-			for(size_t j = 0; j < len; j++) {
-				fputc(rd.qual_[len-j-1], fhs[i]);
-			}
-		}
-		fputc('\n', fhs[i]);
+		write_seq(fhs[i], rd.seq_buf_, len, rd.fw_);
+		fputs(tab6 ? "\t" : "\n+\n", fhs[i]);
+		write_qual(fhs[i], rd.qual_, len, rd.fw_);
+		fputc((tab6 && i == 0) ? '\t' : '\n', fhs[i]);
 	}
 }
 
@@ -188,6 +196,51 @@ size_t apply_function(float fraction, int function, size_t mn, size_t n) {
     return std::max((size_t)nn, mn);
 }
 
+/**
+ * A chunk of the reference, how many reads of each type to simulate from it,
+ * and buffers holding the simulated reads.  Output slots are unpaired, then
+ * mates 1 and 2 of bad-end, concordant and discordant pairs.
+ */
+struct SimChunk {
+
+	SimChunk() : refoff(0) {
+		for(int i = 0; i < 7; i++) {
+			out[i] = NULL;
+			outsz[i] = 0;
+		}
+	}
+
+	std::string seq;
+	std::string refid;
+	size_t refoff;
+	size_t nsamp[4];   // reads to simulate: u, b, c, d
+	size_t n_wrote[4]; // reads simulated: u, b, c, d
+	SimRng rng;
+	char *out[7];
+	size_t outsz[7];
+};
+
+struct SimChunkBatch {
+	const StreamingSimulator *ss;
+	std::vector<SimChunk> *chunks;
+};
+
+void StreamingSimulator::simulate_chunk_job(void *ctx, size_t i) {
+	SimChunkBatch& b = *(SimChunkBatch*)ctx;
+	b.ss->simulate_chunk((*b.chunks)[i]);
+}
+
+/**
+ * Scale a category's number of reads to simulate, or return 0 if the
+ * category isn't among cats.
+ */
+static size_t scale_count(size_t n, float scale, const char *cats, char cat) {
+	if(strchr(cats, cat) == NULL) {
+		return 0;
+	}
+	return (size_t)(n * (double)scale + 0.5);
+}
+
 /**
  * Simulate a batch of reads
  */
@@ -197,25 +250,33 @@ void StreamingSimulator::simulate_batch(
 	size_t min_u,
 	size_t min_c,
 	size_t min_d,
-	size_t min_b)
+	size_t min_b,
+	float scale,
+	const char *cats)
 {
 	size_t nc = 0, nd = 0, nu = 0, nb = 0;
-	size_t n_wrote_c = 0, n_wrote_d = 0, n_wrote_u = 0, n_wrote_b = 0;
-	nu = apply_function(fraction, function, min_u, model_u_.num_added());
-	nb = apply_function(fraction, function, min_b, model_b_.num_added());
-	nc = apply_function(fraction, function, min_c, model_c_.num_added());
-	nd = apply_function(fraction, function, min_d, model_d_.num_added());
+	nu = scale_count(apply_function(fraction, function, min_u, model_u_.num_added()), scale, cats, 'u');
+	nb = scale_count(apply_function(fraction, function, min_b, model_b_.num_added()), scale, cats, 'b');
+	nc = scale_count(apply_function(fraction, function, min_c, model_c_.num_added()), scale, cats, 'c');
+	nd = scale_count(apply_function(fraction, function, min_d, model_d_.num_added()), scale, cats, 'd');
 	assert(nu + nb + nc + nd > 0);
-	
+	for(int i = 0; i < 4; i++) {
+		n_wrote_[i] = 0;
+	}
+
 	std::string refid, refid_full;
 	size_t refoff = 0, retsz = 0;
-	SimulatedRead rd1, rd2;
-	int hist[256];
-	const int max_attempts = 10;
+	BatchPool pool(nthreads_);
+	std::vector<SimChunk> chunks(2 * nthreads_);
+	size_t nchunk = 0;
+	uint64_t chunk_idx = 0;
 	while(true) {
 		const char * buf = fa_.next(refid, refid_full, refoff, retsz);
-		if(buf == NULL && fa_.done()) {
-			break; // finished scanning FASTA
+		if(buf == NULL) {
+			if(fa_.done()) {
+				break; // finished scanning FASTA
+			}
+			continue; // finished a FASTA file
 		}
 		if(retsz < olap_) {
 			continue; // chunk is too small to simulate fragments from
@@ -223,41 +284,167 @@ void StreamingSimulator::simulate_batch(
 		const size_t nchances = retsz - olap_ + 1; // # draws within window
 
 		const float binom_p = min(((float)nchances) * 1.1f / tot_fasta_len_, 0.999f);
-		// Histogram characters
-		memset(hist, 0, sizeof(int) * 256);
-		for(size_t i = 0; i < retsz; i++) {
-			hist[(int)buf[i]]++;
+
+		// Counts are drawn here, in FASTA order, with the global generator;
+		// everything else is drawn with the chunk's own generator
+		SimChunk& c = chunks[nchunk++];
+		c.seq.assign(buf, retsz);
+		c.refid = refid;
+		c.refoff = refoff;
+		c.rng.init(seed_, chunk_idx++);
+		c.nsamp[0] = draw_binomial(nu, binom_p);
+		c.nsamp[1] = draw_binomial(nb, binom_p);
+		c.nsamp[2] = draw_binomial(nc, binom_p);
+		c.nsamp[3] = draw_binomial(nd, binom_p);
+		if(nchunk == chunks.size()) {
+			run_chunks(pool, chunks, nchunk);
+			nchunk = 0;
+		}
+	}
+	run_chunks(pool, chunks, nchunk);
+	cerr << "    Wrote " << n_wrote_[0] << " unpaired tandem reads "
+	     << "(target=" << nu << ")" << endl;
+	cerr << "    Wrote " << n_wrote_[1] << " bad-end tandem reads "
+	     << "(target=" << nb << ")" << endl;
+	cerr << "    Wrote " << n_wrote_[2] << " concordant tandem pairs "
+	     << "(target=" << nc << ")" << endl;
+	cerr << "    Wrote " << n_wrote_[3] << " discordant tandem pairs "
+	     << "(target=" << nd << ")" << endl;
+}
+
+void StreamingSimulator::run_chunks(
+	BatchPool& pool,
+	std::vector<SimChunk>& chunks,
+	size_t n)
+{
+	SimChunkBatch batch;
+	batch.ss = this;
+	batch.chunks = &chunks;
+	pool.run(n, simulate_chunk_job, &batch);
+	FILE *fhs[7] = {fh_u_, fh_b_1_, fh_b_2_, fh_c_1_, fh_c_2_, fh_d_1_, fh_d_2_};
+	for(size_t i = 0; i < n; i++) {
+		SimChunk& c = chunks[i];
+		for(int j = 0; j < 7; j++) {
+			if(c.out[j] != NULL) {
+				fwrite(c.out[j], 1, c.outsz[j], fhs[j]);
+				free(c.out[j]);
+				c.out[j] = NULL;
+				c.outsz[j] = 0;
+			}
 		}
-		if(hist['N'] > (int)(0.9 * retsz)) {
-			continue; // skip chunks that are mostly Ns
+		for(int j = 0; j < 4; j++) {
+			n_wrote_[j] += c.n_wrote[j];
 		}
-		
-		// Maybe N content should affect choice for n*_chances
-		
-		//
-		// Unpaired
-		//
-		
-		size_t nu_samp = draw_binomial(nu, binom_p);
-		for(size_t i = 0; i < nu_samp; i++) {
-			int attempts = 0;
-			do {
-				if(attempts > max_attempts) {
-					break;
+	}
+}
+
+/**
+ * Simulate reads from a chunk.  Run by a BatchPool, so draws only from the
+ * chunk's generator and writes only to the chunk's buffers.
+ */
+void StreamingSimulator::simulate_chunk(SimChunk& c) const {
+	const char *buf = c.seq.c_str();
+	const size_t retsz = c.seq.length();
+	const size_t refoff = c.refoff;
+	const std::string& refid = c.refid;
+	SimRng *rng = &c.rng;
+	for(int i = 0; i < 4; i++) {
+		c.n_wrote[i] = 0;
+	}
+
+	int hist[256];
+	// Histogram characters
+	memset(hist, 0, sizeof(int) * 256);
+	for(size_t i = 0; i < retsz; i++) {
+		hist[(int)buf[i]]++;
+	}
+	if(hist['N'] > (int)(0.9 * retsz)) {
+		return; // skip chunks that are mostly Ns
+	}
+
+	// With --tab6, all reads go to the first buffer, in the order simulated
+	const FILE *dsts[7] = {fh_u_, fh_b_1_, fh_b_2_, fh_c_1_, fh_c_2_, fh_d_1_, fh_d_2_};
+	FILE *fhs[7];
+	for(int i = 0; i < 7; i++) {
+		fhs[i] = NULL;
+		if(i > 0 && tab6_) {
+			fhs[i] = fhs[0];
+		} else if(dsts[i] != NULL) {
+			fhs[i] = open_memstream(&c.out[i], &c.outsz[i]);
+			assert(fhs[i] != NULL);
+		}
+	}
+	FILE *fh_u = fhs[0], *fh_b_1 = fhs[1], *fh_b_2 = fhs[2],
+	     *fh_c_1 = fhs[3], *fh_c_2 = fhs[4], *fh_d_1 = fhs[5], *fh_d_2 = fhs[6];
+
+	SimulatedRead rd1, rd2;
+	const int max_attempts = 10;
+
+	// Maybe N content should affect choice for n*_chances
+
+	//
+	// Unpaired
+	//
+
+	size_t nu_samp = c.nsamp[0];
+	for(size_t i = 0; i < nu_samp; i++) {
+		int attempts = 0;
+		do {
+			if(attempts > max_attempts) {
+				break;
+			}
+			attempts++;
+			const TemplateUnpaired &t = model_u_.draw(rng->uni_01());
+			size_t nslots = retsz - olap_;
+			assert(nslots > 0);
+			size_t off = std::min((size_t)(rng->uni_01() * nslots), nslots-1);
+			assert(off < nslots);
+			const size_t rflen = t.reflen();
+			for(size_t j = off; j < off + rflen; j++) {
+				const int b = buf[j];
+				if(b != 'A' && b != 'C' && b != 'G' && b != 'T') {
+					continue; // uses 1 attempt
 				}
-				attempts++;
-				const TemplateUnpaired &t = model_u_.draw();
-				size_t nslots = retsz - olap_;
-				assert(nslots > 0);
-				size_t off = std::min((size_t)(r4_uni_01() * nslots), nslots-1);
-				assert(off < nslots);
-				const size_t rflen = t.reflen();
-				for(size_t j = off; j < off + rflen; j++) {
-					const int b = buf[j];
-					if(b != 'A' && b != 'C' && b != 'G' && b != 'T') {
-						continue; // uses 1 attempt
-					}
+			}
+			rd1.init(
+				buf + off,
+				t.qual_,
+				t.edit_xscript_,
+				t.fw_flag_ == 'T',
+				t.best_score_,
+				refid.c_str(),
+				refoff + off,
+				rng);
+			c.n_wrote[0]++;
+			rd1.write(fh_u, "u", tab6_);
+		} while(false);
+	}
+	
+	//
+	// Bad-end
+	//
+
+	size_t nb_samp = c.nsamp[1];
+	for(size_t i = 0; i < nb_samp; i++) {
+		int attempts = 0;
+		do {
+			if(attempts > max_attempts) {
+				break;
+			}
+			attempts++;
+			const TemplateUnpaired &t = model_b_.draw(rng->uni_01());
+			bool mate1 = t.mate_flag_ == '1';
+			size_t nslots = retsz - olap_;
+			size_t off = std::min((size_t)(rng->uni_01() * nslots), nslots-1);
+			assert(off < nslots);
+			const size_t rflen = t.reflen();
+			for(size_t j = off; j < off + rflen; j++) {
+				const int b = buf[j];
+				if(b != 'A' && b != 'C' && b != 'G' && b != 'T') {
+					continue; // uses 1 attempt
 				}
+			}
+			if(mate1) {
 				rd1.init(
 					buf + off,
 					t.qual_,
@@ -265,144 +452,108 @@ void StreamingSimulator::simulate_batch(
 					t.fw_flag_ == 'T',
 					t.best_score_,
 					refid.c_str(),
-					refoff + off);
-				n_wrote_u++;
-				rd1.write(fh_u_, "u");
-			} while(false);
-		}
-		
-		//
-		// Bad-end
-		//
-
-		size_t nb_samp = draw_binomial(nb, binom_p);
-		for(size_t i = 0; i < nb_samp; i++) {
-			int attempts = 0;
-			do {
-				if(attempts > max_attempts) {
-					break;
-				}
-				attempts++;
-				const TemplateUnpaired &t = model_b_.draw();
-				bool mate1 = t.mate_flag_ == '1';
-				size_t nslots = retsz - olap_;
-				size_t off = std::min((size_t)(r4_uni_01() * nslots), nslots-1);
-				assert(off < nslots);
-				const size_t rflen = t.reflen();
-				for(size_t j = off; j < off + rflen; j++) {
-					const int b = buf[j];
-					if(b != 'A' && b != 'C' && b != 'G' && b != 'T') {
-						continue; // uses 1 attempt
-					}
-				}
-				if(mate1) {
-					rd1.init(
-						buf + off,
-						t.qual_,
-						t.edit_xscript_,
-						t.fw_flag_ == 'T',
-						t.best_score_,
-						refid.c_str(),
-						refoff + off);
-					rd2.init_random(
-						t.opp_len_,
-						t.fw_flag_ == 'T', // doesn't matter much, but need them for name
-						t.best_score_, // doesn't matter much, but need them for name
-						refid.c_str(), // doesn't matter much, but need them for name
-						refoff + off); // doesn't matter much, but need them for name
-				} else {
-					rd2.init(
-						buf + off,
-						t.qual_,
-						t.edit_xscript_,
-						t.fw_flag_ == 'T',
-						t.best_score_,
-						refid.c_str(),
-						refoff + off);
-					rd1.init_random(
-						t.opp_len_,
-						t.fw_flag_ == 'T', // doesn't matter much, but need them for name
-						t.best_score_, // doesn't matter much, but need them for name
-						refid.c_str(), // doesn't matter much, but need them for name
-						refoff + off); // doesn't matter much, but need them for name
-				}
-				n_wrote_b++;
-				const char *lab = mate1 ? "b1" : "b2";
-				SimulatedRead::write_pair(rd1, rd2, fh_b_1_, fh_b_2_, lab);
-			} while(false);
-		}
+					refoff + off,
+					rng);
+				rd2.init_random(
+					t.opp_len_,
+					t.fw_flag_ == 'T', // doesn't matter much, but need them for name
+					t.best_score_, // doesn't matter much, but need them for name
+					refid.c_str(), // doesn't matter much, but need them for name
+					refoff + off, // doesn't matter much, but need them for name
+					rng);
+			} else {
+				rd2.init(
+					buf + off,
+					t.qual_,
+					t.edit_xscript_,
+					t.fw_flag_ == 'T',
+					t.best_score_,
+					refid.c_str(),
+					refoff + off,
+					rng);
+				rd1.init_random(
+					t.opp_len_,
+					t.fw_flag_ == 'T', // doesn't matter much, but need them for name
+					t.best_score_, // doesn't matter much, but need them for name
+					refid.c_str(), // doesn't matter much, but need them for name
+					refoff + off, // doesn't matter much, but need them for name
+					rng);
+			}
+			c.n_wrote[1]++;
+			const char *lab = mate1 ? "b1" : "b2";
+			SimulatedRead::write_pair(rd1, rd2, fh_b_1, fh_b_2, lab, tab6_);
+		} while(false);
+	}
 
-		//
-		// Concordant & discordant
-		//
-		
-		size_t nc_samp = draw_binomial(nc, binom_p);
-		size_t nd_samp = draw_binomial(nd, binom_p);
-		for(size_t i = 0; i < nc_samp + nd_samp; i++) {
-			bool conc = i < nc_samp;
-			int attempts = 0;
-			do {
-				if(attempts > max_attempts) {
-					break;
-				}
-				attempts++;
-				const TemplatePaired &t = conc ? model_c_.draw() : model_d_.draw();
-				size_t nslots = retsz - olap_;
-				size_t off = std::min((size_t)(r4_uni_01() * nslots), nslots-1);
-				assert(off < nslots);
-				size_t off_1, off_2;
-				const size_t rflen_1 = edit_xscript_to_rflen(t.edit_xscript_1_);
-				const size_t rflen_2 = edit_xscript_to_rflen(t.edit_xscript_2_);
-				if(t.upstream1_) {
-					off_1 = off;
-					off_2 = off + std::max(t.fraglen_, rflen_2) - rflen_2;
-				} else {
-					off_2 = off;
-					off_1 = off + std::max(t.fraglen_, rflen_1) - rflen_1;
-				}
-				for(size_t j = off_1; j < off_1 + rflen_1; j++) {
-					const int b = buf[j];
-					if(b != 'A' && b != 'C' && b != 'G' && b != 'T') {
-						continue; // uses 1 attempt
-					}
+	//
+	// Concordant & discordant
+	//
+	
+	size_t nc_samp = c.nsamp[2];
+	size_t nd_samp = c.nsamp[3];
+	for(size_t i = 0; i < nc_samp + nd_samp; i++) {
+		bool conc = i < nc_samp;
+		int attempts = 0;
+		do {
+			if(attempts > max_attempts) {
+				break;
+			}
+			attempts++;
+			const TemplatePaired &t = conc ? model_c_.draw(rng->uni_01()) : model_d_.draw(rng->uni_01());
+			size_t nslots = retsz - olap_;
+			size_t off = std::min((size_t)(rng->uni_01() * nslots), nslots-1);
+			assert(off < nslots);
+			size_t off_1, off_2;
+			const size_t rflen_1 = edit_xscript_to_rflen(t.edit_xscript_1_);
+			const size_t rflen_2 = edit_xscript_to_rflen(t.edit_xscript_2_);
+			if(t.upstream1_) {
+				off_1 = off;
+				off_2 = off + std::max(t.fraglen_, rflen_2) - rflen_2;
+			} else {
+				off_2 = off;
+				off_1 = off + std::max(t.fraglen_, rflen_1) - rflen_1;
+			}
+			for(size_t j = off_1; j < off_1 + rflen_1; j++) {
+				const int b = buf[j];
+				if(b != 'A' && b != 'C' && b != 'G' && b != 'T') {
+					continue; // uses 1 attempt
 				}
-				for(size_t j = off_2; j < off_2 + rflen_2; j++) {
-					const int b = buf[j];
-					if(b != 'A' && b != 'C' && b != 'G' && b != 'T') {
-						continue; // uses 1 attempt
-					}
+			}
+			for(size_t j = off_2; j < off_2 + rflen_2; j++) {
+				const int b = buf[j];
+				if(b != 'A' && b != 'C' && b != 'G' && b != 'T') {
+					continue; // uses 1 attempt
 				}
-				rd1.init(buf + off_1,
-						 t.qual_1_,
-						 t.edit_xscript_1_,
-						 t.fw_flag_1_ == 'T',
-						 t.score_1_,
-						 refid.c_str(),
-						 refoff + off_1);
-				rd2.init(buf + off_2,
-						 t.qual_2_,
-						 t.edit_xscript_2_,
-						 t.fw_flag_2_ == 'T',
-						 t.score_2_,
-						 refid.c_str(),
-						 refoff + off_2);
-				if(conc) { n_wrote_c++; } else { n_wrote_d++; }
-				const char *lab = conc ? "c" : "d";
-				SimulatedRead::write_pair(rd1, rd2,
-										  conc ? fh_c_1_ : fh_d_1_,
-										  conc ? fh_c_2_ : fh_d_2_,
-										  lab);
-			} while(false);
+			}
+			rd1.init(buf + off_1,
+					 t.qual_1_,
+					 t.edit_xscript_1_,
+					 t.fw_flag_1_ == 'T',
+					 t.score_1_,
+					 refid.c_str(),
+					 refoff + off_1,
+					 rng);
+			rd2.init(buf + off_2,
+					 t.qual_2_,
+					 t.edit_xscript_2_,
+					 t.fw_flag_2_ == 'T',
+					 t.score_2_,
+					 refid.c_str(),
+					 refoff + off_2,
+					 rng);
+			c.n_wrote[conc ? 2 : 3]++;
+			const char *lab = conc ? "c" : "d";
+			SimulatedRead::write_pair(rd1, rd2,
+									  conc ? fh_c_1 : fh_d_1,
+									  conc ? fh_c_2 : fh_d_2,
+									  lab, tab6_);
+		} while(false);
+	}
+	for(int i = 0; i < 7; i++) {
+		if(fhs[i] != NULL && (i == 0 || !tab6_)) {
+			fclose(fhs[i]);
 		}
 	}
-	cerr << "    Wrote " << n_wrote_u << " unpaired tandem reads "
-	     << "(target=" << nu << ")" << endl;
-	cerr << "    Wrote " << n_wrote_b << " bad-end tandem reads "
-	     << "(target=" << nb << ")" << endl;
-	cerr << "    Wrote " << n_wrote_c << " concordant tandem pairs "
-	     << "(target=" << nc << ")" << endl;
-	cerr << "    Wrote " << n_wrote_d << " discordant tandem pairs "
-	     << "(target=" << nd << ")" << endl;
 }
 
 #ifdef SIMPLESIM_MAIN
@@ -413,8 +564,8 @@ void StreamingSimulator::simulate_batch(
 static void test1() {
 	SimulatedRead rd;
 	const char *ref = "ACGT";
-	const char *qual = "ABCD";
-	const char *edit_xscript = "====";
+	char qual[] = "ABCD";
+	char edit_xscript[] = "====";
 	rd.init(ref, qual, edit_xscript,true, 0, "r1", 0);
 	assert(strcmp(rd.mutated_seq(), "ACGT") == 0);
 	assert(strcmp(rd.qual(), "ABCD") == 0);
@@ -424,8 +575,8 @@ static void test1() {
 static void test2() {
 	SimulatedRead rd;
 	const char *ref = "AACC";
-	const char *qual = "ABCD";
-	const char *edit_xscript = "====";
+	char qual[] = "ABCD";
+	char edit_xscript[] = "====";
 	rd.init(ref, qual, edit_xscript,false, 0, "r1", 0);
 	assert(strcmp(rd.mutated_seq(), "AACC") == 0);
 	assert(strcmp(rd.qual(), "ABCD") == 0);
@@ -435,8 +586,8 @@ static void test2() {
 static void test3() {
 	SimulatedRead rd;
 	const char *ref = "ACGT";
-	const char *qual = "ABCD";
-	const char *edit_xscript = "=X==";
+	char qual[] = "ABCD";
+	char edit_xscript[] = "=X==";
 	rd.init(ref, qual, edit_xscript,true, 0, "r1", 0);
 	assert(strcmp(rd.mutated_seq(), "ACGT") != 0);
 	assert(rd.mutated_seq()[0] == 'A');
@@ -450,8 +601,8 @@ static void test3() {
 static void test4() {
 	SimulatedRead rd;
 	const char *ref = "ACGT";
-	const char *qual = "ABC";
-	const char *edit_xscript = "=D==";
+	char qual[] = "ABC";
+	char edit_xscript[] = "=D==";
 	rd.init(ref, qual, edit_xscript,true, 0, "r1", 0);
 	assert(strcmp(rd.mutated_seq(), "AGT") == 0);
 	assert(strcmp(rd.qual(), "ABC") == 0);
@@ -461,8 +612,8 @@ static void test4() {
 static void test5() {
 	SimulatedRead rd;
 	const char *ref = "AGT";
-	const char *qual = "ABCD";
-	const char *edit_xscript = "=I==";
+	char qual[] = "ABCD";
+	char edit_xscript[] = "=I==";
 	rd.init(ref, qual, edit_xscript,true, 0, "r1", 0);
 	assert(rd.mutated_seq()[0] == 'A');
 	assert(rd.mutated_seq()[2] == 'G');
@@ -477,8 +628,8 @@ static void test5() {
 static void test6() {
 	SimulatedRead rd;
 	const char *ref = "ACGT";
-	const char *qual = "ABCD";
-	const char *edit_xscript = "====";
+	char qual[] = "ABCD";
+	char edit_xscript[] = "====";
 	const char *fn = ".test6.tmp";
 	{
 		FILE *fh = fopen(fn, "wb");
@@ -495,8 +646,8 @@ static void test6() {
 static void test7() {
 	SimulatedRead rd;
 	const char *ref = "AAACC";
-	const char *qual = "EDCBA";
-	const char *edit_xscript = "=====";
+	char qual[] = "EDCBA";
+	char edit_xscript[] = "=====";
 	const char *fn = ".test7.tmp";
 	{
 		FILE *fh = fopen(fn, "wb");
@@ -510,7 +661,71 @@ static void test7() {
 	remove(fn);
 }
 
+/**
+ * Write a small FASTA and an input model, then simulate from them with 1
+ * and with 3 threads; reads should be the same.
+ */
+static void test8() {
+	const char *fa_fn = ".test8.fa";
+	{
+		FILE *fh = fopen(fa_fn, "wb");
+		for(int r = 0; r < 3; r++) {
+			fprintf(fh, ">r%d\n", r);
+			for(int i = 0; i < 5000; i++) {
+				fputc("ACGT"[(i * 7 + i / 13 + r) % 4], fh);
+				if(i % 60 == 59) {
+					fputc('\n', fh);
+				}
+			}
+			fputc('\n', fh);
+		}
+		fclose(fh);
+	}
+	EList<TemplateUnpaired> ts_u;
+	EList<TemplatePaired> ts_c;
+	for(int i = 0; i < 5; i++) {
+		ts_u.expand();
+		ts_u.back().init(-i, 10, i % 2 == 0 ? 'T' : 'F', '0', 0,
+		                 "ABCDEFGHIJ", "==X===I==D=");
+		ts_c.expand();
+		ts_c.back().init(-i, 0, 8, 'T', "ABCDEFGH", "========", -i, 8, 'F',
+		                 "HGFEDCBA", "==X=====", i % 2 == 0, 100 + i);
+	}
+	EList<TemplateUnpaired> ts_b;
+	EList<TemplatePaired> ts_d;
+	InputModelUnpaired model_u(ts_u, 1000, 1.0f, 1.0f);
+	InputModelUnpaired model_b(ts_b, 0, 1.0f, 1.0f);
+	InputModelPaired model_c(ts_c, 1000, 1.0f, 1.0f);
+	InputModelPaired model_d(ts_d, 0, 1.0f, 1.0f);
+	vector<string> fns(1, string(fa_fn));
+	string out[2][3];
+	for(int t = 0; t < 2; t++) {
+		const char *fns_out[3] = {".test8.u.fq", ".test8.c1.fq", ".test8.c2.fq"};
+		FILE *fhs[3];
+		for(int i = 0; i < 3; i++) {
+			fhs[i] = fopen(fns_out[i], "wb");
+		}
+		set_seed(77, 78);
+		StreamingSimulator ss(fns, 1024, model_u, model_b, model_c, model_d,
+		                      fhs[0], NULL, NULL, fhs[1], fhs[2], NULL, NULL,
+		                      false, 7, t == 0 ? 1 : 3);
+		ss.simulate_batch(1.0f, FUNC_LINEAR, 0, 0, 0, 0);
+		for(int i = 0; i < 3; i++) {
+			fclose(fhs[i]);
+			ifstream in(fns_out[i]);
+			out[t][i] = string((istreambuf_iterator<char>(in)), istreambuf_iterator<char>());
+			remove(fns_out[i]);
+		}
+	}
+	for(int i = 0; i < 3; i++) {
+		assert(!out[0][i].empty());
+		assert(out[0][i] == out[1][i]);
+	}
+	remove(fa_fn);
+}
+
 int main(void) {
+	initialize();
 	test1();
 	test2();
 	test3();
@@ -518,6 +733,7 @@ int main(void) {
 	test5();
 	test6();
 	test7();
+	test8();
 	cerr << "ALL TESTS PASSED" << endl;
 }
 #endif
@@ -10,6 +10,7 @@
 #define __qtip__simplesim__
 
 #include <stdio.h>
+#include <stdint.h>
 #include <vector>
 #include <algorithm>
 #include <fstream>
@@ -23,8 +24,48 @@
 static const char * sim_startswith = SIM_STARTSWITH_LITERAL;
 static const char sim_sep = SIM_SEPARATOR_LITERAL;
 
-static inline char draw_base() {
-    return "ACGT"[std::min((int)(r4_uni_01() * 4), 3)];
+/**
+ * Random number generator (splitmix64) for simulating the reads from one
+ * chunk of the reference.  Seeded from the run's seed and the chunk's index,
+ * so a chunk yields the same reads however chunks are spread over threads.
+ */
+class SimRng {
+
+public:
+
+	SimRng() : state_(0) { }
+
+	void init(int seed, uint64_t chunk) {
+		state_ = ((uint64_t)(uint32_t)seed << 32) ^ chunk;
+		state_ = next();
+	}
+
+	uint64_t next() {
+		uint64_t z = (state_ += 0x9E3779B97F4A7C15ULL);
+		z = (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9ULL;
+		z = (z ^ (z >> 27)) * 0x94D049BB133111EBULL;
+		return z ^ (z >> 31);
+	}
+
+	/**
+	 * Return a uniform draw from [0, 1).
+	 */
+	float uni_01() {
+		return (float)(next() >> 40) * (1.0f / 16777216.0f);
+	}
+
+protected:
+
+	uint64_t state_;
+};
+
+/**
+ * Draw a uniform random base, using rng if given, otherwise the global
+ * ranlib generator.
+ */
+static inline char draw_base(SimRng *rng = NULL) {
+	float u = rng != NULL ? rng->uni_01() : r4_uni_01();
+	return "ACGT"[std::min((int)(u * 4), 3)];
 }
 
 /**
@@ -72,7 +113,8 @@ public:
 		bool fw,
 		int score,
 		const char *refid,
-		size_t refoff)
+		size_t refoff,
+		SimRng *rng = NULL)
 	{
 		qual_ = qual;
 		edit_xscript_ = edit_xscript;
@@ -80,7 +122,7 @@ public:
 		score_ = score;
 		refid_ = refid;
 		refoff_ = refoff;
-		mutate(seq);
+		mutate(seq, rng);
 	}
 	
 	/**
@@ -91,7 +133,8 @@ public:
 		bool fw,
 		int score,
 		const char *refid,
-		size_t refoff)
+		size_t refoff,
+		SimRng *rng = NULL)
 	{
 		assert(len > 0);
 		while(len+1 >= qual_buf_len_) {
@@ -107,7 +150,7 @@ public:
 		char *seq_cur = seq_buf_;
 		char *qual_cur = qual_buf_;
 		for(size_t i = 0; i < len; i++) {
-			int c = draw_base();
+			int c = draw_base(rng);
 			int q = 'I';
 			*seq_cur++ = c;
 			*qual_cur++ = q;
@@ -117,19 +160,22 @@ public:
 	}
 	
 	/**
-	 * Write unpaired simulated read to a FASTQ file.
+	 * Write unpaired simulated read to a FASTQ file, or as a Bowtie 2
+	 * --tab6 line if tab6 is true.
 	 */
-	void write(FILE *fh, const char *typ);
+	void write(FILE *fh, const char *typ, bool tab6 = false);
 	
 	/**
-	 * Write pair of simulated reads to parallel FASTQ files.
+	 * Write pair of simulated reads to parallel FASTQ files, or as one
+	 * Bowtie 2 --tab6 line to fh1 if tab6 is true.
 	 */
 	static void write_pair(
 		const SimulatedRead& rd1,
 		const SimulatedRead& rd2,
 		FILE *fh1,
 		FILE *fh2,
-		const char *typ);
+		const char *typ,
+		bool tab6 = false);
 	
 	/**
 	 * Return read sequence, as mutated from reference.
@@ -160,7 +206,7 @@ protected:
 	 *
 	 * Note: edit transcript is always presented as though 5' end of read is on the left?
 	 */
-	void mutate(const char *seq);
+	void mutate(const char *seq, SimRng *rng);
 
 	/**
 	 * Double the size of the sequence buffer.
@@ -200,6 +246,9 @@ enum {
     FUNC_CONST
 };
 
+struct SimChunk;
+class BatchPool;
+
 /**
  * What do we need from the dists?
  * 1. Average read/fragment lengths for all 4 classes
@@ -224,11 +273,15 @@ public:
 		FILE *fh_c_1,
 		FILE *fh_c_2,
 		FILE *fh_d_1,
-		FILE *fh_d_2) :
+		FILE *fh_d_2,
+		bool tab6 = false,
+		int seed = 0,
+		int nthreads = 1,
+		bool packed_ref = false) :
 		olap_(std::max(model_u.max_len(),
 			  std::max(model_b.max_len(),
 			  std::max(model_c.max_len(), model_d.max_len())))),
-		fa_(fns, chunksz, olap_),
+		fa_(fns, chunksz, olap_, packed_ref),
 		model_u_(model_u),
 		model_b_(model_b),
 		model_c_(model_c),
@@ -239,14 +292,23 @@ public:
 		fh_c_1_(fh_c_1),
 		fh_c_2_(fh_c_2),
 		fh_d_1_(fh_d_1),
-		fh_d_2_(fh_d_2)
+		fh_d_2_(fh_d_2),
+		tab6_(tab6),
+		seed_(seed),
+		nthreads_(std::max(nthreads, 1))
 	{
+		if(tab6_) {
+			fh_b_1_ = fh_b_2_ = fh_c_1_ = fh_c_2_ = fh_d_1_ = fh_d_2_ = fh_u_;
+		}
 		tot_fasta_len_ = estimate_fasta_length(fns);
 	}
 	
 	/**
 	 * Simulate a batch of reads over the course of a single pass over the
-	 * FASTA files.
+	 * FASTA files.  Chunks of the FASTA are simulated from in parallel,
+	 * nthreads at a time, and their reads written in FASTA order.  Each
+	 * category's number of reads is multiplied by scale, and categories not
+	 * among cats ("ubcd" for all) are skipped.
 	 */
 	void simulate_batch(
 		float fraction,
@@ -254,7 +316,9 @@ public:
 		size_t min_u,
 		size_t min_c,
 		size_t min_d,
-		size_t min_b);
+		size_t min_b,
+		float scale = 1.0f,
+		const char *cats = "ubcd");
 	
 	/**
 	 * Return the estimated number of bases in all the FASTA files, based on
@@ -266,6 +330,19 @@ public:
 
 protected:
 	
+	/**
+	 * Simulate reads from one chunk of the reference into the chunk's
+	 * output buffers.
+	 */
+	void simulate_chunk(SimChunk& c) const;
+
+	/**
+	 * Simulate from the first n chunks in parallel and write their reads.
+	 */
+	void run_chunks(BatchPool& pool, std::vector<SimChunk>& chunks, size_t n);
+
+	static void simulate_chunk_job(void *ctx, size_t i);
+
 	/**
 	 * Return size of file in bytes.
 	 */
@@ -300,6 +377,10 @@ protected:
 	FILE *fh_c_2_;  // destimation for simulated discordant reads, mate 2
 	FILE *fh_d_1_;  // destimation for simulated concordant reads, mate 1
 	FILE *fh_d_2_;  // destimation for simulated discordant reads, mate 2
+	bool tab6_;     // write all reads to fh_u_ in Bowtie 2's --tab6 format
+	int seed_;      // seeds each chunk's SimRng, along with chunk's index
+	int nthreads_;  // threads simulating from chunks in parallel
+	size_t n_wrote_[4]; // reads written so far: u, b, c, d
 };
 
 #endif /* defined(__qtip__simplesim__) */
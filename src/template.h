@@ -14,6 +14,32 @@
 #include <string.h>
 #include "edit_xscript.h"
 
+/**
+ * Split a line into exactly n tab-separated fields, in place, dropping any
+ * trailing newline.  Returns false if there are more or fewer fields.
+ */
+static inline bool split_fields(char *line, char **toks, size_t n) {
+	size_t len = strlen(line);
+	while(len > 0 && (line[len-1] == '\n' || line[len-1] == '\r')) {
+		line[--len] = '\0';
+	}
+	size_t i = 0;
+	char *cur = line;
+	while(true) {
+		if(i == n) {
+			return false;
+		}
+		toks[i++] = cur;
+		char *tab = strchr(cur, '\t');
+		if(tab == NULL) {
+			break;
+		}
+		*tab = '\0';
+		cur = tab + 1;
+	}
+	return i == n;
+}
+
 /*
  * Encapsulates:
  *
@@ -43,7 +69,9 @@ struct TemplateUnpaired {
 		char mate_flag,
 		int opp_len,
 		const char *qual,
-		const char *edit_xscript)
+		const char *edit_xscript) :
+		qual_(NULL),
+		edit_xscript_(NULL)
 	{
 		init(best_score, len, fw_flag, mate_flag, opp_len, qual, edit_xscript);
 	}
@@ -62,6 +90,7 @@ struct TemplateUnpaired {
 		fw_flag_ = fw_flag;
 		mate_flag_ = mate_flag;
 		opp_len_ = opp_len;
+		clear();
 		assert(qual != NULL);
 		if(qual != NULL) {
 			qual_ = strdup(qual);
@@ -75,6 +104,13 @@ struct TemplateUnpaired {
 	}
 	
 	~TemplateUnpaired() {
+		clear();
+	}
+
+	/**
+	 * Free strings; template can be init()ed again.
+	 */
+	void clear() {
 		if(qual_ != NULL) {
 			free(qual_);
 			qual_ = NULL;
@@ -84,6 +120,29 @@ struct TemplateUnpaired {
 			edit_xscript_ = NULL;
 		}
 	}
+
+	/**
+	 * Write template as a line of tab-separated fields.
+	 */
+	void write(FILE *fh) const {
+		fprintf(fh, "%d\t%c\t%d\t%c\t%d\t%s\t%s\n",
+			best_score_, fw_flag_, len_, mate_flag_, opp_len_,
+			qual_, edit_xscript_);
+	}
+
+	/**
+	 * Initialize from a line written by write().  Modifies line.  Returns
+	 * false if the line is malformed.
+	 */
+	bool parse(char *line) {
+		char *toks[7];
+		if(!split_fields(line, toks, 7)) {
+			return false;
+		}
+		init(atoi(toks[0]), atoi(toks[2]), toks[1][0], toks[3][0],
+		     atoi(toks[4]), toks[5], toks[6]);
+		return true;
+	}
 	
 	/**
 	 * Return number of reference characters involved in alignment, as
@@ -150,7 +209,11 @@ struct TemplatePaired {
 		const char *qual_2,
 		const char *edit_xscript_2,
 		bool upstream1,
-		size_t fraglen)
+		size_t fraglen) :
+		qual_1_(NULL),
+		edit_xscript_1_(NULL),
+		qual_2_(NULL),
+		edit_xscript_2_(NULL)
 	{
 		init(score_12,
 			 score_1, len_1, fw_flag_1, qual_1, edit_xscript_1,
@@ -182,6 +245,7 @@ struct TemplatePaired {
 		fw_flag_2_ = fw_flag_2;
 		upstream1_  = upstream1;
 		fraglen_  = fraglen;
+		clear();
 		if(qual_1 != NULL) {
 			qual_1_ = strdup(qual_1);
 		}
@@ -197,6 +261,13 @@ struct TemplatePaired {
 	}
 	
 	~TemplatePaired() {
+		clear();
+	}
+
+	/**
+	 * Free strings; template can be init()ed again.
+	 */
+	void clear() {
 		if(qual_1_ != NULL) {
 			free(qual_1_);
 			qual_1_ = NULL;
@@ -214,6 +285,35 @@ struct TemplatePaired {
 			edit_xscript_2_ = NULL;
 		}
 	}
+
+	/**
+	 * Write template as a line of tab-separated fields.
+	 */
+	void write(FILE *fh) const {
+		fprintf(fh, "%d\t%d\t%d\t%c\t%s\t%s\t%d\t%d\t%c\t%s\t%s\t%c\t%llu\n",
+			score_12_,
+			score_1_, len_1_, fw_flag_1_, qual_1_, edit_xscript_1_,
+			score_2_, len_2_, fw_flag_2_, qual_2_, edit_xscript_2_,
+			upstream1_ ? 'T' : 'F',
+			(unsigned long long)fraglen_);
+	}
+
+	/**
+	 * Initialize from a line written by write().  Modifies line.  Returns
+	 * false if the line is malformed.
+	 */
+	bool parse(char *line) {
+		char *toks[13];
+		if(!split_fields(line, toks, 13)) {
+			return false;
+		}
+		init(atoi(toks[0]),
+		     atoi(toks[1]), atoi(toks[2]), toks[3][0], toks[4], toks[5],
+		     atoi(toks[6]), atoi(toks[7]), toks[8][0], toks[9], toks[10],
+		     toks[11][0] == 'T',
+		     (size_t)strtoull(toks[12], NULL, 10));
+		return true;
+	}
 	
 	int score_12_;
 	int score_1_;
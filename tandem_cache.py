@@ -0,0 +1,293 @@
+"""
+Copyright 2016, Ben Langmead <langmea@cs.jhu.edu>
+
+TandemCache: a local, size-bounded cache of tandem feature tables (the
+_rec_* tables written by "qtip-parse f" for the tandem alignments), stored
+under a hash of everything that determines them: reference, aligner and its
+arguments, simulation parameters and a coarse fingerprint of the input model.
+"""
+
+import os
+import json
+import math
+import errno
+import shutil
+import hashlib
+import logging
+from array import array
+from os.path import join, getsize
+
+__author__ = 'langmead'
+
+
+_suffixes = ['_rec_u', '_rec_b', '_rec_c', '_rec_d']
+_fingerprint_cols = ['len', 'alqual', 'fraglen']
+
+
+def _recursive_size(dr):
+    tot = 0
+    for root, dirs, files in os.walk(dr):
+        tot += sum(getsize(join(root, name)) for name in files)
+    return tot
+
+
+def round_sig(x, digits=2):
+    """ Round to given number of significant digits, so that similar inputs
+        map to the same value """
+    if x == 0 or math.isnan(x):
+        return 0.0
+    return round(x, digits - 1 - int(math.floor(math.log10(abs(x)))))
+
+
+def _column_medians(prefix, cols, max_rows=4096):
+    """ Return number of rows and the medians of the named columns for the
+        given .meta/.npy table, using evenly spaced rows as a sample """
+    with open(prefix + '.meta') as fh:
+        fields = fh.readline().rstrip().split(',')
+    if len(fields) < 2:
+        return 0, {}  # empty table
+    nrow, names = int(fields[-1]), fields[:-1]
+    idxs = [(nm, names.index(nm)) for nm in cols if nm in names]
+    if nrow == 0 or len(idxs) == 0:
+        return nrow, {}
+    rowlen = 8 * len(names)
+    stride = max(1, nrow // max_rows)
+    vals = dict((nm, []) for nm, _ in idxs)
+    with open(prefix + '.npy', 'rb') as fh:
+        for i in range(0, nrow, stride):
+            fh.seek(i * rowlen)
+            row = array('d')
+            row.fromfile(fh, len(names))
+            for nm, j in idxs:
+                if not math.isnan(row[j]):
+                    vals[nm].append(row[j])
+    meds = {}
+    for nm, v in vals.items():
+        if len(v) > 0:
+            v.sort()
+            meds[nm] = v[len(v) // 2]
+    return nrow, meds
+
+
+def files_digest(fns):
+    """ SHA-1 of the contents of the given files, in order, for keying on
+        inputs like saved input models that must match exactly """
+    h = hashlib.sha1()
+    for fn in fns:
+        with open(fn, 'rb') as fh:
+            for buf in iter(lambda: fh.read(1024 * 1024), b''):
+                h.update(buf)
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def input_fingerprint(prefix):
+    """
+    Summarize the input feature tables at the given prefix: per alignment
+    category, the number of rows (on a log2 scale) and the medians of a few
+    columns describing read length, alignment score and fragment length, all
+    rounded so that inputs drawn from the same kind of data agree.
+    """
+    fp = {}
+    for suf in _suffixes:
+        fn = prefix + suf
+        if not os.path.exists(fn + '.meta') or not os.path.exists(fn + '.npy'):
+            continue
+        nrow, meds = _column_medians(fn, _fingerprint_cols)
+        if nrow == 0:
+            continue
+        ent = {'nrow_log2': int(round(math.log(nrow, 2)))}
+        for nm, med in meds.items():
+            ent[nm] = round_sig(med)
+        fp[suf] = ent
+    return fp
+
+
+class TandemCache(object):
+    """
+    Directory of cached tandem feature tables.  Each entry is a subdirectory
+    named for the SHA-1 of its settings and input fingerprint.  Entries are
+    evicted least-recently-used first once the cache exceeds max_bytes; an
+    entry's modification time is its last-use time.
+    """
+
+    def __init__(self, dr, max_bytes, log=logging):
+        self.dir = dr
+        self.max_bytes = max_bytes
+        self.log = log
+        self.hits = 0
+        self.misses = 0
+        try:
+            os.makedirs(dr)
+        except OSError as exception:
+            if exception.errno != errno.EEXIST:
+                raise
+
+    @staticmethod
+    def key(settings, fingerprint):
+        """ Content address for the given settings and input fingerprint """
+        blob = json.dumps({'settings': settings, 'fingerprint': fingerprint}, sort_keys=True)
+        return hashlib.sha1(blob.encode()).hexdigest()
+
+    def _entry(self, key):
+        return join(self.dir, key)
+
+    def fetch(self, key, prefix):
+        """ If there is an entry for key, link or copy its tables to files
+            with the given prefix and return True.  Otherwise return False. """
+        ent = self._entry(key)
+        if not os.path.isdir(ent):
+            self.misses += 1
+            self.log.info('Tandem cache miss (%s)' % key)
+            return False
+        for suf in _suffixes:
+            for ext in ['.npy', '.meta']:
+                src, dst = join(ent, suf[1:] + ext), prefix + suf + ext
+                if os.path.exists(dst):
+                    os.remove(dst)
+                try:
+                    os.link(src, dst)
+                except OSError:
+                    shutil.copyfile(src, dst)
+        os.utime(ent, None)
+        self.hits += 1
+        self.log.info('Tandem cache hit (%s)' % key)
+        return True
+
+    def store(self, key, prefix, settings, fingerprint):
+        """ Add tables with the given prefix to the cache under key, then
+            evict old entries if the cache has grown too large """
+        ent = self._entry(key)
+        if os.path.isdir(ent):
+            return
+        tmp = join(self.dir, '.tmp.%d.%s' % (os.getpid(), key))
+        if os.path.isdir(tmp):
+            shutil.rmtree(tmp)
+        os.mkdir(tmp)
+        for suf in _suffixes:
+            for ext in ['.npy', '.meta']:
+                shutil.copyfile(prefix + suf + ext, join(tmp, suf[1:] + ext))
+        with open(join(tmp, 'entry.json'), 'w') as fh:
+            json.dump({'settings': settings, 'fingerprint': fingerprint}, fh, sort_keys=True, indent=1)
+        try:
+            os.rename(tmp, ent)
+        except OSError:
+            # another run stored the same entry first
+            shutil.rmtree(tmp)
+            return
+        self.log.info('Stored tandem tables in cache (%s)' % key)
+        self.evict()
+
+    def evict(self):
+        """ Remove least-recently-used entries until the cache fits """
+        ents = []
+        for nm in os.listdir(self.dir):
+            ent = join(self.dir, nm)
+            if nm.startswith('.') or not os.path.isdir(ent):
+                continue
+            ents.append((os.stat(ent).st_mtime, _recursive_size(ent), ent))
+        ents.sort()
+        tot = sum(sz for _, sz, _ in ents)
+        for _, sz, ent in ents:
+            if tot <= self.max_bytes:
+                break
+            self.log.info('Evicting tandem cache entry "%s" (%d bytes)' % (os.path.basename(ent), sz))
+            shutil.rmtree(ent, ignore_errors=True)
+            tot -= sz
+
+
+if __name__ == "__main__":
+
+    import sys
+    import time
+    import struct
+    import tempfile
+    import unittest
+
+    def _write_table(prefix, cols, rows):
+        with open(prefix + '.meta', 'w') as fh:
+            fh.write(','.join(cols + [str(len(rows))]))
+        with open(prefix + '.npy', 'wb') as fh:
+            for row in rows:
+                fh.write(struct.pack('%dd' % len(row), *row))
+
+    def _write_tables(prefix, nrow, rdlen=100.0):
+        for suf in _suffixes:
+            _write_table(prefix + suf, ['id', 'len', 'alqual', 'correct'],
+                         [[i, rdlen, -float(i % 10), 1] for i in range(nrow)])
+
+    class TestCases(unittest.TestCase):
+
+        def setUp(self):
+            self.dir = tempfile.mkdtemp()
+            self.log = logging.getLogger('tandem_cache_test')
+            self.log.setLevel(logging.ERROR)
+
+        def tearDown(self):
+            shutil.rmtree(self.dir)
+
+        def test_fingerprint_1(self):
+            pre = join(self.dir, 'a')
+            _write_tables(pre, 1000, 100.0)
+            fp1 = input_fingerprint(pre)
+            self.assertEqual(10, fp1['_rec_u']['nrow_log2'])
+            self.assertEqual(100.0, fp1['_rec_u']['len'])
+            self.assertEqual(-4.0, fp1['_rec_u']['alqual'])
+            # slightly different input, same fingerprint
+            _write_tables(pre, 1010, 101.0)
+            self.assertEqual(fp1, input_fingerprint(pre))
+            # quite different input, different fingerprint
+            _write_tables(pre, 1000, 150.0)
+            self.assertNotEqual(fp1, input_fingerprint(pre))
+            # empty tables, as for categories with no alignments, are skipped
+            for suf in _suffixes[1:]:
+                open(pre + suf + '.meta', 'w').close()
+                open(pre + suf + '.npy', 'w').close()
+            self.assertEqual(['_rec_u'], list(input_fingerprint(pre).keys()))
+
+        def test_files_digest_1(self):
+            fns = [join(self.dir, 'm_%s.tsv' % cat) for cat in 'ub']
+            for fn in fns:
+                with open(fn, 'w') as fh:
+                    fh.write('T\t100\n')
+            d1 = files_digest(fns)
+            self.assertEqual(d1, files_digest(fns))
+            with open(fns[1], 'a') as fh:
+                fh.write('F\t90\n')
+            self.assertNotEqual(d1, files_digest(fns))
+
+        def test_store_fetch_1(self):
+            pre, pre2 = join(self.dir, 'a'), join(self.dir, 'b')
+            _write_tables(pre, 100)
+            cache = TandemCache(join(self.dir, 'cache'), 1 << 30, log=self.log)
+            key = TandemCache.key({'ref': 'x'}, input_fingerprint(pre))
+            self.assertNotEqual(key, TandemCache.key({'ref': 'y'}, input_fingerprint(pre)))
+            self.assertFalse(cache.fetch(key, pre2))
+            cache.store(key, pre, {'ref': 'x'}, input_fingerprint(pre))
+            self.assertTrue(cache.fetch(key, pre2))
+            for suf in _suffixes:
+                for ext in ['.npy', '.meta']:
+                    with open(pre + suf + ext, 'rb') as fh1:
+                        with open(pre2 + suf + ext, 'rb') as fh2:
+                            self.assertEqual(fh1.read(), fh2.read())
+            self.assertEqual(1, cache.hits)
+            self.assertEqual(1, cache.misses)
+
+        def test_evict_1(self):
+            pre, pre2 = join(self.dir, 'a'), join(self.dir, 'b')
+            _write_tables(pre, 100)
+            ent_size = sum(getsize(pre + suf + '.npy') for suf in _suffixes)
+            cache = TandemCache(join(self.dir, 'cache'), int(ent_size * 2.5), log=self.log)
+            keys = ['k%d' % i for i in range(3)]
+            for i, key in enumerate(keys[:2]):
+                cache.store(key, pre, {}, {})
+                os.utime(cache._entry(key), (time.time() - 100 + i, time.time() - 100 + i))
+            # touch k0 so k1 is least recently used
+            self.assertTrue(cache.fetch(keys[0], pre2))
+            cache.store(keys[2], pre, {}, {})
+            self.assertTrue(os.path.isdir(cache._entry(keys[0])))
+            self.assertFalse(os.path.isdir(cache._entry(keys[1])))
+            self.assertTrue(os.path.isdir(cache._entry(keys[2])))
+
+    unittest.main(argv=[sys.argv[0]])
+    sys.exit()
@@ -10,6 +10,7 @@ import tempfile
 import errno
 import shutil
 import logging
+import threading
 from collections import defaultdict
 from os.path import join, getsize
 
@@ -21,39 +22,93 @@ def _recursive_size(dr):
     return tot
 
 
+def _entry_size(path, is_dir):
+    """ Size of a file, or of everything under a directory; 0 if it doesn't
+        exist (yet) """
+    try:
+        return _recursive_size(path) if is_dir else getsize(path)
+    except OSError:
+        return 0
+
+
 class TemporaryFileManager(object):
     """
     Dishes out temporary files and directories, with ability to report total
-    temporary-file footprint at any given point.
+    temporary-file footprint at any given point.  The footprint is tracked
+    per file and directory handed out: each is re-measured when its group is
+    removed or when refresh() is called, e.g. periodically by the sampler
+    thread, so that measuring doesn't mean walking the whole temp tree.
+
+    If fast_dr is given (e.g. a RAM disk like /dev/shm), files and
+    directories requested with fast=True and an expected size go there as
+    long as the fast tier's usage plus their expected size stays within
+    fast_size bytes; otherwise, or once the fast tier fills, they go to the
+    disk tier under dr.
     """
 
-    def __init__(self, dr=None):
+    def __init__(self, dr=None, budget=None, fast_dr=None, fast_size=0):
         self.dir = tempfile.mkdtemp(dir=dr)
+        self.fast_dir = None if fast_dr is None else tempfile.mkdtemp(dir=fast_dr)
+        self.fast_size = fast_size
         self.files = set()
         self.dirs = set()
         self.groups = defaultdict(list)
+        self.paths = {}  # file/dir basename -> full path
+        self.sizes = {}  # file/dir basename -> bytes when last measured
+        self.expected = {}  # fast-tier basename -> expected bytes
+        self.fast = set()  # basenames in fast tier
+        self.cur_size = 0
+        self.cur_fast_size = 0
         self.peak_size = 0
+        self.watches = {}  # key -> peak size since watch_peak returned key
+        self.next_watch = 0
+        self.budget = budget  # bytes on disk tier, or None for no budget
+        self.lock = threading.Lock()
+        self.sampler = None
+        self.sampler_stop = None
+        self.warned_budget = False
+        self.consumers = {}  # group -> {consumer name: uses left}
+
+    def _place(self, basename, fast, expected_size):
+        """ Choose a tier for a new file or directory and return its path;
+            call with lock held """
+        if fast and self.fast_dir is not None and expected_size is not None:
+            # count each fast entry as at least its expected size, since it
+            # may not have grown to it yet
+            committed = sum(max(self.sizes[b], self.expected[b]) for b in self.fast)
+            if committed + expected_size <= self.fast_size:
+                self.fast.add(basename)
+                self.expected[basename] = expected_size
+                return join(self.fast_dir, basename)
+            logging.info('Fast temporary space is full; putting "%s" on disk' % basename)
+        return join(self.dir, basename)
 
-    def get_file(self, fn_basename, group=''):
+    def get_file(self, fn_basename, group='', fast=False, expected_size=None):
         """ Return filename for new temporary file in temp dir """
-        fullpath = join(self.dir, fn_basename)
         if fn_basename in self.files:
             #raise RuntimeError('Temporary file with name "%s" already exists' % fn_basename)
-            return fullpath
-        self.groups[group].append((fn_basename, False))
-        self.files.add(fn_basename)
+            return self.paths[fn_basename]
+        with self.lock:
+            fullpath = self._place(fn_basename, fast, expected_size)
+            self.groups[group].append((fn_basename, False))
+            self.files.add(fn_basename)
+            self.paths[fn_basename] = fullpath
+            self.sizes[fn_basename] = 0
         return fullpath
 
-    def get_dir(self, dir_basename, group=''):
+    def get_dir(self, dir_basename, group='', fast=False, expected_size=None):
         """ Return filename for new temporary subdir in temp dir """
-        fullpath = join(self.dir, dir_basename)
         if dir_basename in self.dirs:
             #raise RuntimeError('Temporary directory with name "%s" already exists' % dir_basename)
-            return fullpath
+            return self.paths[dir_basename]
         if len(group) == 0:
             group = dir_basename
-        self.groups[group].append((dir_basename, True))
-        self.dirs.add(dir_basename)
+        with self.lock:
+            fullpath = self._place(dir_basename, fast, expected_size)
+            self.groups[group].append((dir_basename, True))
+            self.dirs.add(dir_basename)
+            self.paths[dir_basename] = fullpath
+            self.sizes[dir_basename] = 0
         # Create output directory if needed
         try:
             os.makedirs(fullpath)
@@ -64,35 +119,275 @@ class TemporaryFileManager(object):
 
     def remove_group(self, group):
         """ Remove all the temporary files belonging to the named group """
-        self.update_peak()
-        for base, is_dir in self.groups[group]:
-            if is_dir:
-                self.dirs.remove(base)
-                shutil.rmtree(join(self.dir, base))
-            else:
-                self.files.remove(base)
-                os.remove(join(self.dir, base))
-        del self.groups[group]
+        self.refresh(group)
+        with self.lock:
+            for base, is_dir in self.groups[group]:
+                if is_dir:
+                    self.dirs.remove(base)
+                    shutil.rmtree(self.paths[base])
+                else:
+                    self.files.remove(base)
+                    os.remove(self.paths[base])
+                sz = self.sizes.pop(base)
+                self.cur_size -= sz
+                if base in self.fast:
+                    self.cur_fast_size -= sz
+                    self.fast.remove(base)
+                    del self.expected[base]
+                del self.paths[base]
+            del self.groups[group]
+
+    def add_consumers(self, group, consumers):
+        """ Register the named consumers (e.g. pipeline stages) as readers of
+            the files in the named group.  A name may appear more than once
+            if it reads the group several times.  The group is removed as
+            soon as every registered use has been released with consumed(). """
+        with self.lock:
+            uses = self.consumers.setdefault(group, {})
+            for consumer in consumers:
+                uses[consumer] = uses.get(consumer, 0) + 1
+
+    def consumed(self, group, consumer):
+        """ Release one use of the named group by consumer, which is either
+            finished with it or won't run.  Removes the group if that was the
+            last use and returns True.  Does nothing if the group has no
+            registered consumers, e.g. because it isn't in temp space. """
+        with self.lock:
+            uses = self.consumers.get(group)
+            if uses is None or consumer not in uses:
+                return False
+            uses[consumer] -= 1
+            if uses[consumer] == 0:
+                del uses[consumer]
+            if len(uses) > 0:
+                return False
+            del self.consumers[group]
+        self.remove_group(group)
+        return True
 
     def purge(self, log=logging):
         """ Remove all temporary files created for caller """
+        self.stop_sampler()
         self.update_peak()
-        for root, subdirs, files in os.walk(self.dir):
-            for fn in files:
-                log.warning("  still have file: %s/%s" % (root, fn))
-                os.remove(join(root, fn))
-            for dr in subdirs:
-                log.warning("  still have subdir: %s/%s" % (root, dr))
-                shutil.rmtree(join(root, dr))
-        assert len(list(os.walk(self.dir))) == 1, str(list(os.walk(self.dir)))
+        for top in [self.dir, self.fast_dir]:
+            if top is None:
+                continue
+            for root, subdirs, files in os.walk(top):
+                for fn in files:
+                    log.warning("  still have file: %s/%s" % (root, fn))
+                    os.remove(join(root, fn))
+                for dr in subdirs:
+                    log.warning("  still have subdir: %s/%s" % (root, dr))
+                    shutil.rmtree(join(root, dr))
+            assert len(list(os.walk(top))) == 1, str(list(os.walk(top)))
         self.files = set()
         self.dirs = set()
         self.groups = defaultdict(list)
+        self.consumers = {}
+        self.paths = {}
+        self.sizes = {}
+        self.expected = {}
+        self.fast = set()
+        self.cur_size = 0
+        self.cur_fast_size = 0
+
+    def refresh(self, group=None):
+        """ Re-measure the files and directories in the named group, or in
+            all groups, then update current and peak sizes """
+        with self.lock:
+            groups = [group] if group is not None else list(self.groups.keys())
+            for grp in groups:
+                for base, is_dir in self.groups.get(grp, []):
+                    sz = _entry_size(self.paths[base], is_dir)
+                    self.cur_size += sz - self.sizes[base]
+                    if base in self.fast:
+                        self.cur_fast_size += sz - self.sizes[base]
+                    self.sizes[base] = sz
+            self.peak_size = max(self.peak_size, self.cur_size)
+            for key in self.watches:
+                self.watches[key] = max(self.watches[key], self.cur_size)
+        if self.over_budget() and not self.warned_budget:
+            self.warned_budget = True
+            logging.warning('Temporary files on disk (%0.2fMB) exceed temp budget (%0.2fMB)' %
+                            (self.disk_size() / (1024.0 * 1024), self.budget / (1024.0 * 1024)))
 
     def size(self):
-        """ Return total size of all the files in the temp dir """
-        return _recursive_size(self.dir)
+        """ Return total size of the temporary files, as last measured """
+        return self.cur_size
+
+    def disk_size(self):
+        """ Return size of the temporary files in the disk tier """
+        return self.cur_size - self.cur_fast_size
+
+    def remaining(self):
+        """ Return bytes left in the disk budget, or None if there's no
+            budget """
+        return None if self.budget is None else self.budget - self.disk_size()
+
+    def over_budget(self):
+        return self.budget is not None and self.disk_size() > self.budget
 
     def update_peak(self):
-        """ Update peak size of temporary files """
-        self.peak_size = max(self.peak_size, self.size())
+        """ Update peak size of temporary files.  Cheap if the sampler is
+            running, since it keeps the peak up to date. """
+        if self.sampler is None:
+            self.refresh()
+
+    def watch_peak(self):
+        """ Start tracking the peak size of temporary files from now on,
+            separately from the overall peak; returns a key for
+            unwatch_peak """
+        with self.lock:
+            key = self.next_watch
+            self.next_watch += 1
+            self.watches[key] = self.cur_size
+        return key
+
+    def unwatch_peak(self, key):
+        """ Stop tracking a peak started by watch_peak and return it """
+        self.update_peak()
+        with self.lock:
+            return self.watches.pop(key)
+
+    def start_sampler(self, interval=2.0):
+        """ Start thread that re-measures temporary files every interval
+            seconds, so the peak reflects growth between removals """
+        if self.sampler is not None:
+            return
+        self.sampler_stop = threading.Event()
+
+        def _sample():
+            while not self.sampler_stop.wait(interval):
+                self.refresh()
+        self.sampler = threading.Thread(target=_sample)
+        self.sampler.daemon = True
+        self.sampler.start()
+
+    def stop_sampler(self):
+        if self.sampler is None:
+            return
+        self.sampler_stop.set()
+        self.sampler.join()
+        self.sampler = None
+        self.refresh()
+
+
+if __name__ == "__main__":
+
+    import sys
+    import time
+    import unittest
+
+    class TestCases(unittest.TestCase):
+
+        def setUp(self):
+            self.top = tempfile.mkdtemp()
+
+        def tearDown(self):
+            shutil.rmtree(self.top)
+
+        def _write(self, fn, n):
+            with open(fn, 'wb') as fh:
+                fh.write(b'x' * n)
+
+        def test_sizes_1(self):
+            tm = TemporaryFileManager(self.top)
+            dr = tm.get_dir('a')
+            fn = tm.get_file('b', group='b')
+            self._write(join(dr, 'x'), 100)
+            self._write(fn, 10)
+            self.assertEqual(0, tm.size())  # not measured yet
+            tm.refresh()
+            self.assertEqual(110, tm.size())
+            self._write(join(dr, 'y'), 1000)
+            tm.remove_group('a')
+            self.assertEqual(10, tm.size())
+            self.assertEqual(1110, tm.peak_size)
+            self.assertFalse(os.path.exists(dr))
+            tm.purge()
+            self.assertEqual(0, tm.size())
+
+        def test_watch_peak_1(self):
+            tm = TemporaryFileManager(self.top)
+            fa, fb = tm.get_file('a', group='a'), tm.get_file('b', group='b')
+            self._write(fa, 1000)
+            tm.remove_group('a')
+            outer = tm.watch_peak()
+            self._write(fb, 10)
+            inner = tm.watch_peak()
+            self._write(fb, 100)
+            self.assertEqual(100, tm.unwatch_peak(inner))
+            self._write(fb, 50)
+            self.assertEqual(100, tm.unwatch_peak(outer))
+            self.assertEqual(1000, tm.peak_size)
+            tm.purge()
+
+        def test_sampler_1(self):
+            tm = TemporaryFileManager(self.top, budget=500)
+            dr = tm.get_dir('a')
+            tm.start_sampler(0.01)
+            self._write(join(dr, 'x'), 1000)
+            time.sleep(0.2)
+            os.remove(join(dr, 'x'))
+            time.sleep(0.2)
+            tm.stop_sampler()
+            self.assertEqual(0, tm.size())
+            self.assertEqual(1000, tm.peak_size)
+            self.assertTrue(tm.warned_budget)
+            self.assertEqual(500, tm.remaining())
+
+        def test_tiers_1(self):
+            fast_top = tempfile.mkdtemp()
+            try:
+                tm = TemporaryFileManager(self.top, budget=100, fast_dr=fast_top, fast_size=1000)
+                fa = tm.get_dir('a', fast=True, expected_size=600)
+                fb = tm.get_file('b', fast=True, expected_size=600)  # doesn't fit
+                fc = tm.get_file('c', fast=True)  # no expected size
+                self.assertTrue(fa.startswith(fast_top))
+                self.assertTrue(fb.startswith(tm.dir))
+                self.assertTrue(fc.startswith(tm.dir))
+                self.assertEqual(fa, tm.get_dir('a'))
+                self._write(join(fa, 'x'), 900)
+                self._write(fb, 50)
+                tm.refresh()
+                self.assertEqual(950, tm.size())
+                self.assertEqual(50, tm.disk_size())
+                self.assertFalse(tm.over_budget())
+                # a has grown beyond its expected size, leaving room for 100
+                self.assertTrue(tm.get_file('d', fast=True, expected_size=101).startswith(tm.dir))
+                fe = tm.get_file('e', fast=True, expected_size=100)
+                self.assertTrue(fe.startswith(fast_top))
+                self._write(fe, 10)
+                tm.remove_group('a')
+                self.assertEqual(50, tm.size())
+                self.assertFalse(os.path.exists(fa))
+                # freed space is available again
+                self.assertTrue(tm.get_file('f', fast=True, expected_size=800).startswith(fast_top))
+                tm.purge()
+                self.assertEqual([], os.listdir(tm.fast_dir))
+            finally:
+                shutil.rmtree(fast_top)
+
+        def test_consumers_1(self):
+            tm = TemporaryFileManager(self.top)
+            dr = tm.get_dir('a')
+            self._write(join(dr, 'x'), 100)
+            tm.add_consumers('a', ['parse', 'fit', 'fit'])
+            self.assertFalse(tm.consumed('a', 'rewrite'))  # not registered
+            self.assertFalse(tm.consumed('a', 'fit'))
+            self.assertFalse(tm.consumed('a', 'parse'))
+            self.assertTrue(os.path.exists(dr))
+            self.assertTrue(tm.consumed('a', 'fit'))
+            self.assertFalse(os.path.exists(dr))
+            self.assertEqual(0, tm.size())
+            self.assertEqual(100, tm.peak_size)
+            self.assertFalse(tm.consumed('a', 'fit'))  # already gone
+            # group can be handed out and registered again
+            dr = tm.get_dir('a')
+            tm.add_consumers('a', ['parse'])
+            self.assertTrue(tm.consumed('a', 'parse'))
+            self.assertFalse(os.path.exists(dr))
+            tm.purge()
+
+    unittest.main(argv=[sys.argv[0]])
+    sys.exit()